@@ -20,6 +20,7 @@ os.environ['PYOPENGL_PLATFORM'] = 'egl'
 import cv2
 import time
 import torch
+import functools
 import joblib
 import shutil
 import colorsys
@@ -27,90 +28,520 @@ import argparse
 import numpy as np
 from tqdm import tqdm
 from multi_person_tracker import MPT
+from multi_person_tracker.sort import Sort
 from torch.utils.data import DataLoader
 
 from lib.models.vibe import VIBE_Demo
 from lib.utils.renderer import Renderer
-from lib.dataset.inference import Inference
+from lib.dataset.inference import Inference, FrameBuffer, iter_tracklet_batches
 from lib.utils.smooth_pose import smooth_pose
+from lib.utils.smooth_bbox import smooth_bbox_params
+from lib.utils.subject_selection import select_subjects
 from lib.data_utils.kp_utils import convert_kps
 from lib.utils.pose_tracker import run_posetracker
+from instrumentation import get_profiler
 
 from lib.utils.demo_utils import (
     smplify_runner,
     convert_crop_coords_to_orig_img,
     convert_crop_cam_to_orig_img,
     prepare_rendering_results,
-    video_to_images,
+    get_person_verts,
+    get_video_info,
+    scaled_size,
+    video_to_frames,
     images_to_video,
     download_ckpt,
 )
 
 MIN_NUM_FRAMES = 25
+# frame rate MIN_NUM_FRAMES and the smoothing parameters are meant for
+REFERENCE_FPS = 30.
 
-def main(args):
-    device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+
+def min_num_frames(fps):
+    """
+    Shortest tracklet kept at `fps`, i.e. as long in seconds as
+    MIN_NUM_FRAMES frames at REFERENCE_FPS.
+    """
+    if not fps:
+        return MIN_NUM_FRAMES
+    return max(int(round(MIN_NUM_FRAMES * fps / REFERENCE_FPS)), 1)
+
+
+def load_vibe_model(device, use_3dpw=False):
+    """
+    Builds VIBE_Demo, loads the pretrained VIBE weights and puts the model
+    in eval mode.
+    """
+    model = VIBE_Demo(
+        seqlen=16,
+        n_layers=2,
+        hidden_size=1024,
+        add_linear=True,
+        use_residual=True,
+    ).to(device)
+
+    pretrained_file = download_ckpt(use_3dpw=use_3dpw)
+    ckpt = torch.load(pretrained_file, weights_only = False)
+    print(f'Performance of pretrained model on 3DPW: {ckpt["performance"]}')
+    ckpt = ckpt['gen_state_dict']
+    model.load_state_dict(ckpt, strict=False)
+    model.eval()
+    print(f'Loaded pretrained weights from \"{pretrained_file}\"')
+    return model
+
+
+def build_tracker(device, tracker_batch_size=12, display=False, detector='yolo', yolo_img_size=416):
+    """
+    Builds the multi object tracker used for bbox tracking.
+    """
+    return MPT(
+        device=device,
+        batch_size=tracker_batch_size,
+        display=display,
+        detector_type=detector,
+        output_format='dict',
+        yolo_img_size=yolo_img_size,
+    )
+
+
+def track_frames(mot, frames, profiler=None, detect_size=None):
+    """
+    Runs the multi object tracker on an in-memory video (NxHxWx3, RGB)
+    and returns the tracklets in MPT's dict output format, plus the
+    detection score of every tracklet frame under 'scores'.
+
+    Same as MPT.run_tracker, with detection and tracking timed as
+    separate spans of `profiler`. With `detect_size` the detector gets the
+    frames downscaled so that their longer side is at most that many
+    pixels (YOLO resizes its input to yolo_img_size anyway); the boxes are
+    mapped back to the coordinates of `frames`.
+    """
+    profiler = get_profiler(profiler)
+    dataset, box_scale = _detection_frames(frames, detect_size)
+    dataloader = DataLoader(dataset, batch_size=mot.batch_size, num_workers=0)
+
+    # fresh tracker state for every video
+    mot.tracker = Sort()
+    trackers = []
+    frame_dets = []
+    with torch.no_grad():
+        for batch in dataloader:
+            with profiler.span('detection', frames=len(batch)):
+                detections = _detect(mot, batch, box_scale)
+
+            with profiler.span('tracking', frames=len(detections)):
+                for dets in detections:
+                    frame_dets.append(dets)
+                    # if nothing detected do not update the tracker
+                    if dets.shape[0] > 0:
+                        trackers.append(mot.tracker.update(dets))
+                    else:
+                        trackers.append(np.empty((0, 5)))
+
+    tracking_results = mot.prepare_output_tracks(trackers)
+    # Sort drops the scores, take the one of the nearest detection
+    for tracklet in tracking_results.values():
+        tracklet['scores'] = _tracklet_scores(tracklet, frame_dets)
+    return tracking_results
+
+
+def _tracklet_scores(tracklet, frame_dets):
+    # score of the detection closest to the tracklet box in every frame
+    scores = np.zeros(len(tracklet['frames']))
+    for i, (frame, bbox) in enumerate(zip(tracklet['frames'], tracklet['bbox'])):
+        dets = frame_dets[frame]
+        if dets.shape[0] > 0:
+            centers = (dets[:, :2] + dets[:, 2:4]) / 2
+            scores[i] = dets[np.argmin(np.sum((centers - bbox[:2]) ** 2, axis=1)), 4]
+    return scores
+
+
+def _detection_frames(frames, detect_size):
+    # frames as the detector gets them, and the scale mapping its boxes
+    # (x1, y1, x2, y2) back to the coordinates of `frames`
+    height, width = frames.shape[1:3]
+    det_width, det_height = scaled_size(width, height, detect_size)
+    box_scale = np.array([width / det_width, height / det_height] * 2)
+    return FrameBuffer(frames, size=(det_width, det_height)), box_scale
+
+
+def _detect(mot, batch, box_scale):
+    # detections (x1, y1, x2, y2, score) above the tracker's threshold,
+    # one array per image of the batch
+    predictions = mot.detector(batch.to(mot.device))
+    detections = []
+    for pred in predictions:
+        boxes, scores = pred['boxes'].cpu().numpy(), pred['scores'].cpu().numpy()
+        dets = np.hstack([boxes * box_scale, scores[..., None]])
+        detections.append(dets[scores > mot.detection_threshold])
+    return detections
+
+
+def _box_iou(boxes, box):
+    # IoU of boxes (Nx4) with one box, all (x1, y1, x2, y2)
+    w = np.clip(np.minimum(boxes[:, 2], box[2]) - np.maximum(boxes[:, 0], box[0]), 0, None)
+    h = np.clip(np.minimum(boxes[:, 3], box[3]) - np.maximum(boxes[:, 1], box[1]), 0, None)
+    inter = w * h
+    area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    union = area + (box[2] - box[0]) * (box[3] - box[1]) - inter
+    return inter / np.maximum(union, 1e-9)
+
+
+def track_keyframes(mot, frames, max_stride=8, max_motion=0.05, min_iou=0.1, profiler=None,
+                    detect_size=None):
+    """
+    Single-person counterpart of `track_frames` that only runs the
+    detector on keyframes.
+
+    Frames are first detected every `max_stride` frames. Wherever the box
+    of the person moves or scales by more than `max_motion` (relative to
+    its height) between two keyframes, or is found in only one of them,
+    the frame halfway between is detected too, until the motion is small
+    or the keyframes are adjacent. The person is the largest detection
+    of the first keyframe with one, then on every following keyframe the
+    detection overlapping most with its last box (a keyframe where none
+    overlaps it by `min_iou` counts as undetected), so it is not swapped
+    for a bystander who looks larger. Boxes in between are interpolated
+    linearly and smoothed with `smooth_bbox_params`.
+
+    :return: tracklets in MPT's dict output format, one person (id 1)
+             from its first to its last detected keyframe
+    """
+    profiler = get_profiler(profiler)
+    dataset, box_scale = _detection_frames(frames, detect_size)
+    num_frames = len(frames)
+    max_stride = max(int(max_stride), 1)
+
+    # keyframe -> its detections (x1, y1, x2, y2, score)
+    detections = {}
+
+    def detect(frame_ids):
+        for start in range(0, len(frame_ids), mot.batch_size):
+            ids = frame_ids[start:start + mot.batch_size]
+            with profiler.span('detection', frames=len(ids)):
+                detections.update(zip(ids, _detect(mot, torch.stack([dataset[i] for i in ids]), box_scale)))
+
+    def link():
+        # keyframe -> [c_x, c_y, w, h] of the person, None when it is not
+        # detected; keyframes are added out of order, so the person is
+        # followed again from the first one after every pass
+        boxes, scores = {}, {}
+        last = None
+        for i in sorted(detections):
+            dets = detections[i]
+            boxes[i] = None
+            if dets.shape[0] == 0:
+                continue
+            if last is None:
+                best = np.argmax((dets[:, 2] - dets[:, 0]) * (dets[:, 3] - dets[:, 1]))
+            else:
+                overlap = _box_iou(dets[:, :4], last)
+                best = np.argmax(overlap)
+                if overlap[best] < min_iou:
+                    continue
+            last = dets[best, :4]
+            w, h = last[2] - last[0], last[3] - last[1]
+            boxes[i] = np.array([last[0] + w / 2, last[1] + h / 2, w, h])
+            scores[i] = dets[best, 4]
+        return boxes, scores
+
+    def moved(a, b):
+        if a is None or b is None:
+            return a is not b
+        change = np.abs(a - b)[[0, 1, 3]].max()
+        return change > max_motion * (a[3] + b[3]) / 2
+
+    pending = sorted(set(range(0, num_frames, max_stride)) | {num_frames - 1})
+    with torch.no_grad():
+        while pending:
+            detect(pending)
+            boxes, scores = link()
+            keyframes = sorted(boxes)
+            pending = [(a + b) // 2 for a, b in zip(keyframes[:-1], keyframes[1:])
+                       if b - a > 1 and moved(boxes[a], boxes[b])]
+
+    with profiler.span('tracking', frames=num_frames):
+        keyframes = np.array(sorted(i for i, box in boxes.items() if box is not None))
+        if len(keyframes) == 0:
+            return {}
+
+        tracklet_frames = np.arange(keyframes[0], keyframes[-1] + 1)
+        key_boxes = np.stack([boxes[i] for i in keyframes])
+        bbox = np.stack([np.interp(tracklet_frames, keyframes, key_boxes[:, j]) for j in range(4)], axis=1)
+
+        # median kernel of at most the tracklet length (odd); the ends are
+        # padded with the end boxes, medfilt would pad them with zeros
+        kernel_size = min(11, len(bbox) - (1 - len(bbox) % 2))
+        if kernel_size >= 3:
+            pad = kernel_size // 2
+            bbox = np.pad(bbox, ((pad, pad), (0, 0)), mode='edge')
+            bbox = smooth_bbox_params(bbox, kernel_size=kernel_size, sigma=3)[pad:-pad]
+
+        # square boxes, as MPT.prepare_output_tracks makes them
+        bbox[:, 2] = bbox[:, 3] = np.maximum(bbox[:, 2], bbox[:, 3])
+
+    return {1: {
+        'bbox': bbox,
+        'frames': tracklet_frames,
+        'scores': np.interp(tracklet_frames, keyframes, [scores[i] for i in keyframes]),
+    }}
+
+
+def decode_stage(args, models=None, profiler=None):
+    """
+    First stage of a VIBE run: checks the input, prepares the output
+    folder and decodes `args.vid_file` into memory.
+
+    The stages (decode_stage, track_stage, regress_stage, output_stage)
+    share one `state` dict and run in this order; `main` chains them for
+    one video, the job executor runs them for several jobs at once.
+    Their spans are recorded in `profiler` (kept as `state['profiler']`).
+
+    :return: state dict of the run
+    """
+    profiler = get_profiler(profiler)
+    device = models.device if models is not None else \
+        (torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu'))
 
     video_file = args.vid_file
     if not os.path.isfile(video_file):
         exit(f'Input video \"{video_file}\" does not exist!')
 
+    # the pose tracker reads every frame of the original video, its frame
+    # indices only match the decoded frames when none are dropped
+    if args.tracking_method == 'pose' and (args.max_frames or args.target_fps or args.max_duration):
+        exit('--max_frames, --target_fps and --max_duration are not supported with pose tracking')
+
     output_path = os.path.join(args.output_folder)
     os.makedirs(output_path, exist_ok=True)
 
-    image_folder, num_frames, img_shape = video_to_images(video_file, return_info=True)
+    # decoded frames are shared by the tracker, VIBE and the renderer
+    with profiler.span('decode') as span:
+        # frames outside the budget are dropped by ffmpeg, the tracker
+        # and VIBE never see them; frames are decoded at max_img_size,
+        # enough for the 224x224 person crops
+        info = get_video_info(video_file)
+        video_frames, num_frames, img_shape, fps = video_to_frames(
+            video_file, return_info=True,
+            max_frames=args.max_frames,
+            target_fps=args.target_fps,
+            max_duration=args.max_duration,
+            max_size=args.max_img_size,
+            info=info,
+        )
+        span['frames'] = num_frames
 
-    print(f'Input video number of frames {num_frames}')
-    orig_height, orig_width = img_shape[:2]
+    print(f'Input video number of frames {num_frames} ({fps:.2f} fps)')
+    # the results are given in the coordinates of the original video
+    orig_shape = (info['height'], info['width'], 3)
+    img_scale = info['width'] / img_shape[1]
 
     total_time = time.time()
 
+    return {
+        'device': device,
+        'video_file': video_file,
+        'output_path': output_path,
+        'video_frames': video_frames,
+        'num_frames': num_frames,
+        'img_shape': img_shape,
+        'orig_shape': orig_shape,
+        'img_scale': img_scale,
+        'fps': fps,
+        'total_time': total_time,
+        'profiler': profiler,
+    }
+
+
+def track_stage(args, state, models=None):
+    """
+    Tracks the people of the decoded video, keeping the tracklets of at
+    least MIN_NUM_FRAMES frames (at REFERENCE_FPS, scaled to the frame
+    rate of the decoded frames) in `state['tracking_results']`.
+
+    The tracklets are ordered by their subject score (duration, box area,
+    centrality and detection confidence), the most likely subject first;
+    with `args.num_subjects` only that many are kept, so VIBE does not run
+    on bystanders.
+    """
+    device = state['device']
+    video_file = state['video_file']
+    video_frames = state['video_frames']
+    profiler = state['profiler']
+    # YOLO works at yolo_img_size, larger frames only cost transfer time
+    detect_size = args.yolo_img_size if args.detector == 'yolo' else None
+    if args.keyframe_stride and args.keyframe_stride > 1:
+        # one person: detect on keyframes and interpolate the box
+        track = functools.partial(track_keyframes, max_stride=args.keyframe_stride,
+                                  max_motion=args.keyframe_motion)
+    else:
+        track = track_frames
+
     # ========= Run tracking ========= #
-    bbox_scale = 1.1
     if args.tracking_method == 'pose':
         if not os.path.isabs(video_file):
             video_file = os.path.join(os.getcwd(), video_file)
-        tracking_results = run_posetracker(video_file, staf_folder=args.staf_dir, display=args.display)
+        with profiler.span('tracking', frames=state['num_frames']):
+            tracking_results = run_posetracker(video_file, staf_folder=args.staf_dir, display=args.display)
     else:
         # run multi object tracker
-        mot = MPT(
-            device=device,
-            batch_size=args.tracker_batch_size,
-            display=args.display,
-            detector_type=args.detector,
-            output_format='dict',
-            yolo_img_size=args.yolo_img_size,
-        )
-        tracking_results = mot(image_folder)
+        if models is not None:
+            # MPT keeps its Sort state on the instance, so a shared
+            # tracker can only serve one job at a time
+            with models.tracker_lock:
+                tracking_results = track(models.tracker, video_frames, profiler=profiler,
+                                         detect_size=detect_size)
+        else:
+            mot = build_tracker(
+                device,
+                tracker_batch_size=args.tracker_batch_size,
+                display=args.display,
+                detector=args.detector,
+                yolo_img_size=args.yolo_img_size,
+            )
+            tracking_results = track(mot, video_frames, profiler=profiler,
+                                     detect_size=detect_size)
 
     # remove tracklets if num_frames is less than MIN_NUM_FRAMES
+    min_frames = min_num_frames(state['fps'])
     for person_id in list(tracking_results.keys()):
-        if tracking_results[person_id]['frames'].shape[0] < MIN_NUM_FRAMES:
+        if tracking_results[person_id]['frames'].shape[0] < min_frames:
             del tracking_results[person_id]
 
-    # ========= Define VIBE model ========= #
-    model = VIBE_Demo(
-        seqlen=16,
-        n_layers=2,
-        hidden_size=1024,
-        add_linear=True,
-        use_residual=True,
-    ).to(device)
+    # pose tracking runs on the original video, bbox tracking on the decoded frames
+    img_height, img_width = state['orig_shape' if args.tracking_method == 'pose' else 'img_shape'][:2]
+    tracking_results, subject_scores = select_subjects(tracking_results, img_width, img_height,
+                                                       state['num_frames'], top_k=args.num_subjects)
+    if args.num_subjects:
+        print(f'Selected subject(s) {list(tracking_results.keys())} '
+              f'out of {len(subject_scores)} tracklet(s)')
 
-    # ========= Load pretrained weights ========= #
-    pretrained_file = download_ckpt(use_3dpw=False)
-    ckpt = torch.load(pretrained_file, weights_only = False)
-    print(f'Performance of pretrained model on 3DPW: {ckpt["performance"]}')
-    ckpt = ckpt['gen_state_dict']
-    model.load_state_dict(ckpt, strict=False)
-    model.eval()
-    print(f'Loaded pretrained weights from \"{pretrained_file}\"')
+    state['tracking_results'] = tracking_results
+    state['subject_scores'] = subject_scores
+    return state
 
-    # ========= Run VIBE on each person ========= #
-    print(f'Running VIBE on each tracklet...')
-    vibe_time = time.time()
-    vibe_results = {}
-    for person_id in tqdm(list(tracking_results.keys())):
+
+def regress_tracklets(model, datasets, batch_size, stream=True, return_verts=True,
+                      device=None, batcher=None, profiler=None):
+    """
+    Runs VIBE on several tracklets of one video at once.
+
+    The n-th chunk of `batch_size` frames of every tracklet is cropped in
+    one pass (`iter_tracklet_batches`) and goes through the backbone in one
+    call. For the temporal encoder the tracklets are padded to the longest
+    chunk along the batch dimension, with their lengths so that the GRU
+    skips the padding; the regressor only runs on the valid frames. With
+    `stream` the GRU state of every tracklet is carried from one chunk to
+    the next, otherwise each chunk starts from zeros.
+
+    :param model: VIBE_Demo
+    :param datasets: one Inference dataset per tracklet
+    :param batcher: optional FeatureBatcher used for the backbone
+    :return: one dict per tracklet with its 'pred_cam', 'pred_verts' (None
+             without `return_verts`), 'pred_pose', 'pred_betas',
+             'pred_joints3d', 'smpl_joints2d' (tensors, one row per frame)
+             and 'norm_joints2d' (ndarray, None without keypoints)
+    """
+    profiler = get_profiler(profiler)
+    keys = ['pred_cam', 'pred_verts', 'pred_pose', 'pred_betas', 'pred_joints3d', 'smpl_joints2d',
+            'norm_joints2d']
+    outputs = [{key: [] for key in keys} for _ in datasets]
+    hidden = None
+
+    with torch.no_grad():
+        # building a batch crops and normalizes all its frames at once
+        batches = profiler.iterate('crop', iter_tracklet_batches(datasets, batch_size),
+                                   frames=lambda b: sum(b[2]))
+        for crops, kp_2d, lengths in batches:
+            num_frames = sum(lengths)
+            active = [i for i, length in enumerate(lengths) if length > 0]
+            active_lengths = torch.tensor([lengths[i] for i in active])
+
+            # same as model.forward, one span per part
+            with profiler.span('hmr', frames=num_frames):
+                crops = crops.to(device)
+                if batcher is not None:
+                    # the backbone runs on the frames of concurrent jobs at once
+                    feature = batcher.extract(crops)
+                else:
+                    feature = model.hmr.feature_extractor(crops)
+
+            with profiler.span('temporal_encoder', frames=num_frames):
+                # tracklets along the batch dimension, padded to the longest
+                mask = torch.arange(int(active_lengths.max()))[None, :] < active_lengths[:, None]
+                mask = mask.to(feature.device)
+                padded = feature.new_zeros(len(active), mask.shape[1], feature.shape[-1])
+                padded[mask] = feature
+
+                active_hidden = hidden[:, active] if hidden is not None else None
+                padded, next_hidden = model.encoder(padded, hidden=active_hidden, return_hidden=True,
+                                                    lengths=active_lengths)
+                if stream:
+                    if hidden is None:
+                        hidden = next_hidden.new_zeros(next_hidden.shape[0], len(datasets), next_hidden.shape[2])
+                    hidden[:, active] = next_hidden
+                # valid frames, tracklet after tracklet as in `crops`
+                feature = padded[mask]
+
+            with profiler.span('regressor', frames=num_frames):
+                output = model.regress(feature[None], return_verts=return_verts)[-1]
+
+            split = [lengths[i] for i in active]
+            theta = output['theta'][0].split(split)
+            verts = output['verts'][0].split(split) if return_verts else [None] * len(active)
+            kp_3d = output['kp_3d'][0].split(split)
+            kp_2d_smpl = output['kp_2d'][0].split(split)
+            if kp_2d is not None:
+                kp_2d = np.split(kp_2d, np.cumsum(split)[:-1])
+
+            for j, i in enumerate(active):
+                outputs[i]['pred_cam'].append(theta[j][:, :3])
+                outputs[i]['pred_verts'].append(verts[j])
+                outputs[i]['pred_pose'].append(theta[j][:, 3:75])
+                outputs[i]['pred_betas'].append(theta[j][:, 75:])
+                outputs[i]['pred_joints3d'].append(kp_3d[j])
+                outputs[i]['smpl_joints2d'].append(kp_2d_smpl[j])
+                if kp_2d is not None:
+                    outputs[i]['norm_joints2d'].append(kp_2d[j].reshape(-1, 21, 3))
+
+    for output in outputs:
+        for key in keys:
+            if key == 'norm_joints2d':
+                output[key] = np.concatenate(output[key], axis=0) if output[key] else None
+            elif key == 'pred_verts' and not return_verts:
+                output[key] = None
+            else:
+                output[key] = torch.cat(output[key], dim=0)
+    return outputs
+
+
+def regress_stage(args, state, models=None):
+    """
+    Runs VIBE (and the optional SMPLify refinement and smoothing) on every
+    tracklet, leaving the per-person results in `state['vibe_results']`.
+    The VIBE forward runs on all tracklets at once, see `regress_tracklets`.
+    """
+    device = state['device']
+    video_frames = state['video_frames']
+    tracking_results = state['tracking_results']
+    orig_height, orig_width = state['orig_shape'][:2]
+    img_scale = state['img_scale']
+    profiler = state['profiler']
+    bbox_scale = 1.1
+
+    # ========= Define VIBE model and load pretrained weights ========= #
+    if models is not None:
+        model = models.vibe_model
+        batcher = models.feature_batcher
+    else:
+        model = load_vibe_model(device)
+        batcher = None
+
+    # ========= Crop every tracklet ========= #
+    datasets, tracker_joints2d = [], []
+    for person_id in tracking_results:
         bboxes = joints2d = None
 
         if args.tracking_method == 'bbox':
@@ -120,77 +551,81 @@ def main(args):
 
         frames = tracking_results[person_id]['frames']
 
-        dataset = Inference(
-            image_folder=image_folder,
+        # the pose tracker reads the original video, its keypoints are
+        # brought to the decoded frames VIBE crops from
+        crop_joints2d = joints2d
+        if joints2d is not None and img_scale != 1:
+            crop_joints2d = joints2d.copy()
+            crop_joints2d[..., :2] /= img_scale
+
+        datasets.append(Inference(
+            image_folder=None,
             frames=frames,
             bboxes=bboxes,
-            joints2d=joints2d,
+            joints2d=crop_joints2d,
             scale=bbox_scale,
-        )
+            images=video_frames,
+        ))
+        tracker_joints2d.append(joints2d)
 
-        bboxes = dataset.bboxes
-        frames = dataset.frames
-        has_keypoints = True if joints2d is not None else False
-
-        dataloader = DataLoader(dataset, batch_size=args.vibe_batch_size, num_workers=1)
-
-        with torch.no_grad():
-
-            pred_cam, pred_verts, pred_pose, pred_betas, pred_joints3d, smpl_joints2d, norm_joints2d = [], [], [], [], [], [], []
-
-            for batch in dataloader:
-                if has_keypoints:
-                    batch, nj2d = batch
-                    norm_joints2d.append(nj2d.numpy().reshape(-1, 21, 3))
-
-                batch = batch.unsqueeze(0)
-                batch = batch.to(device)
-
-                batch_size, seqlen = batch.shape[:2]
-                output = model(batch)[-1]
-
-                pred_cam.append(output['theta'][:, :, :3].reshape(batch_size * seqlen, -1))
-                pred_verts.append(output['verts'].reshape(batch_size * seqlen, -1, 3))
-                pred_pose.append(output['theta'][:,:,3:75].reshape(batch_size * seqlen, -1))
-                pred_betas.append(output['theta'][:, :,75:].reshape(batch_size * seqlen, -1))
-                pred_joints3d.append(output['kp_3d'].reshape(batch_size * seqlen, -1, 3))
-                smpl_joints2d.append(output['kp_2d'].reshape(batch_size * seqlen, -1, 2))
+    # ========= Run VIBE on all tracklets at once ========= #
+    print(f'Running VIBE on {len(datasets)} tracklet(s)...')
+    vibe_time = time.time()
 
+    # in streaming mode the tracklets are fed in chunks of vibe_chunk_size
+    # frames with the GRU state carried over, so only one chunk of
+    # activations is alive at a time and the result matches one pass
+    # over the whole sequence
+    stream = bool(args.vibe_chunk_size)
+    predictions = regress_tracklets(
+        model, datasets,
+        batch_size=args.vibe_chunk_size if stream else args.vibe_batch_size,
+        stream=stream,
+        return_verts=not args.params_only,
+        device=device,
+        batcher=batcher,
+        profiler=profiler,
+    )
 
-            pred_cam = torch.cat(pred_cam, dim=0)
-            pred_verts = torch.cat(pred_verts, dim=0)
-            pred_pose = torch.cat(pred_pose, dim=0)
-            pred_betas = torch.cat(pred_betas, dim=0)
-            pred_joints3d = torch.cat(pred_joints3d, dim=0)
-            smpl_joints2d = torch.cat(smpl_joints2d, dim=0)
-            del batch
+    vibe_results = {}
+    for person_id, dataset, joints2d, prediction in zip(tracking_results, datasets, tracker_joints2d, predictions):
+        bboxes = dataset.bboxes
+        frames = dataset.frames
+        pred_cam = prediction['pred_cam']
+        pred_verts = prediction['pred_verts']
+        pred_pose = prediction['pred_pose']
+        pred_betas = prediction['pred_betas']
+        pred_joints3d = prediction['pred_joints3d']
+        smpl_joints2d = prediction['smpl_joints2d']
+        norm_joints2d = prediction['norm_joints2d']
 
         # ========= [Optional] run Temporal SMPLify to refine the results ========= #
         if args.run_smplify and args.tracking_method == 'pose':
-            norm_joints2d = np.concatenate(norm_joints2d, axis=0)
             norm_joints2d = convert_kps(norm_joints2d, src='staf', dst='spin')
             norm_joints2d = torch.from_numpy(norm_joints2d).float().to(device)
 
             # Run Temporal SMPLify
-            update, new_opt_vertices, new_opt_cam, new_opt_pose, new_opt_betas, \
-            new_opt_joints3d, new_opt_joint_loss, opt_joint_loss = smplify_runner(
-                pred_rotmat=pred_pose,
-                pred_betas=pred_betas,
-                pred_cam=pred_cam,
-                j2d=norm_joints2d,
-                device=device,
-                batch_size=norm_joints2d.shape[0],
-                pose2aa=False,
-            )
+            with profiler.span('smplify', frames=norm_joints2d.shape[0]):
+                update, new_opt_vertices, new_opt_cam, new_opt_pose, new_opt_betas, \
+                new_opt_joints3d, new_opt_joint_loss, opt_joint_loss = smplify_runner(
+                    pred_rotmat=pred_pose,
+                    pred_betas=pred_betas,
+                    pred_cam=pred_cam,
+                    j2d=norm_joints2d,
+                    device=device,
+                    batch_size=norm_joints2d.shape[0],
+                    pose2aa=False,
+                )
 
             # update the parameters after refinement
             print(f'Update ratio after Temporal SMPLify: {update.sum()} / {norm_joints2d.shape[0]}')
-            pred_verts = pred_verts.cpu()
             pred_cam = pred_cam.cpu()
             pred_pose = pred_pose.cpu()
             pred_betas = pred_betas.cpu()
             pred_joints3d = pred_joints3d.cpu()
-            pred_verts[update] = new_opt_vertices[update]
+            if pred_verts is not None:
+                pred_verts = pred_verts.cpu()
+                pred_verts[update] = new_opt_vertices[update]
             pred_cam[update] = new_opt_cam[update]
             pred_pose[update] = new_opt_pose[update]
             pred_betas[update] = new_opt_betas[update]
@@ -202,7 +637,8 @@ def main(args):
 
         # ========= Save results to a pickle file ========= #
         pred_cam = pred_cam.cpu().numpy()
-        pred_verts = pred_verts.cpu().numpy()
+        if pred_verts is not None:
+            pred_verts = pred_verts.cpu().numpy()
         pred_pose = pred_pose.cpu().numpy()
         pred_betas = pred_betas.cpu().numpy()
         pred_joints3d = pred_joints3d.cpu().numpy()
@@ -212,9 +648,19 @@ def main(args):
         if args.smooth:
             min_cutoff = args.smooth_min_cutoff # 0.004
             beta = args.smooth_beta # 1.5
+            # the filter is tuned for REFERENCE_FPS, a subsampled video
+            # has more time between its frames
+            t_e = REFERENCE_FPS / state['fps'] if state['fps'] else 1.0
             print(f'Running smoothing on person {person_id}, min_cutoff: {min_cutoff}, beta: {beta}')
-            pred_verts, pred_pose, pred_joints3d = smooth_pose(pred_pose, pred_betas,
-                                                               min_cutoff=min_cutoff, beta=beta)
+            with profiler.span('smoothing', frames=pred_pose.shape[0]):
+                pred_verts, pred_pose, pred_joints3d = smooth_pose(pred_pose, pred_betas,
+                                                                   min_cutoff=min_cutoff, beta=beta,
+                                                                   return_verts=not args.params_only,
+                                                                   smpl=models.smpl if models is not None else None,
+                                                                   t_e=t_e)
+
+        # boxes of the decoded frames -> original video coordinates
+        bboxes = bboxes * img_scale
 
         orig_cam = convert_crop_cam_to_orig_img(
             cam=pred_cam,
@@ -244,7 +690,29 @@ def main(args):
 
         vibe_results[person_id] = output_dict
 
-    del model
+    if models is None:
+        del model
+
+    state['vibe_results'] = vibe_results
+    state['vibe_time'] = vibe_time
+    return state
+
+
+def output_stage(args, state, models=None):
+    """
+    Reports timings, saves the results as vibe_output.pkl and renders the
+    result video, as requested by `args`, then releases the frames.
+
+    :return: the VIBE results dictionary
+    """
+    video_file = state['video_file']
+    output_path = state['output_path']
+    video_frames = state['video_frames']
+    num_frames = state['num_frames']
+    orig_height, orig_width = state['img_shape'][:2]
+    vibe_results = state['vibe_results']
+    vibe_time = state['vibe_time']
+    total_time = state['total_time']
 
     end = time.time()
     fps = num_frames / (end - vibe_time)
@@ -254,33 +722,33 @@ def main(args):
     print(f'Total time spent: {total_time:.2f} seconds (including model loading time).')
     print(f'Total FPS (including model loading time): {num_frames / total_time:.2f}.')
 
-    # We still save the .pkl file, as it's useful for VIBE's
-    # rendering step and for debugging.
-    print(f'Saving output results to \"{os.path.join(output_path, "vibe_output.pkl")}\".')
-    joblib.dump(vibe_results, os.path.join(output_path, "vibe_output.pkl"))
+    # The .pkl file is useful for debugging, jobs that only need the
+    # in-memory results can skip it
+    if not args.no_pkl:
+        print(f'Saving output results to \"{os.path.join(output_path, "vibe_output.pkl")}\".')
+        joblib.dump(vibe_results, os.path.join(output_path, "vibe_output.pkl"))
 
     if not args.no_render:
         # ========= Render results as a single video ========= #
         renderer = Renderer(resolution=(orig_width, orig_height), orig_img=True, wireframe=args.wireframe)
 
-        output_img_folder = f'{image_folder}_output'
+        vid_name = os.path.basename(video_file)
+        output_img_folder = os.path.join(output_path, f'{vid_name.replace(".", "_")}_output')
         os.makedirs(output_img_folder, exist_ok=True)
 
         print(f'Rendering output video, writing frames to {output_img_folder}')
 
+        # params-only results carry no mesh, generate it for rendering
+        for person_data in vibe_results.values():
+            if person_data['verts'] is None:
+                person_data['verts'] = get_person_verts(person_data)
+
         # prepare results for rendering
         frame_results = prepare_rendering_results(vibe_results, num_frames)
         mesh_color = {k: colorsys.hsv_to_rgb(np.random.rand(), 0.5, 1.0) for k in vibe_results.keys()}
 
-        image_file_names = sorted([
-            os.path.join(image_folder, x)
-            for x in os.listdir(image_folder)
-            if x.endswith('.png') or x.endswith('.jpg')
-        ])
-
-        for frame_idx in tqdm(range(len(image_file_names))):
-            img_fname = image_file_names[frame_idx]
-            img = cv2.imread(img_fname)
+        for frame_idx in tqdm(range(num_frames)):
+            img = cv2.cvtColor(video_frames[frame_idx], cv2.COLOR_RGB2BGR)
 
             if args.sideview:
                 side_img = np.zeros_like(img)
@@ -330,21 +798,37 @@ def main(args):
             cv2.destroyAllWindows()
 
         # ========= Save rendered video ========= #
-        vid_name = os.path.basename(video_file)
         save_name = f'{vid_name.replace(".mp4", "")}_vibe_result.mp4'
         save_name = os.path.join(output_path, save_name)
         print(f'Saving result video to {save_name}')
         images_to_video(img_folder=output_img_folder, output_vid_file=save_name)
         shutil.rmtree(output_img_folder)
 
-    shutil.rmtree(image_folder)
+    del video_frames
+    state.pop('video_frames', None)
     print('================= END =================')
 
     # <-- *** MODIFICATION 1 *** -->
     # Return the results dictionary for in-memory processing
     return vibe_results
 
-def run_vibe(
+
+def main(args, models=None, profiler=None):
+    """
+    Runs VIBE on `args.vid_file`.
+
+    :param models: optional `ModelRegistry` holding an already loaded VIBE
+                   model and tracker. When it is None both are built here
+                   and released at the end of the call.
+    :param profiler: optional `instrumentation.Profiler` recording the
+                     time and resources of every stage
+    """
+    state = decode_stage(args, models=models, profiler=profiler)
+    track_stage(args, state, models=models)
+    regress_stage(args, state, models=models)
+    return output_stage(args, state, models=models)
+
+def make_vibe_args(
     vid_file: str,
     output_folder: str,
     tracking_method: str = 'bbox',
@@ -353,6 +837,7 @@ def run_vibe(
     tracker_batch_size: int = 12,
     staf_dir: str = '/home/mkocabas/developments/openposetrack',
     vibe_batch_size: int = 450,
+    vibe_chunk_size: int = None,
     display: bool = False,
     run_smplify: bool = False,
     no_render: bool = False,
@@ -361,18 +846,22 @@ def run_vibe(
     save_obj: bool = False,
     smooth: bool = False,
     smooth_min_cutoff: float = 0.004,
-    smooth_beta: float = 0.7
+    smooth_beta: float = 0.7,
+    params_only: bool = False,
+    no_pkl: bool = False,
+    max_frames: int = None,
+    target_fps: float = None,
+    max_duration: float = None,
+    max_img_size: int = None,
+    keyframe_stride: int = None,
+    keyframe_motion: float = 0.05,
+    num_subjects: int = None
 ):
     """
-    Runs the VIBE inference pipeline with specified parameters.
-
-    This function serves as an API-callable alternative to the
-    command-line interface.
+    Builds the arguments of a VIBE run, as argparse.parse_args() would
+    return them for the command-line interface.
     """
-    
-    # 1. Create a namespace object to simulate what argparse.parse_args()
-    #    would return.
-    args = argparse.Namespace(
+    return argparse.Namespace(
         vid_file=vid_file,
         output_folder=output_folder,
         tracking_method=tracking_method,
@@ -381,6 +870,7 @@ def run_vibe(
         tracker_batch_size=tracker_batch_size,
         staf_dir=staf_dir,
         vibe_batch_size=vibe_batch_size,
+        vibe_chunk_size=vibe_chunk_size,
         display=display,
         run_smplify=run_smplify,
         no_render=no_render,
@@ -389,15 +879,41 @@ def run_vibe(
         save_obj=save_obj,
         smooth=smooth,
         smooth_min_cutoff=smooth_min_cutoff,
-        smooth_beta=smooth_beta
+        smooth_beta=smooth_beta,
+        params_only=params_only,
+        no_pkl=no_pkl,
+        max_frames=max_frames,
+        target_fps=target_fps,
+        max_duration=max_duration,
+        max_img_size=max_img_size,
+        keyframe_stride=keyframe_stride,
+        keyframe_motion=keyframe_motion,
+        num_subjects=num_subjects
     )
 
+
+def run_vibe(vid_file: str, output_folder: str, models=None, profiler=None, **options):
+    """
+    Runs the VIBE inference pipeline with specified parameters.
+
+    This function serves as an API-callable alternative to the
+    command-line interface; `options` are the keyword arguments of
+    `make_vibe_args`. Pass a loaded `ModelRegistry` as `models`
+    to reuse the resident VIBE model and tracker instead of rebuilding
+    them for this call, and an `instrumentation.Profiler` as `profiler`
+    to record per-stage timings.
+    """
+    
+    # 1. Create a namespace object to simulate what argparse.parse_args()
+    #    would return.
+    args = make_vibe_args(vid_file, output_folder, **options)
+
     # 2. Call the original main function with the simulated args
     print(f"Starting VIBE processing for: {vid_file}")
     try:
         # <-- *** MODIFICATION 2 *** -->
         # Call the main function from VIBE.py and get the results
-        results_data = main(args)
+        results_data = main(args, models=models, profiler=profiler)
         print(f"Successfully processed video. Results are in: {output_folder}")
         # Return the data dictionary
         return results_data
@@ -434,6 +950,10 @@ if __name__ == '__main__':
     parser.add_argument('--vibe_batch_size', type=int, default=450,
                         help='batch size of VIBE')
 
+    parser.add_argument('--vibe_chunk_size', type=int, default=None,
+                        help='stream each tracklet through VIBE in chunks of this many frames, '
+                             'carrying the GRU state across chunks (bounded memory)')
+
     parser.add_argument('--display', action='store_true',
                         help='visualize the results of each step during demo')
 
@@ -463,6 +983,38 @@ if __name__ == '__main__':
                         help='one euro filter beta. '
                              'Increasing the speed coefficient(beta) decreases speed lag.')
 
+    parser.add_argument('--params_only', action='store_true',
+                        help='only keep SMPL parameters and joints per frame, '
+                             'vertices are not stored and can be generated later')
+
+    parser.add_argument('--no_pkl', action='store_true',
+                        help='do not save the results as vibe_output.pkl')
+
+    parser.add_argument('--max_frames', type=int, default=None,
+                        help='process at most this many frames of the video (bbox tracking only)')
+
+    parser.add_argument('--target_fps', type=float, default=None,
+                        help='subsample videos with a higher frame rate to this one while decoding '
+                             '(bbox tracking only)')
+
+    parser.add_argument('--max_duration', type=float, default=None,
+                        help='only process the first seconds of the video (bbox tracking only)')
+
+    parser.add_argument('--max_img_size', type=int, default=None,
+                        help='decode frames with their longer side downscaled to this many pixels')
+
+    parser.add_argument('--keyframe_stride', type=int, default=None,
+                        help='single person videos: run the detector every this many frames at most '
+                             'and interpolate the bbox in between')
+
+    parser.add_argument('--keyframe_motion', type=float, default=0.05,
+                        help='detect more keyframes where the bbox moves by more than this '
+                             'fraction of its height between two keyframes')
+
+    parser.add_argument('--num_subjects', type=int, default=None,
+                        help='only run VIBE on this many tracklets, the most likely subjects '
+                             '(longest, largest, most centered and confident)')
+
     args = parser.parse_args()
 
     main(args)
\ No newline at end of file
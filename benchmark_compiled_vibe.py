@@ -0,0 +1,148 @@
+# benchmark_compiled_vibe.py
+# --------------------------------------------------------------
+# Speed and parity of the compiled VIBE forward against eager
+# --------------------------------------------------------------
+# Runs the VIBE forward of `regress_tracklets` (backbone on the crops
+# of all tracklets, temporal encoder on them padded with their
+# lengths, regressor on the valid frames) with the eager model and
+# with the graphs of compiled_vibe.py, exported first when missing,
+# on the same random crops. Prints the median time of every part for
+# both, the speedup, and the largest difference of every output.
+#
+#   python benchmark_compiled_vibe.py --frames 64 --tracklets 2
+# --------------------------------------------------------------
+
+import copy
+import json
+import time
+import argparse
+import statistics
+
+import torch
+
+from VIBE import load_vibe_model
+from compiled_vibe import DEFAULT_ROOT, compile_vibe
+
+
+def vibe_forward(model, crops, lengths, return_verts=True):
+    """
+    One forward of `model` on the crops (N,3,224,224) of tracklets of
+    `lengths` frames, one after the other.
+
+    :return: dict part -> seconds, dict output name -> tensor
+    """
+    times = {}
+    with torch.no_grad():
+        start = time.perf_counter()
+        feature = model.hmr.feature_extractor(crops)
+        times['backbone'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        mask = torch.arange(int(lengths.max()))[None, :] < lengths[:, None]
+        mask = mask.to(feature.device)
+        padded = feature.new_zeros(len(lengths), mask.shape[1], feature.shape[-1])
+        padded[mask] = feature
+        padded, hidden = model.encoder(padded, return_hidden=True, lengths=lengths)
+        encoded = padded[mask]
+        times['encoder'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        output = model.regress(encoded[None], return_verts=return_verts)[-1]
+        times['regressor'] = time.perf_counter() - start
+
+    times['total'] = sum(times.values())
+    outputs = {'features': feature, 'encoded': encoded, 'hidden': hidden,
+               'theta': output['theta'], 'kp_3d': output['kp_3d']}
+    if return_verts:
+        outputs['verts'] = output['verts']
+    return times, outputs
+
+
+def benchmark(model, crops, lengths, repeats, warmup, return_verts=True):
+    for _ in range(warmup):
+        vibe_forward(model, crops, lengths, return_verts)
+    runs = [vibe_forward(model, crops, lengths, return_verts)[0] for _ in range(repeats)]
+    return {part: statistics.median(run[part] for run in runs) for part in runs[0]}
+
+
+def main(args):
+    device = torch.device(args.device)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    eager = load_vibe_model(device)
+    compiled = copy.deepcopy(eager)
+    parts = compile_vibe(compiled, args.root, export=True)
+    if not parts:
+        raise SystemExit('No compiled part could be exported or loaded')
+
+    # tracklets of about the same length, as regress_tracklets batches them
+    lengths = torch.tensor([len(chunk) for chunk in torch.arange(args.frames).chunk(args.tracklets)])
+    generator = torch.Generator().manual_seed(args.seed)
+    crops = torch.randn(args.frames, 3, 224, 224, generator=generator).to(device)
+
+    _, expected = vibe_forward(eager, crops, lengths, not args.no_verts)
+    _, actual = vibe_forward(compiled, crops, lengths, not args.no_verts)
+    parity = {name: float((actual[name] - expected[name]).abs().max()) for name in expected}
+
+    eager_times = benchmark(eager, crops, lengths, args.repeats, args.warmup, not args.no_verts)
+    compiled_times = benchmark(compiled, crops, lengths, args.repeats, args.warmup, not args.no_verts)
+
+    report = {
+        'torch': torch.__version__,
+        'device': str(device),
+        'frames': args.frames,
+        'tracklets': args.tracklets,
+        'compiled_parts': parts,
+        'eager_s': eager_times,
+        'compiled_s': compiled_times,
+        'speedup': {part: eager_times[part] / compiled_times[part] for part in eager_times},
+        'max_abs_diff': parity,
+    }
+
+    print(f'{args.frames} frames in {args.tracklets} tracklets on {device}, compiled: {", ".join(parts)}')
+    print(f'{"part":<10} {"eager ms":>10} {"compiled ms":>12} {"speedup":>8}')
+    for part in eager_times:
+        print(f'{part:<10} {eager_times[part] * 1000:>10.1f} {compiled_times[part] * 1000:>12.1f} '
+              f'{report["speedup"][part]:>7.2f}x')
+    print('max abs diff: ' + ', '.join(f'{name} {diff:.2e}' for name, diff in parity.items()))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--device', type=str, default='cpu',
+                        help='device to benchmark on')
+
+    parser.add_argument('--root', type=str, default=str(DEFAULT_ROOT),
+                        help='folder of the compiled artifacts')
+
+    parser.add_argument('--frames', type=int, default=64,
+                        help='number of frames of one forward')
+
+    parser.add_argument('--tracklets', type=int, default=2,
+                        help='number of tracklets the frames are split into')
+
+    parser.add_argument('--repeats', type=int, default=5,
+                        help='timed forwards, the median is reported')
+
+    parser.add_argument('--warmup', type=int, default=2,
+                        help='untimed forwards first')
+
+    parser.add_argument('--threads', type=int, default=None,
+                        help='torch CPU threads (torch default when not given)')
+
+    parser.add_argument('--no_verts', action='store_true',
+                        help='leave the SMPL vertices out (return_verts=False)')
+
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the random crops')
+
+    parser.add_argument('--output', type=str, default=None,
+                        help='also write the report as JSON to this file')
+
+    main(parser.parse_args())
@@ -0,0 +1,89 @@
+# check_shape_parity.py
+# --------------------------------------------------------------
+# Parity of the batched shape measurement with the body model path
+# --------------------------------------------------------------
+# "shape" jobs (`measure_shapes`) pose the rest mesh with
+# `shape_to_verts` and measure all bodies with `measure_batch`, while
+# `from_body_model` runs the whole smplx body model for one body and
+# measures it with `measure`. Both have to give the same body and the
+# same measurements, e.g. the SMPL-X hands in their mean pose. For
+# random shapes of every model type, prints the largest vertex and
+# joint difference and the largest difference of every measurement,
+# and exits with an error when one is over the tolerance.
+#
+#   python check_shape_parity.py --model_types smpl smplx
+# --------------------------------------------------------------
+
+import argparse
+
+import numpy as np
+import torch
+
+from measure import MeasureBody, get_body_model, set_shape, shape_to_verts
+
+
+def check_model_type(model_type, gender, num_shapes, seed):
+    """
+    :return: dict of {name: largest absolute difference}, for 'verts',
+             'joints' and every measurement (cm)
+    """
+    betas = torch.randn(num_shapes, 10, generator=torch.Generator().manual_seed(seed))
+    model = get_body_model(model_type, gender)
+
+    verts, joints = shape_to_verts(model, betas)
+    with torch.no_grad():
+        outputs = [set_shape(model, betas[i:i + 1]) for i in range(num_shapes)]
+    ref_verts = np.concatenate([output.vertices.cpu().numpy() for output in outputs])
+    ref_joints = np.concatenate([output.joints[:, :joints.shape[1]].cpu().numpy() for output in outputs])
+    diffs = {'verts': float(np.abs(verts - ref_verts).max()),
+             'joints': float(np.abs(joints - ref_joints).max())}
+
+    measurer = MeasureBody(model_type)
+    names = measurer.all_possible_measurements
+    batched = measurer.measure_batch(verts, names, joints=joints)
+    for i in range(num_shapes):
+        measurer.from_body_model(gender=gender, shape=betas[i:i + 1])
+        measurer.measure(names)
+        for name in names:
+            diff = abs(batched[name][i] - measurer.measurements[name])
+            if not np.isnan(diff):
+                diffs[name] = max(diffs.get(name, 0.), float(diff))
+    return diffs
+
+
+def main(args):
+    failed = False
+    for model_type in args.model_types:
+        diffs = check_model_type(model_type, args.gender, args.num_shapes, args.seed)
+        print(f'{model_type}: ' + ', '.join(f'{name} {diff:.2e}' for name, diff in diffs.items()))
+        over = [name for name, diff in diffs.items()
+                if diff > (args.vert_tol if name in ('verts', 'joints') else args.cm_tol)]
+        if over:
+            print(f'{model_type} differs in {over}')
+            failed = True
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--model_types', type=str, nargs='+', default=['smpl', 'smplx'],
+                        help='body models to check')
+
+    parser.add_argument('--gender', type=str, default='NEUTRAL',
+                        help='gender of the body models')
+
+    parser.add_argument('--num_shapes', type=int, default=8,
+                        help='random shapes checked per body model')
+
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the random shapes')
+
+    parser.add_argument('--vert_tol', type=float, default=1e-5,
+                        help='largest vertex and joint difference (m)')
+
+    parser.add_argument('--cm_tol', type=float, default=1e-2,
+                        help='largest measurement difference (cm)')
+
+    main(parser.parse_args())
@@ -0,0 +1,337 @@
+# compiled_vibe.py
+# --------------------------------------------------------------
+# TorchScript export of the VIBE forward for inference
+# --------------------------------------------------------------
+# VIBE_Demo runs eagerly: every BatchNorm of the ResNet50 backbone is
+# its own op and the regressor iterates in Python. `export_vibe`
+# compiles the backbone, the temporal encoder and the iterative
+# regressor head to TorchScript, freezes them (weights become
+# constants) and saves them on disk under the hash of the weights,
+# the torch version and the device. `compile_vibe` loads the saved
+# graphs, optimizes them for inference (BatchNorms fold into the
+# convolutions; optimized graphs cannot be saved) and swaps them into
+# a loaded model, keeping the eager parts whose graph is missing or
+# unusable. SMPL and the projections stay eager.
+#
+#   python compiled_vibe.py --device cpu    # export once per image
+# --------------------------------------------------------------
+
+import os
+import argparse
+import hashlib
+import warnings
+from pathlib import Path
+from contextlib import contextmanager
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from lib.core.config import VIBE_DATA_DIR
+
+DEFAULT_ROOT = Path(VIBE_DATA_DIR) / 'compiled'
+
+# bump when a change here makes old artifacts wrong
+COMPILE_VERSION = 1
+
+PARTS = ('backbone', 'encoder', 'regressor')
+
+# export refuses a graph further than this from the eager part
+PARITY_RTOL = 1e-3
+PARITY_ATOL = 1e-4
+
+
+@contextmanager
+def _quiet_jit():
+    # torch.jit warns that it is deprecated on every call
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', FutureWarning)
+        warnings.simplefilter('ignore', torch.jit.TracerWarning)
+        yield
+
+
+def artifact_key(model, device=None) -> str:
+    """
+    sha256 of the weights of `model`, the torch version, the device type
+    and COMPILE_VERSION.
+    """
+    device = torch.device(device) if device is not None else next(model.parameters()).device
+    digest = hashlib.sha256()
+    for name, tensor in sorted(model.state_dict().items()):
+        digest.update(name.encode())
+        digest.update(str(tuple(tensor.shape)).encode())
+        digest.update(tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+    digest.update(f'{torch.__version__}|{device.type}|{COMPILE_VERSION}'.encode())
+    return digest.hexdigest()
+
+
+def artifact_paths(key: str, root=DEFAULT_ROOT) -> dict:
+    return {part: Path(root) / f'{key}.{part}.pt' for part in PARTS}
+
+
+# -------------------- graphs --------------------
+
+class _Backbone(nn.Module):
+    def __init__(self, hmr):
+        super(_Backbone, self).__init__()
+        self.hmr = hmr
+
+    def forward(self, x):
+        return self.hmr.feature_extractor(x)
+
+
+class _Encoder(nn.Module):
+    # TemporalEncoder.forward with the lengths always given, scriptable
+    def __init__(self, encoder):
+        super(_Encoder, self).__init__()
+        self.gru = encoder.gru
+        self.add_linear = encoder.linear is not None
+        self.linear = encoder.linear if self.add_linear else nn.Identity()
+        self.use_residual = encoder.use_residual and \
+            (self.add_linear or encoder.gru.hidden_size * (2 if encoder.gru.bidirectional else 1) == 2048)
+
+    def forward(self, x, hidden, lengths):
+        n, t, f = x.shape
+        x = x.permute(1, 0, 2) # NTF -> TNF
+        packed = nn.utils.rnn.pack_padded_sequence(x, lengths, enforce_sorted=False)
+        y, hidden = self.gru(packed, hidden)
+        y, _ = nn.utils.rnn.pad_packed_sequence(y, total_length=t)
+        if self.add_linear:
+            y = F.relu(y)
+            y = self.linear(y.reshape(-1, y.size(-1)))
+            y = y.reshape(t, n, f)
+        if self.use_residual:
+            y = y + x
+        return y.permute(1, 0, 2), hidden # TNF -> NTF
+
+
+class _RegressorHead(nn.Module):
+    # the iterative part of Regressor.forward, from the mean params
+    def __init__(self, regressor, n_iter=3):
+        super(_RegressorHead, self).__init__()
+        self.regressor = regressor
+        self.n_iter = n_iter
+
+    def forward(self, x):
+        r = self.regressor
+        batch_size = x.shape[0]
+        pred_pose = r.init_pose.expand(batch_size, -1)
+        pred_shape = r.init_shape.expand(batch_size, -1)
+        pred_cam = r.init_cam.expand(batch_size, -1)
+        for i in range(self.n_iter):
+            xc = torch.cat([x, pred_pose, pred_shape, pred_cam], 1)
+            xc = r.fc2(r.fc1(xc))
+            pred_pose = r.decpose(xc) + pred_pose
+            pred_shape = r.decshape(xc) + pred_shape
+            pred_cam = r.deccam(xc) + pred_cam
+        return pred_pose, pred_shape, pred_cam
+
+
+# -------------------- compiled parts --------------------
+# drop-in replacements of model.hmr / model.encoder / model.regressor for
+# what the inference code calls, anything else goes to the eager module
+
+class CompiledHMR(nn.Module):
+    def __init__(self, graph, eager):
+        super(CompiledHMR, self).__init__()
+        self.graph = graph
+        self.eager = eager
+
+    def feature_extractor(self, x):
+        return self.graph(x)
+
+    def forward(self, *args, **kwargs):
+        return self.eager(*args, **kwargs)
+
+
+class CompiledEncoder(nn.Module):
+    def __init__(self, graph, eager):
+        super(CompiledEncoder, self).__init__()
+        self.graph = graph
+        self.eager = eager
+
+    def forward(self, x, hidden=None, return_hidden=False, lengths=None):
+        n, t = x.shape[:2]
+        if lengths is None:
+            lengths = torch.full((n,), t, dtype=torch.int64)
+        lengths = torch.as_tensor(lengths, dtype=torch.int64).cpu()
+        if hidden is None:
+            gru = self.eager.gru
+            hidden = x.new_zeros(gru.num_layers * (2 if gru.bidirectional else 1), n, gru.hidden_size)
+        y, hidden = self.graph(x, hidden, lengths)
+        if return_hidden:
+            return y, hidden
+        return y
+
+
+class CompiledRegressor(nn.Module):
+    def __init__(self, graph, eager, n_iter=3):
+        super(CompiledRegressor, self).__init__()
+        self.graph = graph
+        self.eager = eager
+        self.n_iter = n_iter
+
+    def forward(self, x, init_pose=None, init_shape=None, init_cam=None, n_iter=3, J_regressor=None,
+                return_verts=True):
+        if init_pose is not None or init_shape is not None or init_cam is not None or n_iter != self.n_iter:
+            # the graph only starts from the mean params
+            return self.eager(x, init_pose=init_pose, init_shape=init_shape, init_cam=init_cam,
+                              n_iter=n_iter, J_regressor=J_regressor, return_verts=return_verts)
+        pred_pose, pred_shape, pred_cam = self.graph(x)
+        return self.eager.smpl_output(pred_pose, pred_shape, pred_cam, J_regressor=J_regressor,
+                                      return_verts=return_verts)
+
+
+# -------------------- export / load --------------------
+
+def _example_inputs(model, device, batch_size=4, seqlen=8):
+    gru = model.encoder.gru
+    generator = torch.Generator().manual_seed(0)
+    images = torch.randn(batch_size * seqlen, 3, 224, 224, generator=generator).to(device)
+    features = torch.randn(batch_size, seqlen, gru.input_size, generator=generator).to(device)
+    hidden = torch.zeros(gru.num_layers * (2 if gru.bidirectional else 1), batch_size, gru.hidden_size,
+                         device=device)
+    lengths = torch.linspace(seqlen, 1, batch_size).round().long()
+    return {
+        'backbone': (images,),
+        'encoder': (features, hidden, lengths),
+        'regressor': (torch.randn(batch_size * seqlen, 2048, generator=generator).to(device),),
+    }
+
+
+def _build_graph(part, model, inputs):
+    if part == 'backbone':
+        graph = torch.jit.trace(_Backbone(model.hmr).eval(), inputs)
+    elif part == 'encoder':
+        graph = torch.jit.script(_Encoder(model.encoder).eval())
+    else:
+        graph = torch.jit.trace(_RegressorHead(model.regressor).eval(), inputs)
+    return torch.jit.freeze(graph.eval())
+
+
+def _eager_output(part, model, inputs):
+    if part == 'backbone':
+        return (model.hmr.feature_extractor(*inputs),)
+    if part == 'encoder':
+        features, hidden, lengths = inputs
+        return model.encoder(features, hidden=hidden, return_hidden=True, lengths=lengths)
+    return _RegressorHead(model.regressor).eval()(*inputs)
+
+
+def check_parity(part, model, graph, inputs) -> float:
+    """
+    Largest absolute difference between the outputs of `graph` and of the
+    eager `part` of `model` on `inputs`. Raises ValueError when they are
+    not close.
+    """
+    with torch.no_grad():
+        expected = _eager_output(part, model, inputs)
+        actual = graph(*inputs)
+    actual = actual if isinstance(actual, tuple) else (actual,)
+    max_diff = 0.
+    for a, e in zip(actual, expected):
+        max_diff = max(max_diff, float((a - e).abs().max()))
+        if not torch.allclose(a, e, rtol=PARITY_RTOL, atol=PARITY_ATOL):
+            raise ValueError(f'compiled {part} differs from eager by up to {max_diff:.2e}')
+    return max_diff
+
+
+def _load_graph(path, device):
+    graph = torch.jit.load(str(path), map_location=device)
+    # in place, and the optimized graph can not be saved again
+    return torch.jit.optimize_for_inference(graph)
+
+
+def export_vibe(model, root=DEFAULT_ROOT, key=None, parts=PARTS) -> dict:
+    """
+    Compiles the `parts` of an eval-mode VIBE_Demo, checks them (as
+    `compile_vibe` will run them) against the eager model and saves them
+    under `root`.
+
+    :return: dict part -> path of the artifact
+    """
+    device = next(model.parameters()).device
+    key = key or artifact_key(model, device)
+    paths = artifact_paths(key, root)
+    Path(root).mkdir(parents=True, exist_ok=True)
+
+    examples = _example_inputs(model, device)
+    saved = {}
+    with torch.no_grad(), _quiet_jit():
+        for part in parts:
+            graph = _build_graph(part, model, examples[part])
+            # write next to the artifact and rename, loaders never see a
+            # partial file
+            tmp_path = paths[part].with_name(f'.{paths[part].name}.tmp')
+            torch.jit.save(graph, str(tmp_path))
+            try:
+                check_parity(part, model, _load_graph(tmp_path, device), examples[part])
+            except Exception:
+                tmp_path.unlink()
+                raise
+            os.replace(tmp_path, paths[part])
+            saved[part] = paths[part]
+    return saved
+
+
+def compile_vibe(model, root=DEFAULT_ROOT, export=False, parts=PARTS) -> list:
+    """
+    Replaces `model.hmr`, `model.encoder` and `model.regressor` of an
+    eval-mode VIBE_Demo by their compiled graphs saved under `root` for
+    its weights, torch version and device, exporting them first with
+    `export`. A part without a usable graph stays eager.
+
+    :return: names of the compiled parts
+    """
+    device = next(model.parameters()).device
+    key = artifact_key(model, device)
+    paths = artifact_paths(key, root)
+
+    for part in parts:
+        if export and not paths[part].is_file():
+            try:
+                export_vibe(model, root, key=key, parts=[part])
+            except Exception as exc:
+                print(f'[compiled_vibe] cannot export {part}, it stays eager: {exc}')
+
+    wrappers = {'backbone': ('hmr', CompiledHMR),
+                'encoder': ('encoder', CompiledEncoder),
+                'regressor': ('regressor', CompiledRegressor)}
+    compiled = []
+    for part in parts:
+        if not paths[part].is_file():
+            continue
+        name, wrapper = wrappers[part]
+        try:
+            with _quiet_jit():
+                graph = _load_graph(paths[part], device)
+        except Exception as exc:
+            print(f'[compiled_vibe] cannot load {paths[part]}, {part} stays eager: {exc}')
+            continue
+        setattr(model, name, wrapper(graph, getattr(model, name)))
+        compiled.append(part)
+    return compiled
+
+
+def main(args):
+    from VIBE import load_vibe_model
+
+    device = torch.device(args.device)
+    model = load_vibe_model(device, use_3dpw=args.use_3dpw)
+    for part, path in export_vibe(model, args.root).items():
+        print(f'[compiled_vibe] saved {part} to {path}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--device', type=str, default='cpu',
+                        help='device the graphs are exported for (they only load on it)')
+
+    parser.add_argument('--root', type=str, default=str(DEFAULT_ROOT),
+                        help='folder of the compiled artifacts')
+
+    parser.add_argument('--use_3dpw', action='store_true',
+                        help='export the VIBE weights finetuned on 3DPW')
+
+    main(parser.parse_args())
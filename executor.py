@@ -0,0 +1,188 @@
+# executor.py
+# --------------------------------------------------------------
+# Stage-pipelined job executor
+# --------------------------------------------------------------
+# A job goes through decode -> track -> VIBE -> measure. Each stage
+# has a bounded input queue and its own worker threads, so several
+# jobs overlap (job B decoding while job A is in the VIBE forward)
+# while every stage keeps its own concurrency limit. A full queue
+# blocks the stage feeding it, up to `submit`, which gives
+# backpressure instead of unbounded memory.
+# --------------------------------------------------------------
+
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+from VIBE import make_vibe_args, decode_stage, track_stage, regress_stage, output_stage
+from main import PIPELINE_VIBE_OPTIONS, measure_vibe_data
+from instrumentation import Profiler
+
+_STOP = object()
+
+
+class _Task():
+    def __init__(self, payload):
+        self.payload = payload
+        self.future = Future()
+        self.stage_times = {}
+
+
+class StageExecutor():
+    """
+    Runs payloads through a fixed sequence of stages.
+
+    :param stages: list of (name, fn, workers); `fn(payload)` returns the
+                   payload handed to the next stage, the last one's return
+                   value is the result of the job
+    :param queue_size: capacity of the queue in front of every stage
+
+    `submit` returns a `concurrent.futures.Future`; it carries the wall
+    time spent in each stage as `future.stage_times`. An exception in a
+    stage fails that job only.
+    """
+
+    def __init__(self, stages, queue_size: int = 2):
+        self.stage_names = [name for name, _, _ in stages]
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+        self._threads = []
+        self._closed = False
+
+        for index, (name, fn, workers) in enumerate(stages):
+            for worker in range(workers):
+                thread = threading.Thread(target=self._work,
+                                          args=(index, name, fn),
+                                          name=f'{name}-{worker}',
+                                          daemon=True)
+                thread.start()
+                self._threads.append((index, thread))
+
+    def _work(self, index, name, fn):
+        in_queue = self._queues[index]
+        out_queue = self._queues[index + 1] if index + 1 < len(self._queues) else None
+
+        while True:
+            task = in_queue.get()
+            if task is _STOP:
+                break
+
+            if index == 0 and not task.future.set_running_or_notify_cancel():
+                continue
+
+            start = time.perf_counter()
+            try:
+                task.payload = fn(task.payload)
+            except (Exception, SystemExit) as exc:
+                task.stage_times[name] = time.perf_counter() - start
+                task.future.set_exception(exc)
+                continue
+            task.stage_times[name] = time.perf_counter() - start
+
+            if out_queue is None:
+                task.future.set_result(task.payload)
+            else:
+                # blocks while the next stage is saturated
+                out_queue.put(task)
+
+    def submit(self, payload, timeout: float = None) -> Future:
+        """
+        Queues a job. Blocks while the first stage queue is full (raises
+        `queue.Full` after `timeout` seconds when given).
+        """
+        if self._closed:
+            raise RuntimeError('Executor is shut down')
+        task = _Task(payload)
+        task.future.stage_times = task.stage_times
+        self._queues[0].put(task, timeout=timeout)
+        return task.future
+
+    def queue_sizes(self) -> dict:
+        """
+        Number of jobs waiting in front of every stage.
+        """
+        return {name: q.qsize() for name, q in zip(self.stage_names, self._queues)}
+
+    def shutdown(self, wait: bool = True):
+        """
+        Lets the queued jobs finish, then stops the workers stage by stage.
+        """
+        self._closed = True
+        for index in range(len(self._queues)):
+            stage_threads = [thread for i, thread in self._threads if i == index]
+            for _ in stage_threads:
+                self._queues[index].put(_STOP)
+            if wait:
+                for thread in stage_threads:
+                    thread.join()
+
+
+def build_job_executor(models,
+                       decode_workers: int = 2,
+                       track_workers: int = 1,
+                       vibe_workers: int = 1,
+                       measure_workers: int = 2,
+                       queue_size: int = 2) -> StageExecutor:
+    """
+    Executor running the measurement pipeline of `run_full_pipeline` with
+    the models of a loaded `ModelRegistry`.
+
+    A job is a dict with "video_path" and optionally "output_folder",
+    "save_pkl", "save_ply", "num_measure_frames", "workspace" (a
+    `JobWorkspace`, whose quota is checked after VIBE) and "profiler" (an
+    `instrumentation.Profiler`, one is created otherwise). Its result is
+    the dict returned by `run_full_pipeline`, with the time spent in each
+    stage under "timings", the finer spans under "profile" and the frames
+    decoded of the video under "video".
+    """
+
+    def decode(job):
+        workspace = job.get('workspace')
+        output_folder = job.get('output_folder')
+        if output_folder is None:
+            output_folder = str(workspace.subdir('output')) if workspace is not None else 'output'
+        job['output_folder'] = output_folder
+
+        job['args'] = make_vibe_args(job['video_path'], output_folder,
+                                     no_pkl=not job.get('save_pkl', False),
+                                     **PIPELINE_VIBE_OPTIONS)
+        if job.get('profiler') is None:
+            job['profiler'] = Profiler()
+        job['state'] = decode_stage(job['args'], models=models, profiler=job['profiler'])
+        return job
+
+    def track(job):
+        track_stage(job['args'], job['state'], models=models)
+        return job
+
+    def vibe(job):
+        regress_stage(job['args'], job['state'], models=models)
+        job['vibe_data'] = output_stage(job['args'], job['state'], models=models)
+        state = job.pop('state')
+        # what was decoded of the upload, at most max_duration seconds
+        num_frames, fps = int(state['num_frames']), float(state['fps'])
+        job['video'] = {'num_frames': num_frames, 'fps': fps,
+                        'duration_s': num_frames / fps if fps else None,
+                        'max_duration_s': job['args'].max_duration or None}
+        if job.get('workspace') is not None:
+            job['workspace'].check_quota()
+        return job
+
+    def measure(job):
+        if not job['vibe_data']:
+            return {"status": "error", "message": "Processing failed. VIBE returned no data."}
+        result = measure_vibe_data(job['vibe_data'], job['output_folder'],
+                                   models=models,
+                                   save_ply=job.get('save_ply', False),
+                                   num_measure_frames=job.get('num_measure_frames', 1),
+                                   workspace=job.get('workspace'),
+                                   profiler=job['profiler'])
+        result['video'] = job['video']
+        return result
+
+    return StageExecutor([
+        ('decode', decode, decode_workers),
+        ('track', track, track_workers),
+        ('vibe', vibe, vibe_workers),
+        ('measure', measure, measure_workers),
+    ], queue_size=queue_size)
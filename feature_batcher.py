@@ -0,0 +1,98 @@
+# feature_batcher.py
+# --------------------------------------------------------------
+# Cross-job micro-batching of the VIBE backbone
+# --------------------------------------------------------------
+# Short clips give small batches and the ResNet50 feature extractor
+# runs far more efficiently on large ones. Jobs in the VIBE stage hand
+# their cropped frames to the batcher, which waits a few milliseconds
+# for other jobs, runs one feature_extractor call on all of them and
+# returns each job its own slice. The temporal encoder and regressor
+# still run per job.
+# --------------------------------------------------------------
+
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+import torch
+
+
+class FeatureBatcher():
+    """
+    Batches `feature_extractor` calls across threads.
+
+    :param feature_extractor: callable mapping (N,C,H,W) images to (N,F)
+                              features, e.g. `VIBE_Demo.hmr.feature_extractor`
+    :param max_batch_size: most images in one call; a single request larger
+                           than this runs on its own
+    :param max_wait: seconds the first request of a batch waits for others
+    """
+
+    def __init__(self, feature_extractor, max_batch_size: int = 256, max_wait: float = 0.01):
+        self.feature_extractor = feature_extractor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self.stats = {'batches': 0, 'requests': 0, 'images': 0}
+
+        self._queue = queue.Queue()
+        self._pending = None
+        self._thread = threading.Thread(target=self._loop, name='feature-batcher', daemon=True)
+        self._thread.start()
+
+    def extract(self, images: torch.Tensor) -> torch.Tensor:
+        """
+        Features of (N,C,H,W) images, computed together with the images
+        of concurrent callers. Blocks until they are ready.
+        """
+        future = Future()
+        self._queue.put((images, future))
+        return future.result()
+
+    def _next_request(self, timeout=None):
+        if self._pending is not None:
+            request, self._pending = self._pending, None
+            return request
+        return self._queue.get(timeout=timeout)
+
+    def _gather(self):
+        requests = [self._next_request()]
+        num_images = len(requests[0][0])
+        deadline = time.perf_counter() + self.max_wait
+
+        while num_images < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                request = self._next_request(timeout=remaining)
+            except queue.Empty:
+                break
+            if num_images + len(request[0]) > self.max_batch_size:
+                # starts the next batch
+                self._pending = request
+                break
+            requests.append(request)
+            num_images += len(request[0])
+
+        return requests
+
+    def _loop(self):
+        while True:
+            requests = self._gather()
+            sizes = [len(images) for images, _ in requests]
+            try:
+                with torch.no_grad():
+                    images = torch.cat([images for images, _ in requests], dim=0)
+                    features = self.feature_extractor(images)
+                for (_, future), feature in zip(requests, torch.split(features, sizes, dim=0)):
+                    future.set_result(feature)
+            except Exception as exc:
+                for _, future in requests:
+                    if not future.done():
+                        future.set_exception(exc)
+
+            self.stats['batches'] += 1
+            self.stats['requests'] += len(requests)
+            self.stats['images'] += sum(sizes)
@@ -2,32 +2,93 @@
 # --------------------------------------------------------------
 # RunPod Serverless handler
 # --------------------------------------------------------------
-# Input  : {"video": <base64-encoded video bytes> }   (or multipart/form-data)
-# Output : { "status": "success", "measurements": { … } }
+# Input  : {"video": <base64-encoded video bytes>,       (or multipart/form-data)
+#           "num_measure_frames": <int >= 1 or null for every frame, optional, default 1> }
+#          or, to measure known bodies without video,
+#          {"type": "shape", "betas": [[…10 floats], …],
+#           "gender": "NEUTRAL" | "MALE" | "FEMALE" | [one per shape],
+#           "model_type": "smpl" | "smplx" }
+#          {"type": "vertices", "vertices": [[x, y, z], …] or [[[x, y, z], …], …] }
+#          → { "status": "success", "measurements": [ { … } per body ], "timings": { … } }
+# Output : { "status": "success", "measurements": { … }, "timings": { … },
+#            "profile": { <stage>: { "count", "wall_s", "cpu_s", "frames", "peak_rss_mb" } },
+#            "video": { "num_frames", "fps", "duration_s", "max_duration_s" },
+#            "cache": { "hit": null | "vibe" | "result", "stats": { … } } }
+#          (+ "spread": { … } when more than one frame is measured)
 #          or { "status": "error",   "message": "..."}
+# Only the first MAX_VIDEO_SECONDS (default 10, 0 for no limit) of a
+# video are decoded and measured, "video" gives what was used of it.
 # --------------------------------------------------------------
 
 import os
 import json
+import time
 import base64
-import tempfile
+import asyncio
 import runpod
 from pathlib import Path
 
 # ---- Your pipeline ------------------------------------------------
-from main import run_full_pipeline   # <-- the function you already built
+from executor import build_job_executor   # runs `run_full_pipeline` stage by stage
+from main import (PIPELINE_VIBE_OPTIONS, measure_vibe_data, measure_shapes, measure_vertex_batch,
+                  check_num_measure_frames)
+from model_registry import get_registry
+from instrumentation import Profiler, append_jsonl
+from result_cache import ResultCache, content_key
+from workspace import JobWorkspace, cleanup_stale_workspaces
 
-# RunPod gives us a temporary directory that is writable
+# RunPod gives us a temporary directory that is writable; every job gets
+# its own workspace under it, removed when the job ends
 TMP_DIR = Path("/tmp/runpod")
 TMP_DIR.mkdir(parents=True, exist_ok=True)
+WORKSPACE_QUOTA_BYTES = int(os.environ.get("WORKSPACE_QUOTA_MB", "2048")) * 1024 ** 2
+cleanup_stale_workspaces(TMP_DIR)
+
+# Load every model once when the worker starts; jobs reuse them. Jobs in
+# the VIBE stage at the same time share backbone batches of up to
+# FEATURE_BATCH_SIZE frames (0 disables it). VIBE runs the TorchScript
+# graphs exported by compiled_vibe.py when they match its weights
+# (COMPILED_VIBE=0 disables them, EXPORT_COMPILED_VIBE=1 exports missing
+# ones at start)
+MODELS = get_registry(
+    feature_batch_size=int(os.environ.get("FEATURE_BATCH_SIZE", "256")),
+    feature_batch_wait=float(os.environ.get("FEATURE_BATCH_WAIT_MS", "10")) / 1000,
+    compiled=os.environ.get("COMPILED_VIBE", "1") != "0",
+    export_compiled=os.environ.get("EXPORT_COMPILED_VIBE", "0") == "1",
+)
+
+# Jobs overlap across the pipeline stages (decode / track / VIBE / measure),
+# each stage with its own number of workers
+MAX_CONCURRENT_JOBS = int(os.environ.get("MAX_CONCURRENT_JOBS", "4"))
+EXECUTOR = build_job_executor(
+    MODELS,
+    decode_workers=int(os.environ.get("DECODE_WORKERS", "2")),
+    track_workers=1,
+    vibe_workers=int(os.environ.get("VIBE_WORKERS", "2")),
+    measure_workers=int(os.environ.get("MEASURE_WORKERS", "2")),
+    queue_size=int(os.environ.get("STAGE_QUEUE_SIZE", "2")),
+)
+
+# Resubmitted videos are answered from a local cache keyed by the video
+# bytes and the pipeline parameters (RESULT_CACHE_MB=0 disables it). The
+# VIBE results are cached too, so the same video measured with other
+# parameters skips VIBE.
+RESULT_CACHE_BYTES = int(os.environ.get("RESULT_CACHE_MB", "1024")) * 1024 ** 2
+CACHE_VIBE_RESULTS = os.environ.get("CACHE_VIBE_RESULTS", "1") == "1"
+CACHE = ResultCache(os.environ.get("RESULT_CACHE_DIR", "/tmp/result_cache"),
+                    max_bytes=RESULT_CACHE_BYTES) if RESULT_CACHE_BYTES > 0 else None
+
+# Per-stage profiles are returned with every video job; when
+# PROFILE_LOG is set they are also appended to that JSONL file.
+PROFILE_LOG = os.environ.get("PROFILE_LOG")
 
 # ------------------------------------------------------------------
-def _save_uploaded_video(payload: dict) -> Path:
+def _read_uploaded_video(payload: dict) -> bytes:
     """
     Accepts either:
       • {"video": "<base64 string>"}   (RunPod JSON payload)
       • multipart/form-data with key "video"
-    Returns a Path to the saved video file.
+    Returns the video bytes.
     """
     video_bytes = None
 
@@ -49,34 +110,133 @@ def _save_uploaded_video(payload: dict) -> Path:
     if video_bytes is None:
         raise ValueError("No video data found in request")
 
-    # Save to a unique temp file
-    tmp_file = TMP_DIR / f"input_{os.urandom(4).hex()}.mp4"
-    tmp_file.write_bytes(video_bytes)
-    return tmp_file
+    return video_bytes
+
+
+# ------------------------------------------------------------------
+def _measure_bodies(payload: dict) -> list:
+    """
+    Measurements of the bodies of a "shape" or "vertices" job.
+    """
+    if payload["type"] == "shape":
+        if "betas" not in payload:
+            raise ValueError("No betas found in request")
+        return measure_shapes(payload["betas"],
+                              model_type=payload.get("model_type", "smpl"),
+                              gender=payload.get("gender", "NEUTRAL"))
+    if payload["type"] == "vertices":
+        if "vertices" not in payload:
+            raise ValueError("No vertices found in request")
+        return measure_vertex_batch(payload["vertices"])
+    raise ValueError(f"Unknown job type {payload['type']}")
+
+
+# ------------------------------------------------------------------
+async def _cache_store(put, key: str, value) -> None:
+    """
+    Stores `value` in CACHE. The job succeeded already, a failing write
+    (full disk, unpicklable result) is only logged.
+    """
+    try:
+        await asyncio.to_thread(put, key, value)
+    except Exception as exc:
+        print(f"[result_cache] could not store {key}: {exc!r}")
 
 
 # ------------------------------------------------------------------
-def handler(job: dict) -> dict:
+async def handler(job: dict) -> dict:
     """
-    RunPod entry-point.
+    RunPod entry-point. Up to MAX_CONCURRENT_JOBS jobs run at once,
+    pipelined through the stages of EXECUTOR.
     `job` contains:
         • job["id"]          – request id
         • job["input"]       – user payload
     """
     try:
         input_payload = job.get("input", {})
-        video_path = _save_uploaded_video(input_payload)
 
-        # --------------------------------------------------------------
-        # Run your full pipeline (video → VIBE → PLY → measurements)
-        # --------------------------------------------------------------
-        result = run_full_pipeline(str(video_path))
+        if input_payload.get("type", "video") != "video":
+            # known bodies: measured directly, VIBE is not involved
+            job_start = time.perf_counter()
+            measurements = await asyncio.to_thread(_measure_bodies, input_payload)
+            return {
+                "status": "success",
+                "measurements": measurements,
+                "timings": MODELS.report({"measure": time.perf_counter() - job_start})
+            }
 
-        # Clean-up the temp video ASAP
-        try:
-            video_path.unlink()
-        except Exception:
-            pass
+        video_bytes = _read_uploaded_video(input_payload)
+        num_measure_frames = input_payload.get("num_measure_frames", 1)
+        check_num_measure_frames(num_measure_frames)
+
+        job_start = time.perf_counter()
+        vibe_params = {"vibe": PIPELINE_VIBE_OPTIONS}
+        vibe_key = content_key(video_bytes, vibe_params)
+        result_key = content_key(video_bytes, dict(vibe_params, num_measure_frames=num_measure_frames))
+
+        if CACHE is not None:
+            cached = await asyncio.to_thread(CACHE.get_result, result_key)
+            if cached is not None:
+                cached["timings"] = MODELS.report({"total": time.perf_counter() - job_start})
+                cached["cache"] = {"hit": "result", "stats": CACHE.report()}
+                return cached
+
+        cache_hit = None
+        profiler = Profiler()
+
+        # The workspace (uploaded video and every pipeline output) is
+        # removed when the job ends, even if it fails
+        with JobWorkspace(TMP_DIR, job_id=job.get("id"),
+                          quota_bytes=WORKSPACE_QUOTA_BYTES) as workspace:
+
+            cached_vibe = None
+            if CACHE is not None and CACHE_VIBE_RESULTS:
+                cached_vibe = await asyncio.to_thread(CACHE.get_vibe, vibe_key)
+
+            if cached_vibe is not None:
+                # ------------------------------------------------------
+                # Same video seen before: only measure
+                # ------------------------------------------------------
+                cache_hit = "vibe"
+                result = await asyncio.to_thread(
+                    measure_vibe_data, cached_vibe["vibe_data"], str(workspace.subdir("output")),
+                    models=MODELS, num_measure_frames=num_measure_frames, workspace=workspace,
+                    profiler=profiler,
+                )
+                result["video"] = cached_vibe["video"]
+                job_times = dict(result.get("timings", {}))
+            else:
+                # ------------------------------------------------------
+                # Run your full pipeline (video → VIBE → measurements)
+                # ------------------------------------------------------
+                video_path = workspace.write_bytes("input.mp4", video_bytes)
+                job_payload = {
+                    "video_path": str(video_path),
+                    "num_measure_frames": num_measure_frames,
+                    "workspace": workspace,
+                    "save_pkl": False,
+                    "profiler": profiler,
+                }
+                # submitting blocks while the first stage is saturated
+                future = await asyncio.to_thread(EXECUTOR.submit, job_payload)
+                result = await asyncio.wrap_future(future)
+                job_times = dict(result.get("timings", {}))
+                job_times.update(future.stage_times)
+
+                if CACHE is not None and CACHE_VIBE_RESULTS and job_payload.get("vibe_data"):
+                    await _cache_store(CACHE.put_vibe, vibe_key, {"vibe_data": job_payload["vibe_data"],
+                                                                  "video": job_payload["video"]})
+
+            job_times["total"] = time.perf_counter() - job_start
+
+        if PROFILE_LOG:
+            await asyncio.to_thread(append_jsonl, PROFILE_LOG, {
+                "job_id": job.get("id"),
+                "status": result.get("status"),
+                "cache_hit": cache_hit,
+                "timings": job_times,
+                "profile": profiler.report(),
+            })
 
         # --------------------------------------------------------------
         # Normalise the output
@@ -84,10 +244,22 @@ def handler(job: dict) -> dict:
         if result.get("status") == "success":
             # `run_full_pipeline` returns JSON string inside `data`
             measurements = json.loads(result["data"])
-            return {
+            response = {
                 "status": "success",
-                "measurements": measurements
+                "measurements": measurements,
             }
+            if "spread" in result:
+                response["spread"] = result["spread"]
+            if "video" in result:
+                response["video"] = result["video"]
+            if CACHE is not None:
+                await _cache_store(CACHE.put_result, result_key, response)
+
+            response["timings"] = MODELS.report(job_times)
+            response["profile"] = profiler.report()
+            if CACHE is not None:
+                response["cache"] = {"hit": cache_hit, "stats": CACHE.report()}
+            return response
         else:
             return {
                 "status": "error",
@@ -101,7 +273,14 @@ def handler(job: dict) -> dict:
             "message": str(exc)
         }
 
-runpod.serverless.start({'handler': handler})
+def concurrency_modifier(current_concurrency: int) -> int:
+    return MAX_CONCURRENT_JOBS
+
+
+runpod.serverless.start({
+    'handler': handler,
+    'concurrency_modifier': concurrency_modifier,
+})
 
 # ------------------------------------------------------------------
 # For local testing (optional)
@@ -112,11 +291,11 @@ runpod.serverless.start({'handler': handler})
 #         print("Usage: python handler.py <path-to-video.mp4>")
 #         sys.exit(1)
 
-#     result = handler({
+#     result = asyncio.run(handler({
 #         "input": {
 #             "video": base64.b64encode(Path(sys.argv[1]).read_bytes()).decode()
 #         }
-#     })
+#     }))
 
 #     if result["status"] == "success":
 #         print("SUCCESS! Measurements:")
@@ -0,0 +1,129 @@
+# instrumentation.py
+# --------------------------------------------------------------
+# Per-stage timing and resource spans of one job
+# --------------------------------------------------------------
+# Code wraps each stage in `profiler.span(name, frames=...)`. Spans
+# with the same name (e.g. one per VIBE chunk) add up, so the report
+# gives, per stage: how often it ran, wall and CPU seconds, frames
+# processed and the peak RSS of the process when it ended.
+# --------------------------------------------------------------
+
+import json
+import time
+import resource
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Profiler():
+    """
+    Collects the spans of one job. Thread-safe, so the stages of a job
+    may run on different threads.
+
+    CPU time is the CPU time of the whole process (it includes torch's
+    worker threads, and other jobs when several run at once); peak RSS
+    is the high-water mark of the process.
+    """
+
+    def __init__(self):
+        self._spans = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, name: str, wall: float, cpu: float = 0.0, frames: int = None):
+        """
+        Adds one run of `name` measured elsewhere.
+        """
+        with self._lock:
+            span = self._spans.setdefault(name, {'count': 0, 'wall_s': 0.0, 'cpu_s': 0.0,
+                                                 'frames': 0, 'peak_rss_mb': 0.0})
+            span['count'] += 1
+            span['wall_s'] += wall
+            span['cpu_s'] += cpu
+            if frames is not None:
+                span['frames'] += int(frames)
+            span['peak_rss_mb'] = max(span['peak_rss_mb'], _peak_rss_mb())
+
+    @contextmanager
+    def span(self, name: str, frames: int = None):
+        """
+        Times the block as a `name` span. The block may set the frame
+        count once it is known through the yielded dict:
+
+            with profiler.span('decode') as span:
+                frames = decode()
+                span['frames'] = len(frames)
+        """
+        info = {'frames': frames}
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield info
+        finally:
+            self.add(name, time.perf_counter() - wall, time.process_time() - cpu, info['frames'])
+
+    def iterate(self, name: str, iterable, frames=len):
+        """
+        Yields the items of `iterable`, timing the production of each one
+        (e.g. a DataLoader building its batches) as a `name` span.
+        `frames(item)` gives the frame count of an item.
+        """
+        iterator = iter(iterable)
+        while True:
+            wall = time.perf_counter()
+            cpu = time.process_time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.add(name, time.perf_counter() - wall, time.process_time() - cpu,
+                     frames(item) if frames is not None else None)
+            yield item
+
+    def report(self) -> dict:
+        """
+        {span name: {count, wall_s, cpu_s, frames, peak_rss_mb}}, with
+        the frames left out of spans that counted none.
+        """
+        with self._lock:
+            report = OrderedDict()
+            for name, span in self._spans.items():
+                span = dict(span)
+                span['wall_s'] = round(span['wall_s'], 4)
+                span['cpu_s'] = round(span['cpu_s'], 4)
+                span['peak_rss_mb'] = round(span['peak_rss_mb'], 1)
+                if not span['frames']:
+                    del span['frames']
+                report[name] = span
+            return report
+
+
+class NullProfiler(Profiler):
+    """
+    Profiler that records nothing, for code run without instrumentation.
+    """
+
+    def add(self, name, wall, cpu=0.0, frames=None):
+        pass
+
+
+def get_profiler(profiler=None) -> Profiler:
+    return profiler if profiler is not None else NullProfiler()
+
+
+_LOG_LOCK = threading.Lock()
+
+
+def append_jsonl(path: str, record: dict):
+    """
+    Appends `record` as one JSON line to the file at `path`.
+    """
+    line = json.dumps(record, default=str)
+    with _LOG_LOCK:
+        with open(path, 'a') as f:
+            f.write(line + '\n')
@@ -19,8 +19,10 @@ import cv2
 import torch
 
 import random
+import threading
 import numpy as np
 import torchvision.transforms as transforms
+from concurrent.futures import ThreadPoolExecutor
 from skimage.util.shape import view_as_windows
 
 def get_image(filename):
@@ -241,6 +243,66 @@ def get_single_image_crop_demo(image, bbox, kp_2d, scale=1.2, crop_size=224):
 
     return crop_image, raw_image, kp_2d
 
+def gen_trans_from_bboxes(bboxes, scale=1.2, crop_size=224):
+    '''
+    Vectorized gen_trans_from_patch_cv for unrotated, unflipped crops
+    :param bboxes (ndarray, shape=(N,4)): bbox coordinates (c_x, c_y, w, h)
+    :return: affine transforms (ndarray, shape=(N,2,3)) from image to crop coordinates
+    '''
+    bboxes = np.asarray(bboxes, dtype=np.float64)
+    s_x = crop_size / (bboxes[:, 2] * scale)
+    s_y = crop_size / (bboxes[:, 3] * scale)
+
+    trans = np.zeros((len(bboxes), 2, 3))
+    trans[:, 0, 0] = s_x
+    trans[:, 1, 1] = s_y
+    trans[:, 0, 2] = crop_size * 0.5 - bboxes[:, 0] * s_x
+    trans[:, 1, 2] = crop_size * 0.5 - bboxes[:, 1] * s_y
+    return trans
+
+_CROP_POOL = None
+_CROP_POOL_LOCK = threading.Lock()
+
+def _get_crop_pool():
+    # cv2.warpAffine releases the GIL, one pool is shared by all callers
+    global _CROP_POOL
+    with _CROP_POOL_LOCK:
+        if _CROP_POOL is None:
+            _CROP_POOL = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1),
+                                            thread_name_prefix='crop')
+        return _CROP_POOL
+
+def get_image_crops_demo(images, bboxes, kp_2d=None, scale=1.2, crop_size=224):
+    '''
+    Batched get_single_image_crop_demo: crops and normalizes many frames at once
+    :param images (sequence of ndarray, HxWx3, RGB): frames, read in place (not copied)
+    :param bboxes (ndarray, shape=(N,4)): bbox of each frame (c_x, c_y, w, h)
+    :param kp_2d (ndarray, shape=(N,J,3)): optional keypoints, not modified
+    :return: normalized crops (Tensor, Nx3xcrop_sizexcrop_size), raw crops
+             (ndarray, Nxcrop_sizexcrop_sizex3, uint8) and the keypoints in
+             crop coordinates (None without kp_2d)
+    '''
+    trans = gen_trans_from_bboxes(bboxes, scale=scale, crop_size=crop_size)
+    raw_images = np.empty((len(trans), crop_size, crop_size, 3), dtype=np.uint8)
+
+    def warp(idx):
+        raw_images[idx] = cv2.warpAffine(images[idx], trans[idx], (crop_size, crop_size),
+                                         flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
+
+    list(_get_crop_pool().map(warp, range(len(trans))))
+
+    # same as ToTensor + Normalize of get_default_transform, for the whole batch
+    mean = torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1)
+    std = torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1)
+    crop_images = torch.from_numpy(raw_images).permute(0, 3, 1, 2).float().div_(255.)
+    crop_images = crop_images.sub_(mean).div_(std).contiguous()
+
+    if kp_2d is not None:
+        kp_2d = np.array(kp_2d, copy=True)
+        kp_2d[..., :2] = np.einsum('nij,nkj->nki', trans[:, :, :2], kp_2d[..., :2]) + trans[:, None, :, 2]
+
+    return crop_images, raw_images, kp_2d
+
 def read_image(filename):
     image = cv2.cvtColor(cv2.imread(filename), cv2.COLOR_BGR2RGB)
     image = cv2.resize(image, (224,224))
@@ -15,6 +15,7 @@
 # Contact: ps-license@tuebingen.mpg.de
 
 import numpy as np
+from functools import lru_cache
 
 def keypoint_hflip(kp, img_width):
     # Flip a keypoint horizontally around the y-axis
@@ -25,23 +26,48 @@ def keypoint_hflip(kp, img_width):
         kp[:, :, 0] = (img_width - 1.) - kp[:, :, 0]
     return kp
 
-def convert_kps(joints2d, src, dst):
-    src_names = eval(f'get_{src}_joint_names')()
-    dst_names = eval(f'get_{dst}_joint_names')()
-
-    out_joints2d = np.zeros((joints2d.shape[0], len(dst_names), 3))
-
-    for idx, jn in enumerate(dst_names):
-        if jn in src_names:
-            out_joints2d[:, idx] = joints2d[:, src_names.index(jn)]
+def _joint_names(format):
+    return globals()[f'get_{format}_joint_names']()
+
+@lru_cache(maxsize=None)
+def get_kps_conversion(src, dst):
+    """
+    Index arrays converting keypoints from the `src` to the `dst` format,
+    such that `out[:, dst_idxs] = joints[:, src_idxs]`. Computed once per
+    pair of formats.
+
+    :return: dst_idxs, src_idxs (read-only int arrays), number of dst joints
+    """
+    src_names = _joint_names(src)
+    dst_names = _joint_names(dst)
+
+    # first occurrence, as list.index
+    src_index = {}
+    for idx, jn in enumerate(src_names):
+        src_index.setdefault(jn, idx)
+
+    dst_idxs = np.array([idx for idx, jn in enumerate(dst_names) if jn in src_index], dtype=np.int64)
+    src_idxs = np.array([src_index[jn] for jn in dst_names if jn in src_index], dtype=np.int64)
+    dst_idxs.flags.writeable = False
+    src_idxs.flags.writeable = False
+    return dst_idxs, src_idxs, len(dst_names)
+
+def convert_kps(joints2d, src, dst, dtype=np.float64):
+    """
+    Converts (N, J, 3) keypoints from the `src` to the `dst` format, joints
+    missing in `src` are zeros. Works on a whole db array at once, so
+    datasets convert their keypoints when loading the db (with a smaller
+    `dtype`, the array is kept for the whole run).
+    """
+    dst_idxs, src_idxs, num_joints = get_kps_conversion(src, dst)
+
+    out_joints2d = np.zeros((joints2d.shape[0], num_joints, 3), dtype=dtype)
+    out_joints2d[:, dst_idxs] = joints2d[:, src_idxs]
 
     return out_joints2d
 
 def get_perm_idxs(src, dst):
-    src_names = eval(f'get_{src}_joint_names')()
-    dst_names = eval(f'get_{dst}_joint_names')()
-    idxs = [src_names.index(h) for h in dst_names if h in src_names]
-    return idxs
+    return get_kps_conversion(src, dst)[1].tolist()
 
 def get_mpii3d_test_joint_names():
     return [
@@ -59,15 +59,19 @@ class Dataset2D(Dataset):
         else:
             raise ValueError(f'{db_file} do not exists')
 
+        # convert the keypoints once here instead of in every item
+        if self.dataset_name != 'posetrack':
+            db['joints2D'] = convert_kps(db['joints2D'], src=self.dataset_name, dst='spin',
+                                         dtype=np.float32)
+
         print(f'Loaded {self.dataset_name} dataset from {db_file}')
         return db
 
     def get_single_item(self, index):
         start_index, end_index = self.vid_indices[index]
 
-        kp_2d = self.db['joints2D'][start_index:end_index+1]
-        if self.dataset_name != 'posetrack':
-            kp_2d = convert_kps(kp_2d, src=self.dataset_name, dst='spin')
+        # copy, the keypoints are transformed in place below
+        kp_2d = self.db['joints2D'][start_index:end_index+1].copy()
         kp_2d_tensor = np.ones((self.seqlen, 49, 3), dtype=np.float16)
 
         bbox  = self.db['bbox'][start_index:end_index+1]
@@ -55,6 +55,14 @@ class Dataset3D(Dataset):
         else:
             raise ValueError(f'{db_file} do not exists')
 
+        # convert the keypoints once here instead of in every item
+        if self.dataset_name == '3dpw':
+            db['joints2D'] = convert_kps(db['joints2D'], src='common', dst='spin',
+                                         dtype=np.float32)
+        elif self.dataset_name in ('mpii3d', 'h36m') and self.set != 'train':
+            db['joints3D'] = convert_kps(db['joints3D'], src='spin', dst='common',
+                                         dtype=np.float32)
+
         print(f'Loaded {self.dataset_name} dataset from {db_file}')
         return db
 
@@ -63,21 +71,9 @@ class Dataset3D(Dataset):
 
         is_train = self.set == 'train'
 
-        if self.dataset_name == '3dpw':
-            kp_2d = convert_kps(self.db['joints2D'][start_index:end_index + 1], src='common', dst='spin')
-            kp_3d = self.db['joints3D'][start_index:end_index + 1]
-        elif self.dataset_name == 'mpii3d':
-            kp_2d = self.db['joints2D'][start_index:end_index + 1]
-            if is_train:
-                kp_3d = self.db['joints3D'][start_index:end_index + 1]
-            else:
-                kp_3d = convert_kps(self.db['joints3D'][start_index:end_index + 1], src='spin', dst='common')
-        elif self.dataset_name == 'h36m':
-            kp_2d = self.db['joints2D'][start_index:end_index + 1]
-            if is_train:
-                kp_3d = self.db['joints3D'][start_index:end_index + 1]
-            else:
-                kp_3d = convert_kps(self.db['joints3D'][start_index:end_index + 1], src='spin', dst='common')
+        # copy, the keypoints are transformed in place below
+        kp_2d = self.db['joints2D'][start_index:end_index + 1].copy()
+        kp_3d = self.db['joints3D'][start_index:end_index + 1]
 
         kp_2d_tensor = np.ones((self.seqlen, 49, 3), dtype=np.float16)
         nj = 14 if not is_train else 49
@@ -22,18 +22,23 @@ from torch.utils.data import Dataset
 from torchvision.transforms.functional import to_tensor
 
 from lib.utils.smooth_bbox import get_all_bbox_params
-from lib.data_utils.img_utils import get_single_image_crop_demo
+from lib.data_utils.img_utils import get_single_image_crop_demo, get_image_crops_demo
 
 
 class Inference(Dataset):
-    def __init__(self, image_folder, frames, bboxes=None, joints2d=None, scale=1.0, crop_size=224):
-        self.image_file_names = [
-            osp.join(image_folder, x)
-            for x in os.listdir(image_folder)
-            if x.endswith('.png') or x.endswith('.jpg')
-        ]
-        self.image_file_names = sorted(self.image_file_names)
-        self.image_file_names = np.array(self.image_file_names)[frames]
+    def __init__(self, image_folder, frames, bboxes=None, joints2d=None, scale=1.0, crop_size=224, images=None):
+        # `images` is an optional in-memory video (NxHxWx3, RGB) indexed by `frames`;
+        # when it is given, `image_folder` is not read
+        self.images = images
+        self.image_file_names = None
+        if images is None:
+            self.image_file_names = [
+                osp.join(image_folder, x)
+                for x in os.listdir(image_folder)
+                if x.endswith('.png') or x.endswith('.jpg')
+            ]
+            self.image_file_names = sorted(self.image_file_names)
+            self.image_file_names = np.array(self.image_file_names)[frames]
         self.bboxes = bboxes
         self.joints2d = joints2d
         self.scale = scale
@@ -48,15 +53,19 @@ class Inference(Dataset):
             bboxes[:, 2:] = 150. / bboxes[:, 2:]
             self.bboxes = np.stack([bboxes[:, 0], bboxes[:, 1], bboxes[:, 2], bboxes[:, 2]]).T
 
-            self.image_file_names = self.image_file_names[time_pt1:time_pt2]
+            if self.image_file_names is not None:
+                self.image_file_names = self.image_file_names[time_pt1:time_pt2]
             self.joints2d = joints2d[time_pt1:time_pt2]
             self.frames = frames[time_pt1:time_pt2]
 
     def __len__(self):
-        return len(self.image_file_names)
+        return len(self.frames)
 
     def __getitem__(self, idx):
-        img = cv2.cvtColor(cv2.imread(self.image_file_names[idx]), cv2.COLOR_BGR2RGB)
+        if self.images is not None:
+            img = self.images[self.frames[idx]]
+        else:
+            img = cv2.cvtColor(cv2.imread(self.image_file_names[idx]), cv2.COLOR_BGR2RGB)
 
         bbox = self.bboxes[idx]
 
@@ -73,6 +82,46 @@ class Inference(Dataset):
         else:
             return norm_img
 
+    def get_images(self, idx):
+        # full frames of the items `idx` (views of the in-memory video)
+        if self.images is not None:
+            return [self.images[frame] for frame in self.frames[idx]]
+        return [cv2.cvtColor(cv2.imread(f), cv2.COLOR_BGR2RGB) for f in self.image_file_names[idx]]
+
+
+def iter_tracklet_batches(datasets, batch_size):
+    """
+    Crops several tracklets (Inference datasets of one video, built with the
+    same scale and crop size) together: the n-th batch holds frames
+    n * batch_size ... (n + 1) * batch_size - 1 of every tracklet still that
+    long, cropped and normalized in one get_image_crops_demo call.
+
+    Yields (crops, kp_2d, lengths): the crops (Tensor, Mx3xHxW) of the
+    tracklets one after the other, their keypoints (ndarray, MxJx3, None
+    without keypoints) and the number of frames of each tracklet in the
+    batch (0 once it has ended).
+    """
+    num_frames = max((len(dataset) for dataset in datasets), default=0)
+    for start in range(0, num_frames, batch_size):
+        images, bboxes, kp_2d, lengths = [], [], [], []
+        for dataset in datasets:
+            idx = np.arange(start, min(start + batch_size, len(dataset)))
+            lengths.append(len(idx))
+            if len(idx) == 0:
+                continue
+            images += dataset.get_images(idx)
+            bboxes.append(dataset.bboxes[idx])
+            if dataset.has_keypoints:
+                kp_2d.append(dataset.joints2d[idx])
+
+        norm_imgs, _, kp_2d = get_image_crops_demo(
+            images,
+            np.concatenate(bboxes),
+            kp_2d=np.concatenate(kp_2d) if kp_2d else None,
+            scale=datasets[0].scale,
+            crop_size=datasets[0].crop_size)
+        yield norm_imgs, kp_2d, lengths
+
 
 class ImageFolder(Dataset):
     def __init__(self, image_folder):
@@ -89,3 +138,23 @@ class ImageFolder(Dataset):
     def __getitem__(self, idx):
         img = cv2.cvtColor(cv2.imread(self.image_file_names[idx]), cv2.COLOR_BGR2RGB)
         return to_tensor(img)
+
+
+class FrameBuffer(Dataset):
+    """
+    In-memory counterpart of ImageFolder over a decoded video (NxHxWx3, RGB).
+    With `size` (width, height) the frames are downscaled to it, e.g. for
+    a detector that works at a lower resolution than the video.
+    """
+    def __init__(self, frames, size=None):
+        self.frames = frames
+        self.size = size
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, idx):
+        img = self.frames[idx]
+        if self.size is not None and tuple(self.size) != (img.shape[1], img.shape[0]):
+            img = cv2.resize(img, tuple(self.size), interpolation=cv2.INTER_AREA)
+        return to_tensor(img)
@@ -6,7 +6,7 @@ import numpy as np
 import os.path as osp
 from smplx import SMPL as _SMPL
 from smplx.utils import ModelOutput, SMPLOutput
-from smplx.lbs import vertices2joints
+from smplx.lbs import vertices2joints, blend_shapes, batch_rodrigues, batch_rigid_transform
 
 from lib.core.config import VIBE_DATA_DIR
 
@@ -68,6 +68,24 @@ class SMPL(_SMPL):
         self.register_buffer('J_regressor_extra', torch.tensor(J_regressor_extra, dtype=torch.float32))
         self.joint_map = torch.tensor(joints, dtype=torch.long)
 
+        # The only vertices the joints depend on are the ones picked by the
+        # vertex joint selector and the ones J_regressor_extra regresses from.
+        # Skinning just those gives every joint without posing the whole mesh.
+        selected_ids = self.vertex_joint_selector.extra_joints_idxs.cpu().numpy()
+        joint_vertex_ids = np.union1d(np.nonzero(J_regressor_extra)[1], selected_ids)
+        num_pose_basis = self.posedirs.shape[0]
+        posedirs = self.posedirs.reshape(num_pose_basis, -1, 3)[:, joint_vertex_ids]
+        self.register_buffer('joint_vertex_ids', torch.tensor(joint_vertex_ids, dtype=torch.long),
+                             persistent=False)
+        self.register_buffer('joint_vertex_selector',
+                             torch.tensor(np.searchsorted(joint_vertex_ids, selected_ids), dtype=torch.long),
+                             persistent=False)
+        self.register_buffer('joint_vertex_posedirs', posedirs.reshape(num_pose_basis, -1).clone(),
+                             persistent=False)
+        self.register_buffer('joint_vertex_J_regressor_extra',
+                             torch.tensor(J_regressor_extra[:, joint_vertex_ids], dtype=torch.float32),
+                             persistent=False)
+
     def forward(self, *args, **kwargs):
         kwargs['get_skin'] = True
         smpl_output = super(SMPL, self).forward(*args, **kwargs)
@@ -82,6 +100,53 @@ class SMPL(_SMPL):
                             full_pose=smpl_output.full_pose)
         return output
 
+    def forward_joints(self, betas=None, body_pose=None, global_orient=None, pose2rot=True):
+        """
+        Returns the same joints as `forward(...).joints` while skinning only
+        the vertices the joints are computed from instead of all 6890.
+        """
+        betas = betas if betas is not None else self.betas
+        body_pose = body_pose if body_pose is not None else self.body_pose
+        global_orient = global_orient if global_orient is not None else self.global_orient
+
+        full_pose = torch.cat([global_orient, body_pose], dim=1)
+        batch_size = max(betas.shape[0], global_orient.shape[0], body_pose.shape[0])
+        if betas.shape[0] != batch_size:
+            betas = betas.expand(batch_size, -1)
+
+        dtype, device = betas.dtype, betas.device
+
+        # rest pose joints need the whole shaped template
+        v_shaped = self.v_template + blend_shapes(betas, self.shapedirs)
+        J = vertices2joints(self.J_regressor, v_shaped)
+
+        ident = torch.eye(3, dtype=dtype, device=device)
+        if pose2rot:
+            rot_mats = batch_rodrigues(full_pose.reshape(-1, 3)).view(batch_size, -1, 3, 3)
+        else:
+            rot_mats = full_pose.reshape(batch_size, -1, 3, 3)
+        pose_feature = (rot_mats[:, 1:, :, :] - ident).view(batch_size, -1)
+
+        # pose blend shapes and skinning of the joint vertices only
+        pose_offsets = torch.matmul(pose_feature, self.joint_vertex_posedirs).view(batch_size, -1, 3)
+        v_posed = v_shaped[:, self.joint_vertex_ids] + pose_offsets
+
+        J_transformed, A = batch_rigid_transform(rot_mats, J, self.parents, dtype=dtype)
+
+        num_joints = self.J_regressor.shape[0]
+        W = self.lbs_weights[self.joint_vertex_ids].unsqueeze(dim=0).expand(batch_size, -1, -1)
+        T = torch.matmul(W, A.view(batch_size, num_joints, 16)).view(batch_size, -1, 4, 4)
+        homogen_coord = torch.ones([batch_size, v_posed.shape[1], 1], dtype=dtype, device=device)
+        v_posed_homo = torch.cat([v_posed, homogen_coord], dim=2)
+        vertices = torch.matmul(T, v_posed_homo.unsqueeze(dim=-1))[:, :, :3, 0]
+
+        selected_joints = torch.index_select(vertices, 1, self.joint_vertex_selector)
+        extra_joints = vertices2joints(self.joint_vertex_J_regressor_extra, vertices)
+        joints = torch.cat([J_transformed, selected_joints, extra_joints], dim=1)
+        if hasattr(self, 'transl'):
+            joints = joints + self.transl.unsqueeze(dim=1)
+        return joints[:, self.joint_map, :]
+
 
 def get_smpl_faces():
     smpl = SMPL(SMPL_MODEL_DIR, batch_size=1, create_transl=False)
@@ -239,7 +239,10 @@ class Regressor(nn.Module):
 
 
 
-    def forward(self, x, init_pose=None, init_shape=None, init_cam=None, n_iter=3, J_regressor=None):
+    def forward(self, x, init_pose=None, init_shape=None, init_cam=None, n_iter=3, J_regressor=None,
+                return_verts=True):
+        # return_verts=False skips posing the full SMPL mesh: 'verts' is None
+        # and only theta, joints and their projections are computed
         batch_size = x.shape[0]
 
         if init_pose is None:
@@ -262,17 +265,33 @@ class Regressor(nn.Module):
             pred_shape = self.decshape(xc) + pred_shape
             pred_cam = self.deccam(xc) + pred_cam
 
+        return self.smpl_output(pred_pose, pred_shape, pred_cam, J_regressor=J_regressor,
+                                return_verts=return_verts)
+
+    def smpl_output(self, pred_pose, pred_shape, pred_cam, J_regressor=None, return_verts=True):
+        # SMPL body, joints and their projections of the regressed params
+        batch_size = pred_pose.shape[0]
+
         pred_rotmat = rot6d_to_rotmat(pred_pose).view(batch_size, 24, 3, 3)
 
-        pred_output = self.smpl(
-            betas=pred_shape,
-            body_pose=pred_rotmat[:, 1:],
-            global_orient=pred_rotmat[:, 0].unsqueeze(1),
-            pose2rot=False
-        )
+        if return_verts or J_regressor is not None:
+            pred_output = self.smpl(
+                betas=pred_shape,
+                body_pose=pred_rotmat[:, 1:],
+                global_orient=pred_rotmat[:, 0].unsqueeze(1),
+                pose2rot=False
+            )
 
-        pred_vertices = pred_output.vertices
-        pred_joints = pred_output.joints
+            pred_vertices = pred_output.vertices
+            pred_joints = pred_output.joints
+        else:
+            pred_vertices = None
+            pred_joints = self.smpl.forward_joints(
+                betas=pred_shape,
+                body_pose=pred_rotmat[:, 1:],
+                global_orient=pred_rotmat[:, 0].unsqueeze(1),
+                pose2rot=False
+            )
 
         if J_regressor is not None:
             J_regressor_batch = J_regressor[None, :].expand(pred_vertices.shape[0], -1, -1).to(pred_vertices.device)
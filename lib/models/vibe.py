@@ -49,10 +49,21 @@ class TemporalEncoder(nn.Module):
             self.linear = nn.Linear(hidden_size, 2048)
         self.use_residual = use_residual
 
-    def forward(self, x):
+    def forward(self, x, hidden=None, return_hidden=False, lengths=None):
+        # hidden: GRU state to start from (zeros when None). Feeding a sequence
+        # chunk by chunk with the returned state gives the same output as
+        # feeding it at once.
+        # lengths: valid length of each sequence of a padded batch; the GRU
+        # skips the padding (its output there is meaningless) and the
+        # returned state is the one after the last valid frame
         n,t,f = x.shape
         x = x.permute(1,0,2) # NTF -> TNF
-        y, _ = self.gru(x)
+        if lengths is not None:
+            packed = nn.utils.rnn.pack_padded_sequence(x, torch.as_tensor(lengths).cpu(), enforce_sorted=False)
+            y, hidden = self.gru(packed, hidden)
+            y, _ = nn.utils.rnn.pad_packed_sequence(y, total_length=t)
+        else:
+            y, hidden = self.gru(x, hidden)
         if self.linear:
             y = F.relu(y)
             y = self.linear(y.view(-1, y.size(-1)))
@@ -60,6 +71,8 @@ class TemporalEncoder(nn.Module):
         if self.use_residual and y.shape[-1] == 2048:
             y = y + x
         y = y.permute(1,0,2) # TNF -> NTF
+        if return_hidden:
+            return y, hidden
         return y
 
 
@@ -143,37 +156,60 @@ class VIBE_Demo(nn.Module):
             use_residual=use_residual,
         )
 
-        self.hmr = hmr()
-        checkpoint = torch.load(pretrained)
-        self.hmr.load_state_dict(checkpoint['model'], strict=False)
+        # the SPIN checkpoint overwrites the whole backbone, so the ImageNet
+        # weights are only needed when it is missing
+        checkpoint = None
+        if pretrained and os.path.isfile(pretrained):
+            checkpoint = torch.load(pretrained)
+
+        self.hmr = hmr(pretrained=checkpoint is None)
+        if checkpoint is not None:
+            self.hmr.load_state_dict(checkpoint['model'], strict=False)
 
         # regressor can predict cam, pose and shape params in an iterative way
         self.regressor = Regressor()
 
-        if pretrained and os.path.isfile(pretrained):
-            pretrained_dict = torch.load(pretrained)['model']
-
-            self.regressor.load_state_dict(pretrained_dict, strict=False)
+        if checkpoint is not None:
+            self.regressor.load_state_dict(checkpoint['model'], strict=False)
             print(f'=> loaded pretrained model from \'{pretrained}\'')
 
 
-    def forward(self, input, J_regressor=None):
-        # input size NTF
+    def extract_features(self, input):
+        # input size NTCHW -> NTF
         batch_size, seqlen, nc, h, w = input.shape
-
         feature = self.hmr.feature_extractor(input.reshape(-1, nc, h, w))
+        return feature.reshape(batch_size, seqlen, -1)
 
-        feature = feature.reshape(batch_size, seqlen, -1)
-        feature = self.encoder(feature)
+    def regress(self, feature, J_regressor=None, return_verts=True):
+        # feature size NTF
+        batch_size, seqlen = feature.shape[:2]
         feature = feature.reshape(-1, feature.size(-1))
 
-        smpl_output = self.regressor(feature, J_regressor=J_regressor)
+        smpl_output = self.regressor(feature, J_regressor=J_regressor, return_verts=return_verts)
 
         for s in smpl_output:
             s['theta'] = s['theta'].reshape(batch_size, seqlen, -1)
-            s['verts'] = s['verts'].reshape(batch_size, seqlen, -1, 3)
+            if s['verts'] is not None:
+                s['verts'] = s['verts'].reshape(batch_size, seqlen, -1, 3)
             s['kp_2d'] = s['kp_2d'].reshape(batch_size, seqlen, -1, 2)
             s['kp_3d'] = s['kp_3d'].reshape(batch_size, seqlen, -1, 3)
             s['rotmat'] = s['rotmat'].reshape(batch_size, seqlen, -1, 3, 3)
 
         return smpl_output
+
+    def forward(self, input, J_regressor=None, return_verts=True, hidden=None, return_hidden=False,
+                lengths=None):
+        # input size NTCHW
+        # return_verts=False leaves 'verts' as None (params and joints only)
+        # hidden/return_hidden carry the temporal encoder state between
+        # consecutive chunks of one sequence, see TemporalEncoder.forward
+        # lengths: valid length of each sequence when sequences of different
+        # lengths are padded into one batch, outputs past it are meaningless
+        feature = self.extract_features(input)
+        feature, hidden = self.encoder(feature, hidden=hidden, return_hidden=True, lengths=lengths)
+
+        smpl_output = self.regress(feature, J_regressor=J_regressor, return_verts=return_verts)
+
+        if return_hidden:
+            return smpl_output, hidden
+        return smpl_output
@@ -29,6 +29,7 @@ from lib.utils.smooth_bbox import get_smooth_bbox_params, get_all_bbox_params
 from lib.data_utils.img_utils import get_single_image_crop_demo
 from lib.utils.geometry import rotation_matrix_to_angle_axis
 from lib.smplify.temporal_smplify import TemporalSMPLify
+from lib.models.smpl import SMPL, SMPL_MODEL_DIR
 
 
 def preprocess_video(video, joints2d, bboxes, frames, scale=1.0, crop_size=224):
@@ -204,6 +205,149 @@ def video_to_images(vid_file, img_folder=None, return_info=False):
         return img_folder
 
 
+def get_video_info(vid_file):
+    """
+    Reads the frame size and frame rate of the first video stream with ffprobe.
+    The size is the displayed one, i.e. with the rotation metadata of phone
+    videos applied, which is what ffmpeg decodes to.
+
+    :param vid_file (str): input video path
+    :return: dict with `width`, `height`, `fps` and `num_frames` (None when
+             the container does not store it)
+    """
+    command = ['ffprobe',
+               '-v', 'error',
+               '-select_streams', 'v:0',
+               '-show_entries', 'stream=width,height,avg_frame_rate,r_frame_rate,nb_frames'
+                                ':stream_tags=rotate:stream_side_data=rotation',
+               '-of', 'json',
+               vid_file]
+    stream = json.loads(subprocess.check_output(command))['streams'][0]
+
+    width, height = int(stream['width']), int(stream['height'])
+
+    rotation = stream.get('tags', {}).get('rotate', 0)
+    for side_data in stream.get('side_data_list', []):
+        rotation = side_data.get('rotation', rotation)
+    if abs(int(float(rotation))) % 180 == 90:
+        width, height = height, width
+
+    fps = 0.
+    for key in ('avg_frame_rate', 'r_frame_rate'):
+        num, _, den = stream.get(key, '0/0').partition('/')
+        if float(num or 0) > 0 and float(den or 1) > 0:
+            fps = float(num) / float(den or 1)
+            break
+
+    num_frames = stream.get('nb_frames')
+    num_frames = int(num_frames) if num_frames and num_frames.isdigit() else None
+
+    return {'width': width, 'height': height, 'fps': fps, 'num_frames': num_frames}
+
+
+def scaled_size(width, height, max_size):
+    """
+    Size of a `width` x `height` image downscaled, keeping its aspect
+    ratio, so that its longer side is at most `max_size` (even sides, as
+    video encoders and ffmpeg filters prefer). Unchanged when it fits.
+    """
+    if not max_size or max(width, height) <= max_size:
+        return width, height
+    scale = max_size / max(width, height)
+    return max(int(round(width * scale / 2)) * 2, 2), max(int(round(height * scale / 2)) * 2, 2)
+
+
+def video_to_frames(vid_file, return_info=False, max_frames=None, target_fps=None, max_duration=None,
+                    max_size=None, info=None):
+    """
+    Decodes a video straight into memory by piping ffmpeg rawvideo output
+    into a numpy array, without writing any image to disk.
+
+    The frame budget is applied by ffmpeg, so frames that are dropped are
+    never copied out of the decoder: `max_duration` stops reading the input
+    after that many seconds, `target_fps` drops frames of videos shot at a
+    higher frame rate (e.g. 60 fps phone videos) and `max_frames` caps the
+    number of frames kept. `max_size` downscales the frames while decoding
+    so that their longer side is at most that many pixels, e.g. to what
+    the 224x224 person crops need instead of the native 4K.
+
+    :param vid_file (str): input video path
+    :param return_info (bool): also return the number of frames, the frame
+                               shape and the frame rate of the decoded frames
+    :param max_frames (int): keep at most this many frames
+    :param target_fps (float): subsample to this frame rate when the video is faster
+    :param max_duration (float): only decode the first `max_duration` seconds
+    :param max_size (int): longest side of the decoded frames
+    :param info (dict): `get_video_info(vid_file)`, when already known
+    :return: frames (ndarray, NxHxWx3, uint8, RGB)
+    """
+    if info is None:
+        info = get_video_info(vid_file)
+    width, height = scaled_size(info['width'], info['height'], max_size)
+    fps = info['fps']
+
+    command = ['ffmpeg']
+    if max_duration:
+        # as an input option ffmpeg stops reading the file there
+        command += ['-t', str(max_duration)]
+    command += ['-i', vid_file]
+    filters = []
+    if target_fps and fps > target_fps:
+        filters.append(f'fps={target_fps}')
+        fps = float(target_fps)
+    if (width, height) != (info['width'], info['height']):
+        filters.append(f'scale={width}:{height}:flags=area')
+    if filters:
+        command += ['-vf', ','.join(filters)]
+    if max_frames:
+        command += ['-frames:v', str(int(max_frames))]
+    command += ['-f', 'rawvideo',
+                '-pix_fmt', 'rgb24',
+                '-v', 'error',
+                'pipe:1']
+    print(f'Running \"{" ".join(command)}\"')
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE)
+
+    # read every frame straight into its slot of the buffer; the buffer only
+    # grows when the container under-reports its number of frames
+    capacity = info['num_frames'] or 256
+    if fps and info['fps'] and fps < info['fps']:
+        capacity = int(capacity * fps / info['fps']) + 1
+    if max_duration and fps:
+        capacity = min(capacity, int(max_duration * fps) + 1)
+    if max_frames:
+        capacity = min(capacity, int(max_frames))
+    frames = np.empty((capacity, height, width, 3), dtype=np.uint8)
+    num_frames = 0
+    while True:
+        if num_frames == capacity:
+            capacity = int(capacity * 1.5) + 1
+            grown = np.empty((capacity, height, width, 3), dtype=np.uint8)
+            grown[:num_frames] = frames[:num_frames]
+            frames = grown
+
+        n_bytes = proc.stdout.readinto(memoryview(frames[num_frames]).cast('B'))
+        if not n_bytes:
+            break
+        if n_bytes != frames[num_frames].nbytes:
+            proc.kill()
+            raise ValueError(f'Could not decode \"{vid_file}\" into {width}x{height} frames')
+        num_frames += 1
+
+    proc.stdout.close()
+    if proc.wait() != 0 or num_frames == 0:
+        raise ValueError(f'ffmpeg failed to decode \"{vid_file}\"')
+
+    frames = frames[:num_frames]
+
+    print(f'Decoded {num_frames} frames of {width}x{height} at {fps:.2f} fps in memory')
+
+    if return_info:
+        return frames, num_frames, frames.shape[1:], fps
+    else:
+        return frames
+
+
 def download_url(url, outdir):
     print(f'Downloading files from {url}')
     cmd = ['wget', '-c', url, '-P', outdir]
@@ -275,6 +419,34 @@ def convert_crop_coords_to_orig_img(bbox, keypoints, crop_size):
     return keypoints
 
           
+def get_person_verts(person_data, frame_ids=None, smpl=None):
+    """
+    Returns the SMPL vertices of one person of the VIBE results.
+    Results computed in params-only mode store no vertices; they are then
+    generated from the pose and shape parameters of the requested frames only.
+
+    :param person_data (dict): VIBE results of one person
+    :param frame_ids (int or ndarray): positions in the tracklet, all frames when None
+    :param smpl (SMPL): body model to reuse, one is created when None
+    :return: vertices (ndarray, Fx6890x3), or 6890x3 for a single int frame id
+    """
+    single = np.isscalar(frame_ids)
+    idx = np.arange(len(person_data['pose'])) if frame_ids is None else np.atleast_1d(frame_ids)
+
+    if person_data.get('verts') is not None:
+        verts = person_data['verts'][idx]
+    else:
+        if smpl is None:
+            smpl = SMPL(SMPL_MODEL_DIR, create_transl=False)
+        pose = torch.from_numpy(person_data['pose'][idx]).float()
+        betas = torch.from_numpy(person_data['betas'][idx]).float()
+        with torch.no_grad():
+            output = smpl(betas=betas, body_pose=pose[:, 3:], global_orient=pose[:, :3])
+        verts = output.vertices.cpu().numpy()
+
+    return verts[0] if single else verts
+
+
 def prepare_rendering_results(vibe_results, nframes):
     frame_results = [{} for _ in range(nframes)]
     for person_id, person_data in vibe_results.items():
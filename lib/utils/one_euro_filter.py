@@ -1,4 +1,5 @@
 import math
+import numba
 import numpy as np
 
 
@@ -44,3 +45,47 @@ class OneEuroFilter:
         self.t_prev = t
 
         return x_hat
+
+
+@numba.njit(cache=True)
+def _filter_sequence(x, min_cutoff, beta, d_cutoff, t_e):
+    n_frames, n_dims = x.shape
+    x_hat = np.empty_like(x)
+    x_hat[0] = x[0]
+
+    r_d = 2 * math.pi * d_cutoff * t_e
+    a_d = r_d / (r_d + 1)
+
+    for d in range(n_dims):
+        x_prev = x[0, d]
+        dx_prev = 0.0
+        for i in range(1, n_frames):
+            dx = (x[i, d] - x_prev) / t_e
+            dx_hat = a_d * dx + (1 - a_d) * dx_prev
+
+            r = 2 * math.pi * (min_cutoff + beta * abs(dx_hat)) * t_e
+            a = r / (r + 1)
+            x_prev = a * x[i, d] + (1 - a) * x_prev
+            dx_prev = dx_hat
+            x_hat[i, d] = x_prev
+
+    return x_hat
+
+
+def one_euro_filter_sequence(x, min_cutoff=1.0, beta=0.0, d_cutoff=1.0, t_e=1.0):
+    """
+    Filters a whole sequence in one compiled pass.
+
+    Same output as stepping OneEuroFilter(t0=0, x0=x[0]) through x[1:]
+    with timestamps t_e, 2 * t_e, ..., i.e. `t_e` time units per frame.
+
+    :param x (ndarray, NxD...): signal, filtered along the first axis
+    :param t_e (float): time between two frames
+    :return: filtered signal with the shape and dtype of x
+    """
+    x = np.asarray(x)
+    if x.shape[0] == 0:
+        return x.copy()
+    flat = np.ascontiguousarray(x.reshape(x.shape[0], -1), dtype=np.float64)
+    x_hat = _filter_sequence(flat, float(min_cutoff), float(beta), float(d_cutoff), float(t_e))
+    return x_hat.reshape(x.shape).astype(x.dtype)
@@ -66,41 +66,70 @@ def get_all_bbox_params(kps, vis_thresh=2):
     Look for sequences in the middle with no predictions and linearly
     interpolate the bbox params for those
 
+    Same output as calling kp_to_bbox_param frame by frame, computed over
+    the whole sequence at once (interpolated values are computed exactly
+    as np.linspace does).
+
     Args:
-        kps (list): List of kps (Kx3) or None.
+        kps (list): List of kps (Kx3) or None, or a TxKx3 array.
         vis_thresh (float): Threshold for visibility.
 
     Returns:
         bbox_params, start_index (incl), end_index (excl)
     """
-    # keeps track of how many indices in a row with no prediction
-    num_to_interpolate = 0
-    start_index = -1
-    bbox_params = np.empty(shape=(0, 3), dtype=np.float32)
-
-    for i, kp in enumerate(kps):
-        bbox_param = kp_to_bbox_param(kp, vis_thresh=vis_thresh)
-        if bbox_param is None:
-            num_to_interpolate += 1
-            continue
-
-        if start_index == -1:
-            # Found the first index with a prediction!
-            start_index = i
-            num_to_interpolate = 0
-
-        if num_to_interpolate > 0:
-            # Linearly interpolate each param.
-            previous = bbox_params[-1]
-            # This will be 3x(n+2)
-            interpolated = np.array(
-                [np.linspace(prev, curr, num_to_interpolate + 2)
-                 for prev, curr in zip(previous, bbox_param)])
-            bbox_params = np.vstack((bbox_params, interpolated.T[1:-1]))
-            num_to_interpolate = 0
-        bbox_params = np.vstack((bbox_params, bbox_param))
-
-    return bbox_params, start_index, i - num_to_interpolate + 1
+    if isinstance(kps, np.ndarray):
+        present = np.ones(len(kps), dtype=bool)
+    else:
+        present = np.array([kp is not None for kp in kps], dtype=bool)
+        if present.any():
+            template = np.zeros_like(kps[np.argmax(present)])
+            kps = np.stack([kp if kp is not None else template for kp in kps])
+    if not present.any():
+        return np.empty(shape=(0, 3), dtype=np.float32), -1, 0
+
+    # kp_to_bbox_param of every frame
+    vis = (kps[:, :, 2] > vis_thresh) & present[:, None]
+    pts = kps[:, :, :2]
+    min_pt = np.where(vis[..., None], pts, np.inf).min(axis=1)
+    max_pt = np.where(vis[..., None], pts, -np.inf).max(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # per-row dot product as np.linalg.norm computes it (BLAS), so the
+        # heights are bit-identical to kp_to_bbox_param
+        diagonal = max_pt - min_pt
+        person_height = np.sqrt((diagonal[:, None, :] @ diagonal[:, :, None])[:, 0, 0])
+        valid = vis.any(axis=1) & (person_height >= 0.5)
+        center = (min_pt + max_pt) / 2.
+        scale = 150. / person_height
+    params = np.concatenate([center, scale[:, None]], axis=1)
+    params = params.astype(np.result_type(np.float32, params.dtype), copy=False)
+
+    valid_index = np.flatnonzero(valid)
+    if len(valid_index) == 0:
+        return np.empty(shape=(0, 3), dtype=np.float32), -1, 0
+    start_index, end_index = int(valid_index[0]), int(valid_index[-1]) + 1
+
+    # frames without a prediction: linear interpolation between the
+    # previous and the next valid frame, as np.linspace computes it
+    frames = np.arange(start_index, end_index)
+    next_pos = np.searchsorted(valid_index, frames)
+    is_valid = valid[frames]
+    prev_index = valid_index[np.where(is_valid, next_pos, next_pos - 1)]
+    next_index = valid_index[np.minimum(next_pos, len(valid_index) - 1)]
+
+    bbox_params = params[frames].copy()
+    gap = ~is_valid
+    if gap.any():
+        dtype = params.dtype
+        previous, current = params[prev_index[gap]], params[next_index[gap]]
+        div = (next_index[gap] - prev_index[gap]).astype(dtype)[:, None]
+        k = (frames[gap] - prev_index[gap]).astype(dtype)[:, None]
+        delta = current - previous
+        step = delta / div
+        with np.errstate(invalid='ignore', divide='ignore'):
+            interpolated = np.where(step == 0, k / div * delta, k * step) + previous
+        bbox_params[gap] = interpolated
+
+    return bbox_params, start_index, end_index
 
 
 def smooth_bbox_params(bbox_params, kernel_size=11, sigma=8):
@@ -16,53 +16,52 @@
 
 import torch
 import numpy as np
+from functools import lru_cache
 
 from lib.models.smpl import SMPL, SMPL_MODEL_DIR
-from lib.utils.one_euro_filter import OneEuroFilter
+from lib.utils.one_euro_filter import one_euro_filter_sequence
 
 
-def smooth_pose(pred_pose, pred_betas, min_cutoff=0.004, beta=0.7):
-    # min_cutoff: Decreasing the minimum cutoff frequency decreases slow speed jitter
-    # beta: Increasing the speed coefficient(beta) decreases speed lag.
+@lru_cache(maxsize=1)
+def get_smpl():
+    return SMPL(model_path=SMPL_MODEL_DIR, create_transl=False).eval()
 
-    one_euro_filter = OneEuroFilter(
-        np.zeros_like(pred_pose[0]),
-        pred_pose[0],
-        min_cutoff=min_cutoff,
-        beta=beta,
-    )
 
-    smpl = SMPL(model_path=SMPL_MODEL_DIR)
+def smooth_pose(pred_pose, pred_betas, min_cutoff=0.004, beta=0.7, return_verts=True,
+                smpl=None, batch_size=256, t_e=1.0):
+    # min_cutoff: Decreasing the minimum cutoff frequency decreases slow speed jitter
+    # beta: Increasing the speed coefficient(beta) decreases speed lag.
+    # return_verts: when False only joints are computed and None is returned for the vertices
+    # smpl: body model to reuse, a process wide SMPL model is used when None
+    # batch_size: number of frames per SMPL forward
+    # t_e: time between two frames, in frames of the 30 fps video min_cutoff
+    #      and beta are tuned for (2.0 for a video subsampled to 15 fps)
 
-    pred_pose_hat = np.zeros_like(pred_pose)
+    # the filter runs over the whole sequence at once, then the smoothed
+    # poses go through SMPL in batches instead of one frame at a time
+    pred_pose_hat = one_euro_filter_sequence(pred_pose, min_cutoff=min_cutoff, beta=beta, t_e=t_e)
 
-    # initialize
-    pred_pose_hat[0] = pred_pose[0]
+    if smpl is None:
+        smpl = get_smpl()
 
     pred_verts_hat = []
     pred_joints3d_hat = []
 
-    smpl_output = smpl(
-        betas=torch.from_numpy(pred_betas[0]).unsqueeze(0),
-        body_pose=torch.from_numpy(pred_pose[0, 1:]).unsqueeze(0),
-        global_orient=torch.from_numpy(pred_pose[0, 0:1]).unsqueeze(0),
-    )
-    pred_verts_hat.append(smpl_output.vertices.detach().cpu().numpy())
-    pred_joints3d_hat.append(smpl_output.joints.detach().cpu().numpy())
-
-    for idx, pose in enumerate(pred_pose[1:]):
-        idx += 1
-
-        t = np.ones_like(pose) * idx
-        pose = one_euro_filter(t, pose)
-        pred_pose_hat[idx] = pose
-
-        smpl_output = smpl(
-            betas=torch.from_numpy(pred_betas[idx]).unsqueeze(0),
-            body_pose=torch.from_numpy(pred_pose_hat[idx, 1:]).unsqueeze(0),
-            global_orient=torch.from_numpy(pred_pose_hat[idx, 0:1]).unsqueeze(0),
-        )
-        pred_verts_hat.append(smpl_output.vertices.detach().cpu().numpy())
-        pred_joints3d_hat.append(smpl_output.joints.detach().cpu().numpy())
+    with torch.no_grad():
+        for start in range(0, pred_pose_hat.shape[0], batch_size):
+            pose = torch.from_numpy(pred_pose_hat[start:start + batch_size]).float()
+            betas = torch.from_numpy(pred_betas[start:start + batch_size]).float()
+            kwargs = dict(
+                betas=betas,
+                body_pose=pose[:, 3:],
+                global_orient=pose[:, :3],
+            )
+            if return_verts:
+                smpl_output = smpl(**kwargs)
+                pred_verts_hat.append(smpl_output.vertices.cpu().numpy())
+                pred_joints3d_hat.append(smpl_output.joints.cpu().numpy())
+            else:
+                pred_joints3d_hat.append(smpl.forward_joints(**kwargs).cpu().numpy())
 
-    return np.vstack(pred_verts_hat), pred_pose_hat, np.vstack(pred_joints3d_hat)
\ No newline at end of file
+    pred_verts_hat = np.vstack(pred_verts_hat) if return_verts else None
+    return pred_verts_hat, pred_pose_hat, np.vstack(pred_joints3d_hat)
@@ -0,0 +1,102 @@
+import warnings
+import numpy as np
+
+# weights of the tracklet features in the subject score
+DEFAULT_WEIGHTS = {
+    'duration': 1.0,
+    'area': 1.0,
+    'centrality': 0.5,
+    'confidence': 0.5,
+}
+
+
+def tracklet_boxes(tracklet, vis_thresh=0.3):
+    """
+    Boxes (c_x, c_y, w, h) of a tracklet, from its bboxes (bbox tracking)
+    or from the visible keypoints of its joints2d (pose tracking).
+
+    :param tracklet (dict): one entry of the tracking results
+    :return: boxes (ndarray, Nx4), NaN where no keypoint is visible
+    """
+    if tracklet.get('bbox') is not None:
+        return np.asarray(tracklet['bbox'], dtype=np.float64)
+
+    joints2d = np.asarray(tracklet['joints2d'], dtype=np.float64)
+    visible = joints2d[..., 2] > vis_thresh
+    x = np.where(visible, joints2d[..., 0], np.nan)
+    y = np.where(visible, joints2d[..., 1], np.nan)
+    with warnings.catch_warnings():
+        # all-NaN frames give NaN boxes
+        warnings.simplefilter('ignore', RuntimeWarning)
+        x_min, x_max = np.nanmin(x, axis=1), np.nanmax(x, axis=1)
+        y_min, y_max = np.nanmin(y, axis=1), np.nanmax(y, axis=1)
+    return np.stack([(x_min + x_max) / 2, (y_min + y_max) / 2, x_max - x_min, y_max - y_min], axis=1)
+
+
+def tracklet_confidence(tracklet):
+    """
+    Mean detection score of a tracklet (its `scores`), or mean keypoint
+    confidence for pose tracking; 1 when the tracker gives neither.
+    """
+    if tracklet.get('scores') is not None and len(tracklet['scores']):
+        return float(np.mean(tracklet['scores']))
+    if tracklet.get('joints2d') is not None:
+        return float(np.clip(np.mean(np.asarray(tracklet['joints2d'])[..., 2]), 0, 1))
+    return 1.0
+
+
+def score_subjects(tracking_results, img_width, img_height, num_frames, weights=None):
+    """
+    Scores how likely every tracklet is the subject of the video: long,
+    large, centered and confidently detected tracklets score higher.
+
+    Every feature is in [0, 1]: the duration and the median box area
+    relative to the largest ones among the tracklets, the centrality as one
+    minus the mean distance of the box center to the image center (in half
+    image diagonals) and the mean detection confidence.
+
+    :param tracking_results (dict): person id -> tracklet
+    :param img_width (int): width of the frames the boxes refer to
+    :param img_height (int): height of the frames the boxes refer to
+    :param num_frames (int): number of frames of the video
+    :param weights (dict): weight of each feature, DEFAULT_WEIGHTS when None
+    :return: dict person id -> {'score', 'duration', 'area', 'centrality', 'confidence'}
+    """
+    weights = DEFAULT_WEIGHTS if weights is None else weights
+    half_diagonal = np.hypot(img_width, img_height) / 2
+
+    features = {}
+    for person_id, tracklet in tracking_results.items():
+        boxes = tracklet_boxes(tracklet)
+        valid = np.isfinite(boxes).all(axis=1)
+        boxes = boxes[valid] if valid.any() else np.zeros((1, 4))
+        offset = np.hypot(boxes[:, 0] - img_width / 2, boxes[:, 1] - img_height / 2)
+        features[person_id] = {
+            'duration': len(tracklet['frames']) / max(num_frames, 1),
+            'area': float(np.median(boxes[:, 2] * boxes[:, 3])),
+            'centrality': float(np.clip(1 - offset.mean() / half_diagonal, 0, 1)),
+            'confidence': tracklet_confidence(tracklet),
+        }
+
+    if features:
+        max_duration = max(f['duration'] for f in features.values()) or 1
+        max_area = max(f['area'] for f in features.values()) or 1
+        for f in features.values():
+            f['duration'] /= max_duration
+            f['area'] /= max_area
+            f['score'] = sum(weights.get(name, 0) * f[name] for name in DEFAULT_WEIGHTS)
+    return features
+
+
+def select_subjects(tracking_results, img_width, img_height, num_frames, top_k=None, weights=None):
+    """
+    Orders the tracklets by `score_subjects`, best first, keeping the
+    `top_k` best (all when None).
+
+    :return: tracking results (dict, same entries) and the scores
+    """
+    scores = score_subjects(tracking_results, img_width, img_height, num_frames, weights=weights)
+    ranked = sorted(tracking_results, key=lambda person_id: -scores[person_id]['score'])
+    if top_k is not None:
+        ranked = ranked[:top_k]
+    return {person_id: tracking_results[person_id] for person_id in ranked}, scores
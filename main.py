@@ -1,21 +1,25 @@
 import sys, os
+import time
 import torch
 import trimesh
 import numpy as np
 import smplx
 import joblib
 import json
-from measure import MeasureBody
+from measure import MeasureBody, get_body_model, shape_to_verts
 from measurement_definitions import STANDARD_LABELS
 from VIBE import run_vibe
+from instrumentation import Profiler, get_profiler
+from lib.utils.demo_utils import get_person_verts
 
-def measure_json(model_path):
+def measure_verts(verts_np: np.ndarray, measurer=None):
     """
-    Loads a .ply mesh, calculates body measurements, and returns a JSON string.
+    Calculates body measurements of a single SMPL/SMPL-X mesh given by its
+    vertices (N x 3) and returns a JSON string.
+    Pass `measurer` (e.g. `ModelRegistry.new_measurer()`) to reuse already
+    loaded body model data instead of building a new MeasureBody.
     """
-    print(f"\n--- 3. MEASURING BODY from: {model_path} ---")
-    mesh = trimesh.load(model_path, force='mesh')
-    verts_np = np.array(mesh.vertices, dtype=np.float32)
+    verts_np = np.asarray(verts_np, dtype=np.float32)
 
     n_verts = verts_np.shape[0]
     if n_verts == 6890:
@@ -25,7 +29,8 @@ def measure_json(model_path):
     else:
         raise ValueError(f'Unexpected vertex count {n_verts}.')
 
-    measurer = MeasureBody(model_type)
+    if measurer is None or measurer.num_points != n_verts:
+        measurer = MeasureBody(model_type)
     measurer.from_verts(verts=torch.from_numpy(verts_np))
 
     measurer.measure(measurer.all_possible_measurements)
@@ -60,21 +65,171 @@ def measure_json(model_path):
     # Return the JSON string for the API
     return json_str
 
-# <-- *** MODIFICATION 1 *** -->
-# Renamed from pkl2ply to results_to_ply
-# Now accepts the vibe_data dictionary and output_folder directly
-def results_to_ply(vibe_data: dict, output_folder: str):
+
+# measurements needed for the payload fields
+PAYLOAD_MEASUREMENTS = ["height",
+                        "chest circumference",
+                        "waist circumference",
+                        "torso back length",
+                        "arm left length",
+                        "arm right length"]
+
+
+def payload_fields(measurements: dict) -> dict:
     """
-    Converts a VIBE results dictionary to a .ply mesh.
-    Saves the .ply in the specified output_folder and returns the path.
+    Payload fields (see `measure_verts`) from batched measurements, each
+    an array with one value per body.
     """
-    print(f"\n--- 2. CONVERTING VIBE data TO PLY ---")
-    smpl_model_path = 'data/vibe_data'
-    
-    # Save the .ply file in the output folder
-    output_ply_path = os.path.join(output_folder, "result.ply")
-    os.makedirs(output_folder, exist_ok=True)
+    return {
+        "height":               measurements["height"],
+        "chest_circumference":  measurements["chest circumference"],
+        "waist_circumference":  measurements["waist circumference"],
+        "torso_length":         measurements["torso back length"],
+        "arms_length":          (measurements["arm left length"] + 
+                                 measurements["arm right length"]) / 2.0
+    }
+
+
+def _batch_payloads(fields: dict) -> list:
+    # one payload per body, unmeasurable values (nan) as None
+    num_bodies = len(next(iter(fields.values())))
+    return [{name: (None if np.isnan(values[i]) else
+                    round(float(values[i]), 2 if name == "arms_length" else 0))
+             for name, values in fields.items()}
+            for i in range(num_bodies)]
+
+
+def measure_shapes(betas, model_type: str = 'smpl', gender='NEUTRAL', chunk_size: int = 256):
+    """
+    Measures bodies given by their shape parameters, without VIBE.
+
+    :param betas: (B x <=10) shape coefficients, missing ones are zero
+    :param model_type: 'smpl' or 'smplx'
+    :param gender: 'NEUTRAL', 'MALE' or 'FEMALE', or one of them per shape
+    :param chunk_size: bodies measured together
+    :return: list of B payloads (same fields as `measure_verts`)
+    """
+    model_type = model_type.lower()
+    betas = np.atleast_2d(np.asarray(betas, dtype=np.float32))
+    if betas.size == 0:
+        raise ValueError('No betas given.')
+    if betas.ndim != 2 or betas.shape[1] > 10:
+        raise ValueError(f'betas need to be of dimension (B, <=10), got {betas.shape}.')
+    betas = np.pad(betas, ((0, 0), (0, 10 - betas.shape[1])))
+
+    genders = np.array([gender] * len(betas) if isinstance(gender, str) else gender)
+    if len(genders) != len(betas):
+        raise ValueError('Give one gender, or one per shape.')
+    genders = np.char.upper(genders.astype(str))
+
+    measurer = MeasureBody(model_type)
+    fields = {}
+    for g in np.unique(genders):
+        model = get_body_model(model_type, str(g))
+        indices = np.flatnonzero(genders == g)
+        for start in range(0, len(indices), chunk_size):
+            chunk = indices[start:start + chunk_size]
+            verts, joints = shape_to_verts(model, torch.from_numpy(betas[chunk]))
+            chunk_fields = payload_fields(measurer.measure_batch(verts, PAYLOAD_MEASUREMENTS,
+                                                                 joints=joints))
+            for name, values in chunk_fields.items():
+                fields.setdefault(name, np.full(len(betas), np.nan))[chunk] = values
+
+    return _batch_payloads(fields)
+
+
+def measure_vertex_batch(verts, chunk_size: int = 256):
+    """
+    Measures bodies given by their SMPL (6890) or SMPL-X (10475) vertices,
+    (N x 3) for one body or (B x N x 3), without VIBE.
+
+    :return: list of B payloads (same fields as `measure_verts`)
+    """
+    verts = np.asarray(verts, dtype=np.float32)
+    if verts.ndim == 2:
+        verts = verts[None]
+
+    n_verts = verts.shape[1] if verts.ndim == 3 else None
+    if n_verts == 6890:
+        model_type = 'smpl'
+    elif n_verts == 10475:
+        model_type = 'smplx'
+    else:
+        raise ValueError(f'verts need to be of dimension (B, 6890 or 10475, 3), got {verts.shape}.')
+
+    measurer = MeasureBody(model_type)
+    fields = {}
+    for start in range(0, len(verts), chunk_size):
+        chunk_fields = payload_fields(measurer.measure_batch(verts[start:start + chunk_size],
+                                                             PAYLOAD_MEASUREMENTS))
+        for name, values in chunk_fields.items():
+            fields.setdefault(name, []).append(values)
+
+    return _batch_payloads({name: np.concatenate(values) for name, values in fields.items()})
+
+
+def measure_verts_stack(verts_stack: np.ndarray, measurer=None):
+    """
+    Measures a stack of meshes (F x N x 3) of the same person in one batched
+    pass and returns the median of every value over the frames as a JSON
+    string (same fields as `measure_verts`), together with a dict giving the
+    number of frames and the per-field median absolute deviation (cm).
+    Frames where a circumference could not be sliced are ignored.
+    """
+    verts_stack = np.asarray(verts_stack, dtype=np.float32)
+
+    n_verts = verts_stack.shape[1]
+    if n_verts == 6890:
+        model_type = 'smpl'
+    elif n_verts == 10475:
+        model_type = 'smplx'
+    else:
+        raise ValueError(f'Unexpected vertex count {n_verts}.')
+
+    if measurer is None or measurer.num_points != n_verts:
+        measurer = MeasureBody(model_type)
+
+    per_frame = payload_fields(measurer.measure_batch(verts_stack, PAYLOAD_MEASUREMENTS))
+
+    payload = {}
+    mad = {}
+    for name, values in per_frame.items():
+        if np.isnan(values).all():
+            # not measurable in any frame, NaN is not valid JSON
+            payload[name] = mad[name] = None
+            continue
+        median = float(np.nanmedian(values))
+        payload[name] = round(median, 2 if name == "arms_length" else 0)
+        mad[name] = round(float(np.nanmedian(np.abs(values - median))), 2)
+
+    spread = {"num_frames": int(verts_stack.shape[0]), "mad": mad}
+
+    json_str = json.dumps(payload, indent=2)
+    print(f"\n=== JSON OUTPUT (median of {verts_stack.shape[0]} frames) ===")
+    print(json_str)
+    print(f"MAD: {mad}")
 
+    return json_str, spread
+
+
+def measure_json(model_path, measurer=None):
+    """
+    Loads a .ply mesh, calculates body measurements, and returns a JSON string.
+    """
+    print(f"\n--- 3. MEASURING BODY from: {model_path} ---")
+    mesh = trimesh.load(model_path, force='mesh')
+    verts_np = np.array(mesh.vertices, dtype=np.float32)
+    return measure_verts(verts_np, measurer=measurer)
+
+
+def get_subject_verts(vibe_data: dict, frame_idx: int = 0, smpl=None):
+    """
+    Returns the vertices (N x 3) of the first tracked person at `frame_idx`
+    of a VIBE results dictionary, or None if there are none. VIBE orders
+    the people by subject score, so the first one is the main subject.
+    For params-only results the mesh of that frame is generated with `smpl`
+    (a new SMPL model when None).
+    """
     try:
         # The data is already a dictionary, no joblib.load needed
         output = vibe_data
@@ -86,7 +241,13 @@ def results_to_ply(vibe_data: dict, output_folder: str):
         first_person_id = person_ids[0]
         print(f"Extracting data for person ID: {first_person_id}")
         
-        all_vertices = output[first_person_id]['verts']
+        person_data = output[first_person_id]
+        if person_data.get('verts') is None:
+            vertices = get_person_verts(person_data, frame_idx, smpl=smpl)
+            print(f"Generated vertices for frame {frame_idx}. Shape: {vertices.shape}")
+            return vertices
+
+        all_vertices = person_data['verts']
     except Exception as e:
         print(f"Error reading vibe_data dictionary: {e}.")
         print("Attempting to load as list (legacy format)...")
@@ -97,13 +258,72 @@ def results_to_ply(vibe_data: dict, output_folder: str):
             print(f"Legacy load failed: {e2}")
             return None
 
-    frame_idx = 0 # Use the first frame
     vertices = all_vertices[frame_idx]
     print(f"Loaded vertices for frame {frame_idx}. Shape: {vertices.shape}")
+    return vertices
+
 
-    model = smplx.SMPL(smpl_model_path)
-    faces = model.faces
-    print(f"Loaded SMPL faces. Shape: {faces.shape}")
+def check_num_measure_frames(num_measure_frames):
+    """
+    Raises ValueError unless `num_measure_frames` is None (every frame) or
+    an int of at least 1.
+    """
+    if num_measure_frames is None:
+        return
+    if isinstance(num_measure_frames, bool) or not isinstance(num_measure_frames, int) \
+            or num_measure_frames < 1:
+        raise ValueError(f'num_measure_frames needs to be null or an integer >= 1, '
+                         f'got {num_measure_frames!r}')
+
+
+def get_subject_verts_stack(vibe_data: dict, num_frames=None, smpl=None):
+    """
+    Returns the vertices (F x N x 3) of the first tracked person at
+    `num_frames` frames sampled evenly over its tracklet (every frame when
+    None), or None if there are none.
+    """
+    person_ids = list(vibe_data.keys())
+    if not person_ids:
+        print(f"Error: No people found in vibe_data dictionary")
+        return None
+
+    person_data = vibe_data[person_ids[0]]
+    n = len(person_data['pose'])
+    if num_frames is None or num_frames >= n:
+        frame_ids = np.arange(n)
+    else:
+        frame_ids = np.unique(np.linspace(0, n - 1, num_frames).round().astype(int))
+
+    vertices = get_person_verts(person_data, frame_ids, smpl=smpl)
+    print(f"Loaded vertices of {len(frame_ids)} frames for person ID: {person_ids[0]}")
+    return vertices
+
+
+# <-- *** MODIFICATION 1 *** -->
+# Renamed from pkl2ply to results_to_ply
+# Now accepts the vibe_data dictionary and output_folder directly
+def results_to_ply(vibe_data: dict, output_folder: str, faces=None, smpl=None):
+    """
+    Converts a VIBE results dictionary to a .ply mesh.
+    Saves the .ply in the specified output_folder and returns the path.
+    `faces` are the SMPL faces; they are loaded from the SMPL model when
+    not given.
+    """
+    print(f"\n--- CONVERTING VIBE data TO PLY ---")
+    smpl_model_path = 'data/vibe_data'
+    
+    # Save the .ply file in the output folder
+    output_ply_path = os.path.join(output_folder, "result.ply")
+    os.makedirs(output_folder, exist_ok=True)
+
+    vertices = get_subject_verts(vibe_data, frame_idx=0, smpl=smpl) # Use the first frame
+    if vertices is None:
+        return None
+
+    if faces is None:
+        model = smplx.SMPL(smpl_model_path)
+        faces = model.faces
+        print(f"Loaded SMPL faces. Shape: {faces.shape}")
 
     mesh = trimesh.Trimesh(vertices=vertices, faces=faces)
     mesh.export(output_ply_path)
@@ -113,26 +333,55 @@ def results_to_ply(vibe_data: dict, output_folder: str):
     return output_ply_path
 
 
+# VIBE options of the measurement pipeline
+PIPELINE_VIBE_OPTIONS = dict(
+    run_smplify=True,
+    smooth=True,
+    no_render=True,
+    params_only=True,
+    vibe_chunk_size=64,
+    # the measured frame does not need more than 30 fps of context,
+    # 60 fps phone videos are decoded at half their frame rate
+    target_fps=30,
+    # every job holds its decoded frames from decode to the end of VIBE
+    # and the executor keeps several such jobs at once: 10 s are at most
+    # 300 frames, 0.8 GB at 1280x720, whatever the length of the upload.
+    # Only the first MAX_VIDEO_SECONDS of an upload are used (0 for all
+    # of it), the decoded length is reported under "video"
+    max_duration=float(os.environ.get("MAX_VIDEO_SECONDS", "10")),
+    # plenty for 224x224 crops of a full body, 4K uploads are decoded
+    # at a fraction of their size
+    max_img_size=1280,
+    # one person standing in front of the camera: detect every 8 frames
+    # at most, more often where the person moves
+    keyframe_stride=8,
+    # only the subject is measured, bystanders are not run through VIBE
+    num_subjects=1,
+)
+
+
 # <-- *** MODIFICATION 2 *** -->
 # Updated to capture the returned dictionary from run_vibe
-def process_video_endpoint(video_path):
+def process_video_endpoint(video_path, models=None, output_folder='output', save_pkl=True,
+                           profiler=None):
     """
-    Runs VIBE on a video and returns the path to the output .pkl file.
+    Runs VIBE on a video and returns its results dictionary.
+    `models` is an optional loaded `ModelRegistry` shared between jobs.
+    Everything VIBE writes goes to `output_folder` (give each concurrent
+    job its own, e.g. from a `JobWorkspace`); `save_pkl` also saves the
+    results there as vibe_output.pkl. VIBE's stages are recorded in
+    `profiler` when given.
     """
     print(f"\n--- 1. STARTING VIBE PROCESSING for {video_path} ---")
-    output_folder = 'output' 
     
-    # This path is still used by VIBE to save the .pkl, but
-    # we won't use it for loading anymore.
-    pkl_save_path = os.path.join(output_folder, "vibe_output.pkl")
-
     # Run VIBE and get the results dictionary directly
     vibe_data = run_vibe(
         vid_file=video_path,
         output_folder=output_folder, 
-        run_smplify=True,
-        smooth=True,
-        no_render=True
+        no_pkl=not save_pkl,
+        models=models,
+        profiler=profiler,
+        **PIPELINE_VIBE_OPTIONS
     )
     
     # Check if data was returned, not if a file exists
@@ -150,39 +399,126 @@ def process_video_endpoint(video_path):
 
 # <-- *** MODIFICATION 3 *** -->
 # Updated to handle the new return value from process_video_endpoint
-# and call the new results_to_ply function
-def run_full_pipeline(input_video_path):
+# and measure the in-memory vertices (PLY export is optional)
+def run_full_pipeline(input_video_path, models=None, save_ply=False, num_measure_frames=1,
+                      workspace=None, save_pkl=True, profiler=None):
     """
     This is the main function your API will call.
     It takes a video file path, runs the full process, and returns
     a dictionary with the final measurements or an error.
+
+    The body is measured straight from the in-memory VIBE vertices;
+    set `save_ply` to also export the measured mesh as `result.ply`
+    in the output folder (its path is returned under "ply_path").
+
+    When a loaded `ModelRegistry` is passed as `models`, the VIBE model,
+    tracker, SMPL faces and measurer are taken from it instead of being
+    loaded for this call. The wall time of each stage is returned under
+    "timings".
+
+    `num_measure_frames` frames of the person, sampled evenly, are measured
+    (every frame when None) and the median values are returned; with more
+    than one frame the per-measurement dispersion is returned under "spread".
+
+    Outputs go to the 'output' folder, or to the `output` directory of
+    `workspace` (a `JobWorkspace`) so that concurrent jobs never share
+    files; the workspace quota is checked after each stage that writes.
+    `save_pkl` keeps the VIBE results as vibe_output.pkl.
+
+    Wall time, CPU time, peak RSS and frame count of every finer stage
+    (decode, detection, tracking, crop, hmr, temporal_encoder, regressor,
+    smplify, smoothing, measurement) are returned under "profile",
+    recorded in `profiler` or in a new `instrumentation.Profiler`.
     """
+    timings = {}
+    profiler = Profiler() if profiler is None else profiler
     
     # --- STAGE 1: Process Video (Video -> VIBE data dict) ---
-    vibe_results = process_video_endpoint(input_video_path)
+    start = time.perf_counter()
+    output_folder = str(workspace.subdir('output')) if workspace is not None else 'output'
+    vibe_results = process_video_endpoint(input_video_path, models=models,
+                                          output_folder=output_folder, save_pkl=save_pkl,
+                                          profiler=profiler)
+    timings['vibe'] = time.perf_counter() - start
+    if workspace is not None:
+        workspace.check_quota()
     
     if vibe_results['status'] == 'error':
+        vibe_results["profile"] = profiler.report()
         return vibe_results # Pass the error dictionary up
     
     # Get the data and save location from the results
     vibe_data = vibe_results['data']
     output_folder = vibe_results['output_folder']
+
+    return measure_vibe_data(vibe_data, output_folder, models=models, save_ply=save_ply,
+                             num_measure_frames=num_measure_frames, workspace=workspace,
+                             timings=timings, profiler=profiler)
+
+
+def measure_vibe_data(vibe_data: dict, output_folder: str, models=None, save_ply=False,
+                      num_measure_frames=1, workspace=None, timings=None, profiler=None):
+    """
+    Second half of `run_full_pipeline`: picks the mesh(es) of the subject
+    from the VIBE results, measures them and optionally exports the PLY.
+    Returns the same dictionary as `run_full_pipeline`; stage times are
+    added to `timings`, and the report of `profiler` (when given) is
+    returned under "profile".
+    """
+    timings = {} if timings is None else timings
+    report_profile = profiler is not None
+    profiler = get_profiler(profiler)
+
+    try:
+        check_num_measure_frames(num_measure_frames)
+    except ValueError as e:
+        return {"status": "error", "message": str(e)}
+
+    # --- STAGE 2: Pick the mesh(es) to measure (dict -> vertices) ---
+    smpl = models.smpl if models is not None else None
+    if num_measure_frames == 1:
+        vertices = get_subject_verts(vibe_data, frame_idx=0, smpl=smpl)
+    else:
+        vertices = get_subject_verts_stack(vibe_data, num_frames=num_measure_frames, smpl=smpl)
     
-    # --- STAGE 2: Convert VIBE data to PLY (dict -> PLY) ---
-    ply_file_path = results_to_ply(vibe_data, output_folder)
-    
-    if ply_file_path is None:
-        return {"status": "error", "message": "Failed to convert VIBE data to PLY"}
+    if vertices is None:
+        return {"status": "error", "message": "Failed to read vertices from VIBE data"}
     
-    # --- STAGE 3: Measure Body (PLY -> JSON) ---
+    # --- STAGE 3: Measure Body (vertices -> JSON) ---
+    spread = None
     try:
-        json_measurements = measure_json(ply_file_path)
-        print(f"\n--- 4. FULL PROCESS COMPLETE ---")
-        return {"status": "success", "data": json_measurements}
+        start = time.perf_counter()
+        print(f"\n--- 2. MEASURING BODY ---")
+        measurer = models.new_measurer() if models is not None else None
+        with profiler.span('measurement', frames=len(vertices) if vertices.ndim == 3 else 1):
+            if vertices.ndim == 3:
+                json_measurements, spread = measure_verts_stack(vertices, measurer=measurer)
+            else:
+                json_measurements = measure_verts(vertices, measurer=measurer)
+        timings['measure'] = time.perf_counter() - start
     except Exception as e:
         print(f"Error during measurement: {e}")
         return {"status": "error", "message": f"Failed during measurement: {e}"}
 
+    result = {"status": "success", "data": json_measurements, "timings": timings}
+    if spread is not None:
+        result["spread"] = spread
+
+    # --- [Optional] Export the measured mesh (dict -> PLY) ---
+    if save_ply:
+        start = time.perf_counter()
+        faces = models.smpl_faces if models is not None else None
+        result["ply_path"] = results_to_ply(vibe_data, output_folder, faces=faces, smpl=smpl)
+        timings['ply'] = time.perf_counter() - start
+        if workspace is not None:
+            workspace.check_quota()
+
+    if report_profile:
+        result["profile"] = profiler.report()
+
+    print(f"\n--- 3. FULL PROCESS COMPLETE ---")
+    return result
+
 
 # --- This block is for testing your script directly ---
 if __name__ == '__main__':
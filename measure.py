@@ -1,17 +1,18 @@
 
 from typing import List, Dict
+import functools
 import numpy as np
-import trimesh
 import torch
 import smplx
+from smplx.lbs import blend_shapes, vertices2joints, lbs
 from pprint import pprint
-import os
 import argparse
 
 from measurement_definitions import *
 from utils import *
 from landmark_definitions import *
 from joint_definitions import *
+from measurement_plan import MeasurementPlan, get_measurement_plan
 
 
 
@@ -54,6 +55,47 @@ def create_model(model_type, model_root, gender, num_betas=10, num_thetas=24):
 
 
 
+@functools.lru_cache(maxsize=None)
+def get_body_model(model_type: str, gender: str, model_root: str = "data"):
+    '''
+    Body model of the given type and gender with 10 shape coefficients, 
+    created once and shared.
+    '''
+    model = create_model(model_type=model_type,
+                         model_root=model_root,
+                         gender=gender,
+                         num_betas=10)
+    return model.eval().requires_grad_(False)
+
+
+def shape_to_verts(model, shape: torch.tensor):
+    '''
+    Vertices and joints of a batch of shapes in the rest pose, which 
+    is what set_shape gives without running the whole body model.
+    SMPL-X models created with flat_hand_mean=False (the smplx default)
+    add their mean pose to every pose, so the rest pose has the hands
+    in that mean pose and its pose blend shapes.
+    :param model: smplx body model with 10 shape coefficients
+    :param shape: torch.tensor (B,10) beta parameters
+
+    Return
+    :param verts: np.ndarray (B,V,3)
+    :param joints: np.ndarray (B,J,3) - joints of the kinematic tree
+    '''
+    shape = shape.to(torch.float32)
+    pose_mean = getattr(model, 'pose_mean', None)
+    with torch.no_grad():
+        if pose_mean is not None and bool(pose_mean.any()):
+            full_pose = pose_mean.to(torch.float32).reshape(1, -1).repeat(shape.shape[0], 1)
+            verts, joints = lbs(shape, full_pose, model.v_template,
+                                model.shapedirs, model.posedirs,
+                                model.J_regressor, model.parents, model.lbs_weights)
+        else:
+            verts = model.v_template[None] + blend_shapes(shape, model.shapedirs)
+            joints = vertices2joints(model.J_regressor, verts)
+    return verts.cpu().numpy(), joints.cpu().numpy()
+
+
 class Measurer():
     '''
     Measure a parametric body model defined either.
@@ -63,8 +105,48 @@ class Measurer():
     '''
 
     def __init__(self):
-        self.verts = None
+        self.plan = None
         self.faces = None
+        self.circumf_face_masks = None
+        self.joint_regressor = None
+        self.reset()
+
+    def use_plan(self, plan: MeasurementPlan):
+        '''
+        Take the model data (faces, segmentation, definitions, joint
+        regressor) from a shared measurement plan.
+        :param plan: MeasurementPlan of the body model type
+        '''
+        self.plan = plan
+
+        self.model_type = plan.model_type
+        self.body_model_root = plan.body_model_root
+        self.body_model_path = plan.body_model_path
+
+        self.faces = plan.faces
+        self.face_segmentation = plan.face_segmentation
+
+        self.landmarks = plan.landmarks
+        self.measurement_types = plan.measurement_types
+        self.length_definitions = plan.length_definitions
+        self.circumf_definitions = plan.circumf_definitions
+        self.circumf_2_bodypart = plan.circumf_2_bodypart
+        self.circumf_face_masks = plan.circumf_face_masks
+        self.all_possible_measurements = plan.all_possible_measurements
+
+        self.joint2ind = plan.joint2ind
+        self.num_joints = plan.num_joints
+        self.joint_regressor = plan.joint_regressor
+
+        self.num_points = plan.num_points
+
+    def reset(self):
+        '''
+        Forget the current body and its measurements while keeping
+        the loaded model data (faces, segmentation, joint regressor),
+        so one measurer can be reused for another body.
+        '''
+        self.verts = None
         self.joints = None
         self.gender = None
 
@@ -74,6 +156,18 @@ class Measurer():
         self.height_normalized_labeled_measurements = {}
         self.labels2names = {}
 
+    def load_joint_regressor(self):
+        '''
+        Load the neutral joint regressor of the body model once and
+        keep it for every following body.
+        '''
+        if self.joint_regressor is None:
+            self.joint_regressor = get_joint_regressor(self.model_type, 
+                                                       self.body_model_root,
+                                                       gender="NEUTRAL", 
+                                                       num_thetas=self.num_joints)
+        return self.joint_regressor
+
     def from_verts(self):
         pass
 
@@ -89,6 +183,11 @@ class Measurer():
                                     to measure from MeasurementDefinitions class
         '''
 
+        # all circumferences are sliced together, see measure_circumferences
+        circumf_names = [m_name for m_name in measurement_names
+                         if self.measurement_types.get(m_name) == MeasurementType().CIRCUMFERENCE]
+        circumferences = self.measure_circumferences(circumf_names)
+
         for m_name in measurement_names:
             if m_name not in self.all_possible_measurements:
                 print(f"Measurement {m_name} not defined.")
@@ -104,7 +203,7 @@ class Measurer():
 
             elif self.measurement_types[m_name] == MeasurementType().CIRCUMFERENCE:
 
-                value = self.measure_circumference(m_name)
+                value = circumferences[m_name]
                 self.measurements[m_name] = value
     
             else:
@@ -119,6 +218,12 @@ class Measurer():
         :float of measurement in cm
         '''
 
+        if self.plan is not None:
+            # (2,2) vertex indices, each end point is the mean of its pair
+            end_point_inds = self.plan.length_landmark_indices[measurement_name]
+            landmark_points = self.verts[end_point_inds].mean(axis=1)[None,...]
+            return self._get_dist(landmark_points)
+
         measurement_landmarks_inds = self.length_definitions[measurement_name]
 
         landmark_points = []
@@ -168,32 +273,136 @@ class Measurer():
         float of measurement value in cm
         '''
 
-        measurement_definition = self.circumf_definitions[measurement_name]
-        circumf_landmarks = measurement_definition["LANDMARKS"]
-        circumf_landmark_indices = [self.landmarks[l_name] for l_name in circumf_landmarks]
-        circumf_n1, circumf_n2 = self.circumf_definitions[measurement_name]["JOINTS"]
-        circumf_n1, circumf_n2 = self.joint2ind[circumf_n1], self.joint2ind[circumf_n2]
-        
-        plane_origin = np.mean(self.verts[circumf_landmark_indices,:],axis=0)
-        plane_normal = self.joints[circumf_n1,:] - self.joints[circumf_n2,:]
+        return self.measure_circumferences([measurement_name])[measurement_name]
 
-        mesh = trimesh.Trimesh(vertices=self.verts, faces=self.faces)
+    def measure_circumferences(self,
+                               measurement_names: List[str]
+                               ) -> Dict[str, float]:
+        '''
+        Measure several circumferences at once. The signed distances of
+        all vertices to all the cutting planes are found with one matrix
+        product, then each plane is intersected only with the faces of
+        the body part of its measurement.
+        :param measurement_names: list of circumference names
 
-        # new version            
-        slice_segments, sliced_faces = trimesh.intersections.mesh_plane(mesh, 
-                                plane_normal=plane_normal, 
-                                plane_origin=plane_origin, 
-                                return_faces=True) # (N, 2, 3), (N,)
-        
-        slice_segments = filter_body_part_slices(slice_segments,
-                                                 sliced_faces,
-                                                 measurement_name,
-                                                 self.circumf_2_bodypart,
-                                                 self.face_segmentation)
-        
-        slice_segments_hull = convex_hull_from_3D_points(slice_segments)
+        Return
+        dict of {measurement name: value in cm}
+        '''
 
-        return self._get_dist(slice_segments_hull)
+        if len(measurement_names) == 0:
+            return {}
+
+        plane_origins = []
+        plane_normals = []
+        for measurement_name in measurement_names:
+            if self.plan is not None:
+                circumf_landmark_indices = self.plan.circumf_landmark_indices[measurement_name]
+                circumf_n1, circumf_n2 = self.plan.circumf_joint_pairs[measurement_name]
+            else:
+                measurement_definition = self.circumf_definitions[measurement_name]
+                circumf_landmarks = measurement_definition["LANDMARKS"]
+                circumf_landmark_indices = [self.landmarks[l_name] for l_name in circumf_landmarks]
+                circumf_n1, circumf_n2 = self.circumf_definitions[measurement_name]["JOINTS"]
+                circumf_n1, circumf_n2 = self.joint2ind[circumf_n1], self.joint2ind[circumf_n2]
+
+            plane_origins.append(np.mean(self.verts[circumf_landmark_indices,:],axis=0))
+            plane_normals.append(self.joints[circumf_n1,:] - self.joints[circumf_n2,:])
+
+        plane_origins = np.stack(plane_origins) # (C,3)
+        plane_normals = np.stack(plane_normals) # (C,3)
+
+        # (V,C) signed distances, scaled by the normal lengths
+        vertex_dists = self.verts @ plane_normals.T - np.sum(plane_origins * plane_normals, axis=1)
+
+        circumferences = {}
+        for i, measurement_name in enumerate(measurement_names):
+
+            if self.plan is not None and measurement_name in self.plan.circumf_faces:
+                # only faces of the measurement body part
+                faces = self.plan.circumf_faces[measurement_name]
+                slice_segments, _ = slice_faces_with_plane(self.verts, faces, vertex_dists[:,i])
+            else:
+                slice_segments, sliced_faces = slice_faces_with_plane(self.verts, 
+                                                                      self.faces, 
+                                                                      vertex_dists[:,i])
+                slice_segments = filter_body_part_slices(slice_segments,
+                                                         sliced_faces,
+                                                         measurement_name,
+                                                         self.circumf_2_bodypart,
+                                                         self.face_segmentation,
+                                                         self.circumf_face_masks)
+
+            slice_segments_hull = convex_hull_from_3D_points(slice_segments)
+            circumferences[measurement_name] = self._get_dist(slice_segments_hull)
+
+        return circumferences
+
+    def measure_batch(self,
+                      verts: np.ndarray,
+                      measurement_names: List[str],
+                      joints: np.ndarray = None
+                      ) -> Dict[str, np.ndarray]:
+        '''
+        Measure a stack of F bodies given by their vertices. Lengths and 
+        slicing are computed for all the bodies at once, only the convex
+        hull of each slice is found body by body. The measurer's own body
+        and measurements are left untouched.
+        :param verts: np.ndarray (F,V,3) - vertices of the bodies
+        :param measurement_names: list of measurement names
+        :param joints: np.ndarray (F,J,3) - joints of the bodies, used for the
+                       circumference plane normals; regressed from the vertices
+                       with the plan's joint regressor when None
+
+        Return
+        dict of {measurement name: np.ndarray (F,) of values in cm}, 
+        nan where a circumference plane misses its body part
+        '''
+
+        error_msg = f"verts need to be of dimension (F,{self.num_points},3)"
+        assert verts.ndim == 3 and verts.shape[1:] == (self.num_points,3), error_msg
+        assert self.plan is not None, "measure_batch needs a measurement plan"
+
+        num_frames = verts.shape[0]
+        measurements = {}
+
+        for m_name in measurement_names:
+            if m_name not in self.all_possible_measurements:
+                print(f"Measurement {m_name} not defined.")
+                continue
+
+            if self.measurement_types[m_name] == MeasurementType().LENGTH:
+                # (F,2,3) end points, each the mean of its pair of vertices
+                end_point_inds = self.plan.length_landmark_indices[m_name]
+                end_points = verts[:,end_point_inds].mean(axis=2)
+                measurements[m_name] = np.linalg.norm(end_points[:,1] - end_points[:,0], 
+                                                      axis=1) * 100
+
+            elif self.measurement_types[m_name] == MeasurementType().CIRCUMFERENCE:
+                landmark_indices = self.plan.circumf_landmark_indices[m_name]
+                plane_origins = verts[:,landmark_indices].mean(axis=1) # (F,3)
+                if joints is not None:
+                    circumf_n1, circumf_n2 = self.plan.circumf_joint_pairs[m_name]
+                    plane_normals = joints[:,circumf_n1] - joints[:,circumf_n2]
+                else:
+                    plane_normals = verts.transpose(0,2,1) @ self.plan.circumf_normal_regressors[m_name] # (F,3)
+
+                faces = self.plan.circumf_faces.get(m_name, self.faces)
+                slice_segments, frame_ids = slice_faces_with_planes(verts, 
+                                                                    faces, 
+                                                                    plane_origins, 
+                                                                    plane_normals)
+
+                values = np.full(num_frames, np.nan)
+                frames, starts = np.unique(frame_ids, return_index=True)
+                for frame, frame_segments in zip(frames, np.split(slice_segments, starts[1:])):
+                    slice_segments_hull = convex_hull_from_3D_points(frame_segments)
+                    values[frame] = self._get_dist(slice_segments_hull)
+                measurements[m_name] = values
+
+            else:
+                print(f"Measurement {m_name} not defined")
+
+        return measurements
 
     def height_normalize_measurements(self, new_height: float):
         ''' 
@@ -259,31 +468,13 @@ class MeasureSMPL(Measurer):
     All the measurements are expressed in cm.
     '''
 
-    def __init__(self):
+    def __init__(self, plan: MeasurementPlan = None):
         
         super().__init__()
 
-        self.model_type = "smpl"
-        self.body_model_root = "data"
-        self.body_model_path = os.path.join(self.body_model_root, 
-                                            self.model_type)
-
-        self.faces = smplx.SMPL(self.body_model_path, ext="pkl").faces
-        face_segmentation_path = os.path.join(self.body_model_path,
-                                              f"{self.model_type}_body_parts_2_faces.json")
-        self.face_segmentation = load_face_segmentation(face_segmentation_path)
-
-        self.landmarks = SMPL_LANDMARK_INDICES
-        self.measurement_types = MEASUREMENT_TYPES
-        self.length_definitions = SMPLMeasurementDefinitions().LENGTHS
-        self.circumf_definitions = SMPLMeasurementDefinitions().CIRCUMFERENCES
-        self.circumf_2_bodypart = SMPLMeasurementDefinitions().CIRCUMFERENCE_TO_BODYPARTS
-        self.all_possible_measurements = SMPLMeasurementDefinitions().possible_measurements
-
-        self.joint2ind = SMPL_JOINT2IND
-        self.num_joints = SMPL_NUM_JOINTS
-
-        self.num_points = 6890
+        if plan is None:
+            plan = get_measurement_plan("smpl")
+        self.use_plan(plan)
 
     def from_verts(self,
                    verts: torch.tensor):
@@ -296,10 +487,7 @@ class MeasureSMPL(Measurer):
         error_msg = f"verts need to be of dimension ({self.num_points},3)"
         assert verts.shape == torch.Size([self.num_points,3]), error_msg
 
-        joint_regressor = get_joint_regressor(self.model_type, 
-                                              self.body_model_root,
-                                              gender="NEUTRAL", 
-                                              num_thetas=self.num_joints)
+        joint_regressor = self.load_joint_regressor()
         joints = torch.matmul(joint_regressor, verts)
         self.joints = joints.numpy()
         self.verts = verts.numpy()
@@ -335,31 +523,13 @@ class MeasureSMPLX(Measurer):
     All the measurements are expressed in cm.
     '''
 
-    def __init__(self):
+    def __init__(self, plan: MeasurementPlan = None):
         
         super().__init__()
 
-        self.model_type = "smplx"
-        self.body_model_root = "data"
-        self.body_model_path = os.path.join(self.body_model_root, 
-                                            self.model_type)
-
-        self.faces = smplx.SMPLX(self.body_model_path, ext="pkl").faces
-        face_segmentation_path = os.path.join(self.body_model_path,
-                                              f"{self.model_type}_body_parts_2_faces.json")
-        self.face_segmentation = load_face_segmentation(face_segmentation_path)
-
-        self.landmarks = SMPLX_LANDMARK_INDICES
-        self.measurement_types = MEASUREMENT_TYPES
-        self.length_definitions = SMPLXMeasurementDefinitions().LENGTHS
-        self.circumf_definitions = SMPLXMeasurementDefinitions().CIRCUMFERENCES
-        self.circumf_2_bodypart = SMPLXMeasurementDefinitions().CIRCUMFERENCE_TO_BODYPARTS
-        self.all_possible_measurements = SMPLXMeasurementDefinitions().possible_measurements
-
-        self.joint2ind = SMPLX_JOINT2IND
-        self.num_joints = SMPLX_NUM_JOINTS
-
-        self.num_points = 10475
+        if plan is None:
+            plan = get_measurement_plan("smplx")
+        self.use_plan(plan)
 
     def from_verts(self,
                    verts: torch.tensor):
@@ -372,10 +542,7 @@ class MeasureSMPLX(Measurer):
         error_msg = f"verts need to be of dimension ({self.num_points},3)"
         assert verts.shape == torch.Size([self.num_points,3]), error_msg
 
-        joint_regressor = get_joint_regressor(self.model_type, 
-                                              self.body_model_root,
-                                              gender="NEUTRAL", 
-                                              num_thetas=self.num_joints)
+        joint_regressor = self.load_joint_regressor()
         joints = torch.matmul(joint_regressor, verts)
         self.joints = joints.numpy()
         self.verts = verts.numpy()
@@ -407,9 +574,9 @@ class MeasureBody():
     def __new__(cls, model_type):
         model_type = model_type.lower()
         if model_type == 'smpl':
-            return MeasureSMPL()
+            return MeasureSMPL(get_measurement_plan(model_type))
         elif model_type == 'smplx':
-            return MeasureSMPLX()
+            return MeasureSMPLX(get_measurement_plan(model_type))
         else:
             raise NotImplementedError("Model type not defined")
 
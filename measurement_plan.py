@@ -0,0 +1,132 @@
+import os
+import functools
+from types import MappingProxyType
+
+import numpy as np
+import smplx
+
+from measurement_definitions import *
+from utils import load_face_segmentation, get_body_part_face_masks
+from landmark_definitions import *
+from joint_definitions import *
+
+
+MODEL_SPECS = {
+    "smpl": {"definitions": SMPLMeasurementDefinitions,
+             "landmarks": SMPL_LANDMARK_INDICES,
+             "joint2ind": SMPL_JOINT2IND,
+             "num_joints": SMPL_NUM_JOINTS,
+             "num_points": 6890},
+    "smplx": {"definitions": SMPLXMeasurementDefinitions,
+              "landmarks": SMPLX_LANDMARK_INDICES,
+              "joint2ind": SMPLX_JOINT2IND,
+              "num_joints": SMPLX_NUM_JOINTS,
+              "num_points": 10475},
+}
+
+
+def _read_only(array: np.ndarray) -> np.ndarray:
+    array = np.ascontiguousarray(array)
+    array.setflags(write=False)
+    return array
+
+
+class MeasurementPlan():
+    '''
+    Everything needed to measure a body model of one type that does not
+    depend on the body itself: faces, face segmentation and per-circumference
+    face masks, landmark indices, the joint regressor and, for each
+    circumference, the pair of joints defining the plane normal.
+
+    Build it with get_measurement_plan so that it is created once per
+    model type and shared by every measurer. The plan is read-only: arrays
+    are not writeable and dicts are mapping proxies.
+    '''
+
+    def __init__(self, model_type: str, body_model_root: str = "data"):
+
+        model_type = model_type.lower()
+        if model_type not in MODEL_SPECS:
+            raise NotImplementedError("Model type not defined")
+        spec = MODEL_SPECS[model_type]
+        definitions = spec["definitions"]()
+
+        self.model_type = model_type
+        self.body_model_root = body_model_root
+        self.body_model_path = os.path.join(body_model_root, model_type)
+
+        self.num_joints = spec["num_joints"]
+        self.num_points = spec["num_points"]
+        self.joint2ind = MappingProxyType(dict(spec["joint2ind"]))
+        self.landmarks = MappingProxyType(dict(spec["landmarks"]))
+        self.measurement_types = MappingProxyType(dict(MEASUREMENT_TYPES))
+        self.length_definitions = MappingProxyType(dict(definitions.LENGTHS))
+        self.circumf_definitions = MappingProxyType(dict(definitions.CIRCUMFERENCES))
+        self.circumf_2_bodypart = MappingProxyType(dict(definitions.CIRCUMFERENCE_TO_BODYPARTS))
+        self.all_possible_measurements = tuple(definitions.possible_measurements)
+
+        # one body model load gives both the faces and the joint regressor
+        body_model = smplx.create(model_path=body_model_root,
+                                  model_type=model_type,
+                                  gender="NEUTRAL",
+                                  use_face_contour=False,
+                                  num_betas=10,
+                                  ext='pkl')
+        self.faces = _read_only(body_model.faces.astype(np.int64))
+        self.joint_regressor = body_model.J_regressor.detach().clone()
+        self.joint_regressor.requires_grad_(False)
+        joint_regressor_np = self.joint_regressor.cpu().numpy()
+
+        face_segmentation_path = os.path.join(self.body_model_path,
+                                              f"{model_type}_body_parts_2_faces.json")
+        face_segmentation = load_face_segmentation(face_segmentation_path)
+        self.face_segmentation = MappingProxyType(
+            {body_part: _read_only(np.asarray(faces, dtype=np.int64))
+             for body_part, faces in face_segmentation.items()})
+
+        circumf_face_masks = get_body_part_face_masks(self.circumf_2_bodypart,
+                                                      self.face_segmentation,
+                                                      self.faces.shape[0])
+        self.circumf_face_masks = MappingProxyType(
+            {name: _read_only(mask) for name, mask in circumf_face_masks.items()})
+        # faces each circumference plane is intersected with
+        self.circumf_faces = MappingProxyType(
+            {name: _read_only(self.faces[mask]) for name, mask in circumf_face_masks.items()})
+
+        # every length end point as a pair of vertex indices whose mean is
+        # the landmark (a single vertex landmark is the pair (i,i))
+        length_landmark_indices = {}
+        for name, landmarks in self.length_definitions.items():
+            end_points = [lm if isinstance(lm, tuple) else (lm, lm)
+                          for lm in landmarks[:2]]
+            length_landmark_indices[name] = _read_only(np.array(end_points, dtype=np.int64))
+        self.length_landmark_indices = MappingProxyType(length_landmark_indices)
+
+        circumf_landmark_indices = {}
+        circumf_joint_pairs = {}
+        circumf_normal_regressors = {}
+        for name, definition in self.circumf_definitions.items():
+            circumf_landmark_indices[name] = _read_only(np.array(
+                [self.landmarks[l_name] for l_name in definition["LANDMARKS"]], dtype=np.int64))
+            n1, n2 = [self.joint2ind[j_name] for j_name in definition["JOINTS"]]
+            circumf_joint_pairs[name] = (n1, n2)
+            # plane normal = joint n1 - joint n2 = (J[n1] - J[n2]) @ verts
+            circumf_normal_regressors[name] = _read_only(
+                joint_regressor_np[n1] - joint_regressor_np[n2])
+        self.circumf_landmark_indices = MappingProxyType(circumf_landmark_indices)
+        self.circumf_joint_pairs = MappingProxyType(circumf_joint_pairs)
+        self.circumf_normal_regressors = MappingProxyType(circumf_normal_regressors)
+
+
+@functools.lru_cache(maxsize=None)
+def _build_measurement_plan(model_type: str, body_model_root: str) -> MeasurementPlan:
+    return MeasurementPlan(model_type, body_model_root)
+
+
+def get_measurement_plan(model_type: str, body_model_root: str = "data") -> MeasurementPlan:
+    '''
+    Returns the measurement plan of model_type, building it on first use.
+    :param model_type: str - smpl or smplx
+    :param body_model_root: str - folder with the smpl/smplx model folders
+    '''
+    return _build_measurement_plan(model_type.lower(), body_model_root)
@@ -0,0 +1,162 @@
+# model_registry.py
+# --------------------------------------------------------------
+# Process-resident models shared by every job of a worker
+# --------------------------------------------------------------
+# Loading VIBE (ResNet50 backbone + SPIN/VIBE checkpoints), the
+# YOLO tracker and the SMPL body models takes seconds. The registry
+# loads them once when the worker starts and hands them to each job.
+# --------------------------------------------------------------
+
+import copy
+import time
+import threading
+
+import torch
+
+from VIBE import load_vibe_model, build_tracker
+from feature_batcher import FeatureBatcher
+from compiled_vibe import DEFAULT_ROOT as COMPILED_ROOT, compile_vibe
+from measure import MeasureBody
+from lib.models.smpl import SMPL, SMPL_MODEL_DIR
+
+
+class ModelRegistry():
+    """
+    Holds the VIBE model, the multi person tracker, the SMPL model used to
+    generate meshes from params-only results (and its faces for mesh export)
+    and a template body measurer.
+
+    All models are loaded by `load()` and kept in eval mode. `load_times`
+    records the cold-start cost of each of them in seconds.
+
+    With `feature_batch_size` set, `feature_batcher` batches the VIBE
+    backbone across concurrent jobs (at most that many frames per call,
+    waiting up to `feature_batch_wait` seconds for other jobs).
+
+    With `compiled`, the VIBE backbone, temporal encoder and regressor run
+    the TorchScript graphs saved under `compiled_root` for the loaded
+    weights (see compiled_vibe.py), exported at load when
+    `export_compiled` is set; parts without a graph run eagerly.
+    `compiled_parts` lists the parts that run compiled.
+    """
+
+    def __init__(self,
+                 device=None,
+                 tracker_batch_size: int = 12,
+                 detector: str = 'yolo',
+                 yolo_img_size: int = 416,
+                 model_type: str = 'smpl',
+                 feature_batch_size: int = None,
+                 feature_batch_wait: float = 0.01,
+                 compiled: bool = True,
+                 compiled_root=COMPILED_ROOT,
+                 export_compiled: bool = False):
+        if device is None:
+            device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+        self.device = device
+        self.tracker_batch_size = tracker_batch_size
+        self.detector = detector
+        self.yolo_img_size = yolo_img_size
+        self.model_type = model_type
+        self.feature_batch_size = feature_batch_size
+        self.feature_batch_wait = feature_batch_wait
+        self.compiled = compiled
+        self.compiled_root = compiled_root
+        self.export_compiled = export_compiled
+
+        self.vibe_model = None
+        self.compiled_parts = []
+        self.feature_batcher = None
+        self.tracker = None
+        self.smpl = None
+        self.smpl_faces = None
+        self.measurer = None
+
+        # MPT is stateful (Sort tracker), jobs have to take turns on it
+        self.tracker_lock = threading.Lock()
+
+        self.load_times = {}
+        self.loaded = False
+
+    def _timed(self, name, fn):
+        start = time.perf_counter()
+        value = fn()
+        self.load_times[name] = time.perf_counter() - start
+        print(f'[registry] loaded {name} in {self.load_times[name]:.2f} s')
+        return value
+
+    def load(self):
+        """
+        Loads every model. Calling it again is a no-op.
+        """
+        if self.loaded:
+            return self
+
+        start = time.perf_counter()
+
+        self.vibe_model = self._timed('vibe', lambda: load_vibe_model(self.device))
+        if self.compiled:
+            # before the batcher, which keeps the backbone it is given
+            self.compiled_parts = self._timed('vibe_compiled', lambda: compile_vibe(
+                self.vibe_model, self.compiled_root, export=self.export_compiled))
+        if self.feature_batch_size:
+            self.feature_batcher = FeatureBatcher(self.vibe_model.hmr.feature_extractor,
+                                                  max_batch_size=self.feature_batch_size,
+                                                  max_wait=self.feature_batch_wait)
+        self.tracker = self._timed('tracker', lambda: build_tracker(
+            self.device,
+            tracker_batch_size=self.tracker_batch_size,
+            detector=self.detector,
+            yolo_img_size=self.yolo_img_size,
+        ))
+        self.smpl = self._timed('smpl', lambda: SMPL(SMPL_MODEL_DIR, create_transl=False).eval())
+        self.smpl_faces = self.smpl.faces
+
+        def _load_measurer():
+            measurer = MeasureBody(self.model_type)
+            # warm the joint regressor so jobs never rebuild the body model
+            measurer.load_joint_regressor()
+            return measurer
+
+        self.measurer = self._timed('measurer', _load_measurer)
+
+        self.load_times['total'] = time.perf_counter() - start
+        self.loaded = True
+        return self
+
+    def new_measurer(self):
+        """
+        Returns a measurer sharing the loaded model data of the template,
+        with no body or measurements set.
+        """
+        measurer = copy.copy(self.measurer)
+        measurer.reset()
+        return measurer
+
+    def report(self, job_times: dict = None):
+        """
+        Cold-start cost of the registry next to the cost of one job.
+
+        :param job_times: dict of {stage: seconds} measured for a job
+        """
+        report = {'cold_start': dict(self.load_times), 'compiled_parts': list(self.compiled_parts)}
+        if self.feature_batcher is not None:
+            report['feature_batcher'] = dict(self.feature_batcher.stats)
+        if job_times is not None:
+            report['job'] = dict(job_times)
+        return report
+
+
+_REGISTRY = None
+_REGISTRY_LOCK = threading.Lock()
+
+
+def get_registry(**kwargs):
+    """
+    Returns the process wide registry, loading it on first use.
+    """
+    global _REGISTRY
+    with _REGISTRY_LOCK:
+        if _REGISTRY is None:
+            _REGISTRY = ModelRegistry(**kwargs).load()
+    return _REGISTRY
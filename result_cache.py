@@ -0,0 +1,151 @@
+# result_cache.py
+# --------------------------------------------------------------
+# Content-addressed cache of pipeline results
+# --------------------------------------------------------------
+# Clients often resubmit the same video after a timeout or a UI
+# retry. Results are stored on local disk under the sha256 of the
+# video bytes and the pipeline parameters, so a resubmission is
+# answered from disk. The cache is an LRU capped in bytes.
+# --------------------------------------------------------------
+
+import os
+import json
+import hashlib
+import tempfile
+import threading
+from pathlib import Path
+from collections import OrderedDict
+
+import joblib
+
+DEFAULT_ROOT = Path(tempfile.gettempdir()) / "result_cache"
+DEFAULT_MAX_BYTES = 1024 ** 3
+
+# bump when a pipeline change makes old entries wrong
+CACHE_VERSION = 2
+
+
+def content_key(data: bytes, params: dict = None) -> str:
+    """
+    sha256 of `data` and the JSON of `params` (key order does not matter).
+    """
+    digest = hashlib.sha256()
+    digest.update(data)
+    digest.update(json.dumps({'version': CACHE_VERSION, 'params': params or {}},
+                             sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+class ResultCache():
+    """
+    LRU cache on disk, one file per entry, at most `max_bytes` in total.
+
+    Two kinds of entries are kept: final results (JSON, `get_result` /
+    `put_result`) and intermediate VIBE results (joblib, `get_vibe` /
+    `put_vibe`). Entries written by a previous process are picked up at
+    start, oldest used first out. Thread-safe.
+    """
+
+    def __init__(self, root=DEFAULT_ROOT, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+
+        self.stats = {'hits': 0, 'misses': 0, 'vibe_hits': 0, 'vibe_misses': 0,
+                      'stores': 0, 'evictions': 0}
+
+        self._lock = threading.Lock()
+        # file name -> size, least recently used first
+        self._entries = OrderedDict()
+        self._size = 0
+
+        files = [path for path in self.root.iterdir()
+                 if path.is_file() and not path.name.startswith('.')]
+        for path in sorted(files, key=lambda p: p.stat().st_mtime):
+            size = path.stat().st_size
+            self._entries[path.name] = size
+            self._size += size
+        with self._lock:
+            self._evict()
+
+    def _evict(self):
+        while self._size > self.max_bytes and self._entries:
+            name, size = self._entries.popitem(last=False)
+            self._size -= size
+            self.stats['evictions'] += 1
+            try:
+                (self.root / name).unlink()
+            except OSError:
+                pass
+
+    def _forget(self, name: str):
+        # with the lock held
+        if name in self._entries:
+            self._size -= self._entries.pop(name)
+            try:
+                (self.root / name).unlink()
+            except OSError:
+                pass
+
+    def _read(self, name: str, load, stat: str):
+        # the lock only guards the bookkeeping, loading runs outside it
+        with self._lock:
+            found = name in self._entries
+            if found:
+                self._entries.move_to_end(name)
+
+        value = None
+        if found:
+            path = self.root / name
+            try:
+                os.utime(path)
+                value = load(path)
+            except Exception:
+                # unreadable (or meanwhile evicted) entry, forget it
+                with self._lock:
+                    self._forget(name)
+
+        with self._lock:
+            self.stats[f'{stat}hits' if value is not None else f'{stat}misses'] += 1
+        return value
+
+    def _write(self, name: str, dump):
+        path = self.root / name
+        # write next to the entry and rename, readers never see a
+        # partial file; one tmp file per thread, writers of the same
+        # entry do not clash
+        tmp_path = self.root / f'.{name}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            dump(tmp_path)
+            size = tmp_path.stat().st_size
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                tmp_path.unlink()
+            except OSError:
+                pass
+            raise
+
+        with self._lock:
+            if name in self._entries:
+                self._size -= self._entries.pop(name)
+            self._entries[name] = size
+            self._size += size
+            self.stats['stores'] += 1
+            self._evict()
+
+    def get_result(self, key: str):
+        return self._read(f'{key}.json', lambda path: json.loads(path.read_text()), '')
+
+    def put_result(self, key: str, result: dict):
+        self._write(f'{key}.json', lambda path: path.write_text(json.dumps(result)))
+
+    def get_vibe(self, key: str):
+        return self._read(f'{key}.vibe.pkl', joblib.load, 'vibe_')
+
+    def put_vibe(self, key: str, vibe_results: dict):
+        self._write(f'{key}.vibe.pkl', lambda path: joblib.dump(vibe_results, path))
+
+    def report(self) -> dict:
+        with self._lock:
+            return dict(self.stats, entries=len(self._entries), bytes=self._size)
@@ -53,11 +53,123 @@ def convex_hull_from_3D_points(slice_segments: np.ndarray):
         return slice_segments_hull
 
 
+def slice_faces_with_plane(verts: np.ndarray,
+                           faces: np.ndarray,
+                           vertex_dists: np.ndarray):
+        '''
+        Intersect the given faces with a plane, given the signed distance
+        of every vertex to the plane. Only the faces passed in are checked,
+        so pre-selecting the faces of a body part keeps it cheap.
+        Vertices lying exactly on the plane are counted on its positive side.
+        :param verts: np.ndarray (V,3) - mesh vertices
+        :param faces: np.ndarray (K,3) - vertex indices of the faces to slice
+        :param vertex_dists: np.ndarray (V,) - signed distance (up to scale)
+                                              of each vertex to the plane
+
+        Return:
+        :param slice_segments: np.ndarray (N,2,3) for N segments 
+                                represented as two 3D points
+        :param sliced_faces: np.ndarray (N,) - positions in faces of the
+                                                sliced faces
+        '''
+
+        positive = vertex_dists[faces] >= 0 # (K,3)
+        num_positive = positive.sum(axis=1)
+        sliced_faces = np.flatnonzero((num_positive == 1) | (num_positive == 2))
+
+        faces = faces[sliced_faces]
+        positive = positive[sliced_faces]
+
+        # the vertex alone on its side of the plane, both edges leaving it 
+        # are cut
+        lone = np.where(num_positive[sliced_faces] == 1,
+                        np.argmax(positive, axis=1),
+                        np.argmin(positive, axis=1))
+        rows = np.arange(len(faces))
+        lone_verts = faces[rows, lone]
+
+        slice_segments = np.empty((len(faces),2,3), dtype=verts.dtype)
+        for i, shift in enumerate((1,2)):
+            other_verts = faces[rows, (lone + shift) % 3]
+            # cut every edge from its lower index vertex so that faces 
+            # sharing the edge give exactly the same point
+            a = np.minimum(lone_verts, other_verts)
+            b = np.maximum(lone_verts, other_verts)
+            t = vertex_dists[a] / (vertex_dists[a] - vertex_dists[b])
+            slice_segments[:,i] = verts[a] + t[:,None] * (verts[b] - verts[a])
+
+        return slice_segments, sliced_faces
+
+
+def slice_faces_with_planes(verts: np.ndarray,
+                            faces: np.ndarray,
+                            plane_origins: np.ndarray,
+                            plane_normals: np.ndarray):
+        '''
+        Slice a stack of F meshes sharing the same faces, each with its own
+        plane, in one pass. The frames are laid out as one mesh of F*V 
+        vertices and cut with slice_faces_with_plane.
+        :param verts: np.ndarray (F,V,3) - vertices of the F meshes
+        :param faces: np.ndarray (K,3) - vertex indices of the faces to slice
+        :param plane_origins: np.ndarray (F,3) - a point of each plane
+        :param plane_normals: np.ndarray (F,3) - normal of each plane
+
+        Return:
+        :param slice_segments: np.ndarray (N,2,3) for N segments 
+                                represented as two 3D points
+        :param frame_ids: np.ndarray (N,) - sorted frame of each segment
+        '''
+
+        num_frames, num_verts = verts.shape[:2]
+
+        vertex_dists = (np.einsum('fvk,fk->fv', verts, plane_normals) - 
+                        np.sum(plane_origins * plane_normals, axis=1)[:,None])
+        frame_faces = faces[None] + (np.arange(num_frames) * num_verts)[:,None,None]
+
+        slice_segments, sliced_faces = slice_faces_with_plane(verts.reshape(-1,3),
+                                                              frame_faces.reshape(-1,3),
+                                                              vertex_dists.reshape(-1))
+
+        return slice_segments, sliced_faces // len(faces)
+
+
+def get_body_part_face_masks(circumf_2_bodypart: dict,
+                             face_segmentation: dict,
+                             num_faces: int):
+        '''
+        Build for each circumference a boolean mask over all faces that
+        is True for the faces of its body part(s).
+        :param circumf_2_bodypart: dict - dict mapping measurement to body part
+        :param face_segmentation: dict - dict mapping body part to all faces belonging
+                                        to it
+        :param num_faces: int - number of faces of the body model
+
+        Return:
+        :param face_masks: dict - dict mapping measurement to np.ndarray (num_faces,)
+                                  of bools
+        '''
+
+        face_masks = {}
+        for measurement_name, body_parts in circumf_2_bodypart.items():
+
+            if not isinstance(body_parts,list):
+                body_parts = [body_parts]
+
+            mask = np.zeros(num_faces, dtype=bool)
+            for body_part in body_parts:
+                mask[face_segmentation[body_part]] = True
+
+            face_masks[measurement_name] = mask
+
+        return face_masks
+
+
 def filter_body_part_slices(slice_segments:np.ndarray, 
                              sliced_faces:np.ndarray,
                              measurement_name: str,
                              circumf_2_bodypart: dict,
-                             face_segmentation: dict
+                             face_segmentation: dict,
+                             face_masks: dict = None
                             ):
         '''
         Remove segments that are not in the appropriate body part 
@@ -70,6 +182,9 @@ def filter_body_part_slices(slice_segments:np.ndarray,
         :param circumf_2_bodypart: dict - dict mapping measurement to body part
         :param face_segmentation: dict - dict mapping body part to all faces belonging
                                         to it
+        :param face_masks: dict - optional precomputed masks from 
+                                  get_body_part_face_masks, used instead of
+                                  circumf_2_bodypart and face_segmentation
 
         Return:
         :param slice_segments: np.ndarray (K,2,3) where K < N, for K segments 
@@ -77,6 +192,9 @@ def filter_body_part_slices(slice_segments:np.ndarray,
                                 appropriate body part
         '''
 
+        if face_masks is not None and measurement_name in face_masks:
+            return slice_segments[face_masks[measurement_name][sliced_faces]]
+
         if measurement_name in circumf_2_bodypart.keys():
 
             body_parts = circumf_2_bodypart[measurement_name]
@@ -87,12 +205,7 @@ def filter_body_part_slices(slice_segments:np.ndarray,
             else:
                 body_part_faces = face_segmentation[body_parts]
 
-            N_sliced_faces = sliced_faces.shape[0]
-
-            keep_segments = []
-            for i in range(N_sliced_faces):
-                if sliced_faces[i] in body_part_faces:
-                    keep_segments.append(i)
+            keep_segments = np.isin(sliced_faces, body_part_faces)
 
             return slice_segments[keep_segments]
 
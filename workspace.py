@@ -0,0 +1,144 @@
+# workspace.py
+# --------------------------------------------------------------
+# Per-job scratch directories
+# --------------------------------------------------------------
+# Every job gets its own directory under a common root, so jobs
+# running at the same time in one worker never share file names.
+# The directory is capped in size and removed when the job ends,
+# whether it succeeded or failed.
+# --------------------------------------------------------------
+
+import os
+import re
+import time
+import shutil
+import tempfile
+from pathlib import Path
+
+DEFAULT_ROOT = Path(tempfile.gettempdir()) / "runpod"
+DEFAULT_QUOTA_BYTES = 2 * 1024 ** 3
+WORKSPACE_PREFIX = "job_"
+
+
+class WorkspaceQuotaExceeded(Exception):
+    pass
+
+
+class JobWorkspace():
+    """
+    Unique scratch directory of one job, used as a context manager:
+
+        with JobWorkspace(job_id=job["id"]) as ws:
+            video_path = ws.write_bytes("input.mp4", video_bytes)
+            ...
+            ws.check_quota()
+
+    The directory is created on enter and deleted on exit. `quota_bytes`
+    caps the size of everything written in it: `write_bytes` refuses
+    writes that would exceed it and `check_quota` raises
+    `WorkspaceQuotaExceeded` once the files written by other code have
+    grown past it.
+    """
+
+    def __init__(self,
+                 root=DEFAULT_ROOT,
+                 job_id: str = None,
+                 quota_bytes: int = DEFAULT_QUOTA_BYTES):
+        self.root = Path(root)
+        self.job_id = job_id
+        self.quota_bytes = quota_bytes
+        self.path = None
+
+    def __enter__(self):
+        self.root.mkdir(parents=True, exist_ok=True)
+        # the job id only makes the directory easier to find, mkdtemp
+        # keeps it unique when ids repeat
+        tag = re.sub(r'[^A-Za-z0-9_-]', '', str(self.job_id or ''))[:32]
+        self.path = Path(tempfile.mkdtemp(prefix=f'{WORKSPACE_PREFIX}{tag}_', dir=self.root))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cleanup()
+        return False
+
+    def cleanup(self):
+        if self.path is not None:
+            shutil.rmtree(self.path, ignore_errors=True)
+            self.path = None
+
+    def _require_open(self):
+        if self.path is None:
+            raise RuntimeError('Workspace is not open, use it as a context manager')
+
+    def file(self, name: str) -> Path:
+        """
+        Path of `name` inside the workspace (nothing is created).
+        """
+        self._require_open()
+        return self.path / name
+
+    def subdir(self, name: str) -> Path:
+        """
+        Creates (if needed) and returns the directory `name` inside the workspace.
+        """
+        self._require_open()
+        path = self.path / name
+        path.mkdir(parents=True, exist_ok=True)
+        return path
+
+    def usage(self) -> int:
+        """
+        Total size in bytes of the files in the workspace.
+        """
+        self._require_open()
+        total = 0
+        for dirpath, _, filenames in os.walk(self.path):
+            for filename in filenames:
+                try:
+                    total += os.path.getsize(os.path.join(dirpath, filename))
+                except OSError:
+                    pass
+        return total
+
+    def check_quota(self, extra_bytes: int = 0):
+        """
+        Raises `WorkspaceQuotaExceeded` if the workspace, plus `extra_bytes`
+        about to be written, is larger than the quota.
+        """
+        if self.quota_bytes is None:
+            return
+        used = self.usage() + extra_bytes
+        if used > self.quota_bytes:
+            raise WorkspaceQuotaExceeded(
+                f'Job workspace needs {used / 1024 ** 2:.1f} MB, '
+                f'quota is {self.quota_bytes / 1024 ** 2:.1f} MB')
+
+    def write_bytes(self, name: str, data: bytes) -> Path:
+        """
+        Writes `data` to `name` inside the workspace, within the quota.
+        """
+        self.check_quota(extra_bytes=len(data))
+        path = self.file(name)
+        path.write_bytes(data)
+        return path
+
+
+def cleanup_stale_workspaces(root=DEFAULT_ROOT, max_age_s: float = 3600.0):
+    """
+    Removes the workspaces under `root` left behind by killed processes,
+    i.e. older than `max_age_s` seconds. Returns the number removed.
+    """
+    root = Path(root)
+    if not root.is_dir():
+        return 0
+
+    removed = 0
+    now = time.time()
+    for path in root.glob(f'{WORKSPACE_PREFIX}*'):
+        try:
+            if path.is_dir() and now - path.stat().st_mtime > max_age_s:
+                shutil.rmtree(path, ignore_errors=True)
+                removed += 1
+        except OSError:
+            pass
+    return removed